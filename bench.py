@@ -0,0 +1,270 @@
+import time, random, json, argparse, os, tempfile, tracemalloc, gc, glob, socket
+from suffixindex import SUFFIX_INDEX
+from codec import CODECS
+from zone import ZONE
+from cache import CACHE
+from zonedb import ZONE_DB, convertZone
+from snapshot import ZONE_SNAPSHOT, compileZone
+from counters import COUNTERS
+from loadtest import prepareWorkdir, waitForServer, percentile
+from run import allZones, startAll
+
+#Micro benchmarks for single building blocks, the whole system is measured by loadtest.py
+
+def scanSuffix(zones, domain):
+	"""The old suffix matching of DNS_SERVER and RESOLVER, kept for comparison
+
+	Args:
+		zones (dict): known names
+		domain (str): The Domain we look for
+
+	Returns:
+		str: longest known name found inside the domain
+	"""
+	biggestZone = ""
+	for zone in zones:
+		if zone in domain and len(zone) > len(biggestZone):
+			biggestZone = zone
+	return biggestZone
+
+def timeLookups(lookup, domains):
+	"""Runs a lookup for every domain
+
+	Returns:
+		float: microseconds per lookup
+	"""
+	start = time.perf_counter()
+	for domain in domains:
+		lookup(domain)
+	return (time.perf_counter() - start) / len(domains) * 1e6
+
+def benchSuffix(args):
+	"""Compares the label trie with the old substring scan on a big generated zone
+	"""
+	rng = random.Random(args.seed)
+	zones = {}
+	while len(zones) < args.entries:
+		name = "host%d.sub%d.zone%d." % (rng.randrange(10 ** 6), rng.randrange(100), rng.randrange(50))
+		zones[name] = {"A": "127.0.0.1", "TTL": 100}
+	names = list(zones)
+	# Half the lookups hit a name below a known one, half miss everything
+	domains = ["www." + rng.choice(names) if i % 2 else "www.unknown%d.zone%d." % (i, i % 50) for i in range(args.lookups)]
+
+	start = time.perf_counter()
+	index = SUFFIX_INDEX(zones)
+	buildMs = (time.perf_counter() - start) * 1000
+
+	scanned = domains[:args.scanLookups]
+	for domain in scanned:
+		# The scan also matches "host1.sub2.zone3." inside "xhost1.sub2.zone3.", so only compare hits
+		if domain.startswith("www.host"):
+			assert index.longestSuffix(domain) == scanSuffix(zones, domain)
+	result = {
+		"benchmark": "suffix",
+		"entries": len(zones),
+		"buildMs": round(buildMs, 1),
+		"trieUsPerLookup": round(timeLookups(index.longestSuffix, domains), 3),
+		"scanUsPerLookup": round(timeLookups(lambda domain: scanSuffix(zones, domain), scanned), 3),
+	}
+	result["speedup"] = round(result["scanUsPerLookup"] / result["trieUsPerLookup"], 1)
+	print(json.dumps(result))
+
+def sampleMessages():
+	"""One of every message kind our servers exchange
+
+	Returns:
+		dict: kind -> message
+	"""
+	question = {"dns.id": 4711, "dns.qry.name": "www.switch.telematik.", "dns.qry.type": 1}
+	response = dict(question, **{"dns.flags.response": 1, "dns.flags.recavail": 0, "dns.flags.rcode": 0, "dns.flags.authoritative": 1})
+	return {
+		"query": dict(question, **{"dns.flags.response": 0, "dns.flags.recdesired": 1}),
+		"answer": dict(response, **{"dns.count.answers": 1, "dns.ns": "www.switch.telematik.", "dns.a": "127.0.0.14", "dns.resp.ttl": 100}),
+		"referral": dict(response, **{"dns.flags.authoritative": 0, "dns.count.answers": 0, "dns.count_auth_rr": 1, "dns.ns": "switch.telematik.", "dns.a": "127.0.0.13", "dns.resp.ttl": 400}),
+		"nxdomain": dict(response, **{"dns.count.answers": 0, "dns.flags.rcode": 3}),
+	}
+
+def benchCodec(args):
+	"""Measures encode and decode cost and packet size of every codec for every message kind
+	"""
+	for kind, message in sampleMessages().items():
+		for codec in CODECS.values():
+			data = codec.encode(message)
+			assert codec.decode(data) == message, (codec.name, kind, codec.decode(data))
+			start = time.perf_counter()
+			for i in range(args.rounds):
+				codec.encode(message)
+			encodeUs = (time.perf_counter() - start) / args.rounds * 1e6
+			start = time.perf_counter()
+			for i in range(args.rounds):
+				codec.decode(data)
+			decodeUs = (time.perf_counter() - start) / args.rounds * 1e6
+			print(json.dumps({"benchmark": "codec", "codec": codec.name, "message": kind, "bytes": len(data), "encodeUs": round(encodeUs, 3), "decodeUs": round(decodeUs, 3)}))
+
+def buildTraced(build):
+	"""Builds something once for the time and once more for the memory, tracing slows the build down
+
+	Returns:
+		tuple: the built object, milliseconds, MiB allocated by the build
+	"""
+	# Whatever the last benchmark left behind shouldn't be collected on our clock
+	gc.collect()
+	start = time.perf_counter()
+	build()
+	buildMs = (time.perf_counter() - start) * 1000
+	tracemalloc.start()
+	built = build()
+	mib = tracemalloc.get_traced_memory()[0] / 2 ** 20
+	tracemalloc.stop()
+	return built, buildMs, mib
+
+def benchZone(args):
+	"""Compares a JSON zone compiled into memory with the same zone in SQLite and loaded from its snapshot
+	"""
+	rng = random.Random(args.seed)
+	records = {}
+	while len(records) < args.entries:
+		name = "host%d.sub%d.zone%d." % (rng.randrange(10 ** 7), rng.randrange(100), rng.randrange(50))
+		records[name] = {"A": "127.0.0.1", "TTL": 100}
+	names = list(records)
+	domains = [rng.choice(names) if i % 2 else "www." + rng.choice(names) for i in range(args.lookups)]
+	with tempfile.TemporaryDirectory() as directory:
+		zonePath = os.path.join(directory, "big.zone")
+		with open(zonePath, "w") as zonefile:
+			json.dump(records, zonefile)
+		start = time.perf_counter()
+		dbPath = convertZone(zonePath)
+		convertMs = (time.perf_counter() - start) * 1000
+		start = time.perf_counter()
+		snapPath = compileZone(zonePath)
+		snapshotMs = (time.perf_counter() - start) * 1000
+
+		for backend, build in (("dict", lambda: ZONE(json.load(open(zonePath)), True)), ("sqlite", lambda: ZONE_DB(dbPath, True)), ("snapshot", lambda: ZONE_SNAPSHOT(snapPath, True))):
+			zone, buildMs, mib = buildTraced(build)
+			for domain in domains[:100]:
+				assert zone.lookup(domain)[0]["dns.ns"] == zone.records.longestSuffix(domain)
+			result = {
+				"benchmark": "zone",
+				"backend": backend,
+				"entries": len(zone.records),
+				"loadMs": round(buildMs, 1),
+				"heapMiB": round(mib, 1),
+				"usPerLookup": round(timeLookups(zone.lookup, domains), 3),
+			}
+			if backend == "sqlite":
+				result["convertMs"] = round(convertMs, 1)
+				result["fileMiB"] = round(os.path.getsize(dbPath) / 2 ** 20, 1)
+			if backend == "snapshot":
+				# The first lookup of a name compiles its response, the second one finds it
+				result["usPerWarmLookup"] = round(timeLookups(zone.lookup, domains), 3)
+				result["convertMs"] = round(snapshotMs, 1)
+				result["fileMiB"] = round(os.path.getsize(snapPath) / 2 ** 20, 1)
+			print(json.dumps(result))
+			zone = None
+
+def timeQueries(sock, names):
+	"""Asks the resolver for every name, one after another
+
+	Returns:
+		list: microseconds per query
+	"""
+	times = []
+	for name in names:
+		query = json.dumps({"dns.flags.response": 0, "dns.flags.recdesired": 1, "dns.qry.name": name, "dns.qry.type": 1}).encode('utf-8')
+		start = time.perf_counter()
+		sock.sendto(query, ("127.0.0.10", 53053))
+		sock.recvfrom(65535)
+		times.append((time.perf_counter() - start) * 1e6)
+	return times
+
+def benchCache(args):
+	"""Latency of stub queries the resolver answers from its cache vs. ones that need the whole recursion
+	"""
+	os.chdir(prepareWorkdir())
+	# Every name in a zone file is answered by that zone
+	names = []
+	for path in sorted(glob.glob(os.path.join("zones", "*.zone"))):
+		with open(path) as zonefile:
+			names += list(json.load(zonefile))
+	counters = COUNTERS(names=["resolver"] + [name for ip, name, auth in allZones()])
+	processes = startAll(counters, {"logLevel": "off"}, {"logLevel": "off"}, {})
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.settimeout(10)
+	try:
+		for ip, name, authoritative in allZones():
+			waitForServer(ip, 53053)
+		time.sleep(0.5)
+		for phase, rounds in (("cold", 1), ("cached", args.rounds)):
+			sent = counters.counter("resolver").get("sent")
+			times = timeQueries(sock, names * rounds)
+			# The resolver counts its answers to us and its questions upstream
+			upstream = counters.counter("resolver").get("sent") - sent - len(times)
+			print(json.dumps({"benchmark": "cache", "phase": phase, "queries": len(times), "upstreamPerQuery": round(upstream / len(times), 2), "p50Us": percentile(times, 0.5), "p99Us": percentile(times, 0.99)}))
+	finally:
+		sock.close()
+		for process in processes:
+			process.terminate()
+			process.join()
+
+def benchEntries(args):
+	"""Bytes the resolver cache needs per entry, with everything it keeps besides the entry (LRU order, expiry heap, indexes)
+	"""
+	rng = random.Random(args.seed)
+	names = ["host%d.sub%d.zone%d." % (n, rng.randrange(100), rng.randrange(50)) for n in range(args.entries)]
+	zones = sorted({name.split(".", 1)[1] for name in names})
+
+	def fill():
+		cache = CACHE(None, len(names) + len(zones))
+		for zone in zones:
+			cache.putDelegation(zone, "127.1.%d.%d" % (len(zone) % 256, zone.count("1")), 3600)
+		for n, name in enumerate(names):
+			# Like a real mix: mostly answers, some names that don't exist
+			if n % 10:
+				cache.putAnswer(name, 1, "127.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255), 300)
+			else:
+				cache.putNegative(name, 1, 3)
+		return cache
+
+	cache, fillMs, mib = buildTraced(fill)
+	lookups = [rng.choice(names) for n in range(args.lookups)]
+	print(json.dumps({
+		"benchmark": "entries",
+		"entries": len(cache),
+		"fillMs": round(fillMs, 1),
+		"heapMiB": round(mib, 1),
+		"bytesPerEntry": round(mib * 2 ** 20 / len(cache), 1),
+		"usPerLookup": round(timeLookups(lambda name: cache.lookupEntry(name, 1), lookups), 3),
+	}))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Micro benchmarks for the DNS building blocks")
+	parser.add_argument("--seed", type=int, default=53053)
+	sub = parser.add_subparsers(dest="benchmark")
+	sub.required = True
+
+	suffix = sub.add_parser("suffix", help="label trie vs. substring scan for suffix matching")
+	suffix.add_argument("--entries", type=int, default=100000, help="names in the generated zone")
+	suffix.add_argument("--lookups", type=int, default=100000, help="lookups against the trie")
+	suffix.add_argument("--scanLookups", type=int, default=50, help="lookups against the scan, it is slow")
+	suffix.set_defaults(run=benchSuffix)
+
+	codec = sub.add_parser("codec", help="encode/decode cost and bytes per packet of the JSON and RFC 1035 codecs")
+	codec.add_argument("--rounds", type=int, default=20000)
+	codec.set_defaults(run=benchCodec)
+
+	zone = sub.add_parser("zone", help="JSON zone compiled in memory vs. SQLite zone vs. snapshot: load time, memory and lookups")
+	zone.add_argument("--entries", type=int, default=100000, help="names in the generated zone")
+	zone.add_argument("--lookups", type=int, default=100000, help="lookups against each zone, half of them are referrals")
+	zone.set_defaults(run=benchZone)
+
+	cache = sub.add_parser("cache", help="stub query latency with a cold resolver cache vs. answered from the cache, starts all servers")
+	cache.add_argument("--rounds", type=int, default=200, help="times every name is asked once it is cached")
+	cache.set_defaults(run=benchCache)
+
+	entries = sub.add_parser("entries", help="memory per resolver cache entry and lookup cost with a big cache")
+	entries.add_argument("--entries", type=int, default=1000000, help="cached names, one in ten of them failed")
+	entries.add_argument("--lookups", type=int, default=200000)
+	entries.set_defaults(run=benchEntries)
+
+	args = parser.parse_args()
+	args.run(args)
@@ -0,0 +1,396 @@
+import time, heapq, sys
+from collections import OrderedDict
+from suffixindex import SUFFIX_INDEX
+from records import ENTRY, ANSWER, DELEGATION, NEGATIVE, packAddress, unpackAddress
+
+class CACHE():
+	def __init__(self, entries=None, maxEntries=10000, maxBytes=None, negativeTTL=60, staleSec=0):
+		"""In-memory resolver cache with LRU eviction, an expiry heap and negative caching
+
+		Three kinds of entries: delegations map a zone to the A record(s) of its servers and are found by suffix,
+		answers map (name, type) to the final A record, negative entries map (name, type) to the rcode it failed
+		with, NXDOMAIN (3) or SERVFAIL (2), so we don't recurse for them again
+
+		Every entry has a key, the zone name for delegations and "name/type" for answers and failures,
+		which is also its key in cache.json. Entries are slotted objects with packed addresses (records.py),
+		a million of them would take gigabytes as dicts of strings
+
+		Args:
+			entries (dict): cache content as saved in cache.json
+			maxEntries (int): Entries we keep at most, least recently used ones are evicted first
+			maxBytes (int): Rough memory budget for all entries, None = unlimited
+			negativeTTL (int): Seconds we remember failed names, default = 60
+			staleSec (int): Seconds an answer is kept after it died, to answer from while it is refreshed (RFC 8767), default = 0
+		"""
+		self.maxEntries = maxEntries
+		self.maxBytes = maxBytes
+		self.negativeTTL = negativeTTL
+		self.staleSec = staleSec
+		self.delegations = SUFFIX_INDEX()
+		# answers and failures, "name/type" -> entry
+		self.answers = {}
+		# key -> estimated size, oldest use first
+		self.lru = OrderedDict()
+		self.bytes = 0
+		# (dieTime plus stale window, key), may contain outdated items which are skipped when popped
+		self.expiry = []
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expired = 0
+		self.staleHits = 0
+		# Called with (key, entry or None) whenever the content of cache.json changes
+		self.listener = None
+		if entries:
+			for key, entry in entries.items():
+				if "/" not in key and "rcode" in entry:
+					# cache.json from before answers had types, every query was for an A record
+					key = self.answerKey(key, 1)
+				self.insert(key, ENTRY.fromJSON(entry, "/" not in key))
+			self.sweep()
+
+	@staticmethod
+	def answerKey(name, qtype):
+		return "%s/%d" % (name, qtype)
+
+	@staticmethod
+	def entrySize(key, entry):
+		"""Estimates how many bytes an entry occupies in memory
+
+		Returns:
+			int: size in bytes
+		"""
+		return sys.getsizeof(key) + entry.size()
+
+	def table(self, key):
+		"""Where an entry with this key lives
+
+		Returns:
+			dict: delegations or answers
+		"""
+		return self.answers if "/" in key else self.delegations
+
+	def insert(self, key, entry):
+		"""Adds or replaces an entry and evicts old ones if we are over budget
+
+		Args:
+			key (str): zone name or "name/type"
+			entry (ENTRY): the entry
+		"""
+		self.remove(key, False)
+		self.table(key)[key] = entry
+		size = self.entrySize(key, entry)
+		self.lru[key] = size
+		self.bytes += size
+		heapq.heappush(self.expiry, (self.dropTime(key, entry), key))
+		self.changed(key)
+		self.evict()
+
+	def remove(self, key, notify=True):
+		"""Drops an entry if we have it
+
+		Args:
+			key (str): zone name or "name/type"
+			notify (bool): Tell the listener about it
+
+		Returns:
+			bool: an entry was dropped
+		"""
+		size = self.lru.pop(key, None)
+		if size is None:
+			return False
+		self.bytes -= size
+		del self.table(key)[key]
+		if notify:
+			self.changed(key)
+		return True
+
+	def dropTime(self, key, entry):
+		"""When an entry leaves the cache, answers stay staleSec longer than they live
+
+		Returns:
+			int: unix time
+		"""
+		if self.staleSec and entry.rcode is None and "/" in key:
+			return entry.dieTime + self.staleSec
+		return entry.dieTime
+
+	def changed(self, key):
+		"""Tells the listener what cache.json holds for key now
+
+		Args:
+			key (str): the changed key
+		"""
+		if self.listener is not None:
+			self.listener(key, self.table(key).get(key))
+
+	def evict(self):
+		"""Drops least recently used entries until we are within entry count and byte budget
+		"""
+		while self.lru and (len(self.lru) > self.maxEntries or (self.maxBytes is not None and self.bytes > self.maxBytes)):
+			key = next(iter(self.lru))
+			self.remove(key)
+			self.evictions += 1
+
+	def sweep(self, now=None):
+		"""Drops every entry whose time to live has run out, without waiting for someone to look it up
+
+		Args:
+			now (int): current unix time, default = time.time()
+
+		Returns:
+			int: number of dropped entries
+		"""
+		if now is None:
+			now = int(time.time())
+		dropped = 0
+		while self.expiry and self.expiry[0][0] < now:
+			dropTime, key = heapq.heappop(self.expiry)
+			entry = self.table(key).get(key)
+			# The heap item may belong to an entry that has been replaced or evicted in the meantime
+			if entry is not None and self.dropTime(key, entry) == dropTime:
+				self.remove(key)
+				dropped += 1
+		self.expired += dropped
+		# Outdated heap items pile up when entries are refreshed often, rebuild from the live entries
+		if len(self.expiry) > 2 * len(self.lru) + 64:
+			self.rebuildExpiry()
+		return dropped
+
+	def rebuildExpiry(self):
+		self.expiry = [(self.dropTime(key, entries[key]), key) for entries in (self.delegations, self.answers) for key in entries]
+		heapq.heapify(self.expiry)
+
+	def putDelegation(self, name, address, ttl, servers=None):
+		"""Caches the servers of a zone we were referred to
+
+		Args:
+			name (str): name of the zone (and its server)
+			address (str): A record of its server
+			ttl (int): time to live in seconds
+			servers (list): addresses of all name servers of the zone, if it has more than one
+		"""
+		if servers and len(servers) > 1:
+			self.insert(name, DELEGATION(packAddress(address), ttl, servers=tuple(packAddress(server) for server in servers)))
+		else:
+			self.insert(name, DELEGATION(packAddress(address), ttl))
+
+	def putAnswer(self, name, qtype, address, ttl):
+		"""Caches the final answer to a query, replaces a failure of the same query
+
+		Args:
+			name (str): the queried name
+			qtype (int): the queried type
+			address (str): the A record
+			ttl (int): time to live in seconds
+		"""
+		self.insert(self.answerKey(name, qtype), ANSWER(packAddress(address), ttl))
+
+	def putNegative(self, name, qtype, rcode, ttl=None):
+		"""Caches a failed query, replaces an answer to the same query
+
+		Args:
+			name (str): the name we couldn't resolve
+			qtype (int): the queried type
+			rcode (int): 3 for NXDOMAIN, 2 for SERVFAIL
+			ttl (int): time to live in seconds, default = negativeTTL
+		"""
+		if ttl is None:
+			ttl = self.negativeTTL
+		self.insert(self.answerKey(name, qtype), NEGATIVE(rcode, ttl))
+
+	def lookupDelegation(self, domain):
+		"""Searches the cache for the biggest zone above or at the domain that is still alive
+
+		Args:
+			domain (str): the requested name
+
+		Returns:
+			tuple: the zone and the A record of its server, or None if we know no zone of the domain
+		"""
+		now = int(time.time())
+		while 1:
+			name = self.delegations.longestSuffix(domain)
+			if name == "":
+				self.misses += 1
+				return None
+			entry = self.delegations[name]
+			# Entry dying this very second is still okay to return
+			if entry.dieTime >= now:
+				self.lru.move_to_end(name)
+				self.hits += 1
+				entry.hits += 1
+				return (name, unpackAddress(entry.address))
+			# Too old, drop it and try the next smaller zone
+			self.remove(name)
+			self.expired += 1
+
+	def lookupEntry(self, name, qtype):
+		"""Finds the live answer or failure of a query, every call is one hit or one miss
+
+		Args:
+			name (str): the requested name
+			qtype (int): the requested type
+
+		Returns:
+			ENTRY: the ANSWER, the NEGATIVE or None
+		"""
+		key = self.answerKey(name, qtype)
+		entry = self.answers.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		if entry.dieTime < int(time.time()):
+			# lookupStale() may still want an answer
+			if self.dropTime(key, entry) < int(time.time()):
+				self.remove(key)
+				self.expired += 1
+			self.misses += 1
+			return None
+		self.lru.move_to_end(key)
+		self.hits += 1
+		entry.hits += 1
+		return entry
+
+	def lookupAnswer(self, name, qtype):
+		"""Checks if we know the final answer to a query
+
+		Args:
+			name (str): the requested name
+			qtype (int): the requested type
+
+		Returns:
+			str: the cached A record or None
+		"""
+		entry = self.lookupEntry(name, qtype)
+		if entry is None or entry.address is None:
+			return None
+		return unpackAddress(entry.address)
+
+	def lookupNegative(self, name, qtype):
+		"""Checks if the query failed recently
+
+		Args:
+			name (str): the requested name
+			qtype (int): the requested type
+
+		Returns:
+			int: the cached rcode or None
+		"""
+		entry = self.lookupEntry(name, qtype)
+		if entry is None:
+			return None
+		return entry.rcode
+
+	def lookupStale(self, name, qtype):
+		"""Finds an answer to the query that died less than staleSec ago
+
+		Args:
+			name (str): the requested name
+			qtype (int): the requested type
+
+		Returns:
+			str: its A record or None
+		"""
+		key = self.answerKey(name, qtype)
+		entry = self.answers.get(key)
+		if entry is None or entry.address is None or self.dropTime(key, entry) < int(time.time()):
+			return None
+		self.lru.move_to_end(key)
+		self.staleHits += 1
+		return unpackAddress(entry.address)
+
+	def prefetchDue(self, name, qtype, fraction, minHits):
+		"""Decides if a live answer is popular and close enough to its death to be refreshed in the background
+
+		Args:
+			name (str): the requested name
+			qtype (int): the requested type
+			fraction (float): share of the TTL that may be left at most, e.g. 0.1
+			minHits (int): lookups the answer needs since it was cached
+
+		Returns:
+			bool: refresh it now
+		"""
+		key = self.answerKey(name, qtype)
+		entry = self.answers[key]
+		return entry.hits >= minHits and entry.dieTime - int(time.time()) <= fraction * entry.ttl
+
+	def servers(self, name):
+		"""Addresses of the name servers of a cached zone
+
+		Args:
+			name (str): a zone lookupDelegation() returned
+
+		Returns:
+			list: every address we know, the A record first
+		"""
+		return self.delegations[name].addressList()
+
+	def remainingTTL(self, key):
+		"""Seconds an entry has left to live
+
+		Args:
+			key (str): zone name or "name/type"
+
+		Returns:
+			int: remaining time to live, 0 if it's about to die
+		"""
+		return max(0, self.table(key)[key].dieTime - int(time.time()))
+
+	def longestSuffix(self, domain):
+		return self.delegations.longestSuffix(domain)
+
+	def state(self):
+		"""Everything the cache consists of, in types marshal can store, see restore()
+
+		Returns:
+			dict: entries as tuples of their fields, trie, LRU order, size, expiry heap and the stale window the heap was built with
+		"""
+		return {
+			"delegations": {name: entry.pack() for name, entry in self.delegations.items()},
+			"trie": self.delegations.trie,
+			"answers": {key: entry.pack() for key, entry in self.answers.items() if entry.rcode is None},
+			"negatives": {key: entry.pack() for key, entry in self.answers.items() if entry.rcode is not None},
+			"lru": list(self.lru.items()),
+			"bytes": self.bytes,
+			"expiry": self.expiry,
+			"staleSec": self.staleSec}
+
+	@classmethod
+	def restore(cls, state, maxEntries=10000, maxBytes=None, negativeTTL=60, staleSec=0):
+		"""Puts a cache back together from its state, without inserting every entry again
+
+		Args:
+			state (dict): see state()
+			maxEntries, maxBytes, negativeTTL, staleSec: see CACHE(), the state may hold more than we want to keep
+
+		Returns:
+			CACHE: the cache, over budget and expired entries already dropped
+		"""
+		cache = cls(None, maxEntries, maxBytes, negativeTTL, staleSec)
+		cache.delegations = SUFFIX_INDEX.restore({name: DELEGATION(*fields) for name, fields in state["delegations"].items()}, state["trie"])
+		cache.answers = {key: ANSWER(*fields) for key, fields in state["answers"].items()}
+		cache.answers.update((key, NEGATIVE(*fields)) for key, fields in state["negatives"].items())
+		cache.lru = OrderedDict(state["lru"])
+		cache.bytes = state["bytes"]
+		cache.expiry = state["expiry"]
+		if state["staleSec"] != staleSec:
+			# Answers leave the cache at another time now
+			cache.rebuildExpiry()
+		cache.evict()
+		cache.sweep()
+		return cache
+
+	def toDict(self):
+		"""Cache content with the keys of cache.json, ENTRY.toJSON() turns an entry into what cache.json holds
+
+		Returns:
+			dict: key -> ENTRY
+		"""
+		content = dict(self.delegations)
+		content.update(self.answers)
+		return content
+
+	def __len__(self):
+		return len(self.lru)
@@ -0,0 +1,457 @@
+import json, socket, struct
+
+# RFC 1035 types and classes we speak
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_OPT = 41
+CLASS_IN = 1
+
+# Plain DNS over UDP stops at 512 bytes, with EDNS (RFC 6891) both sides tell how much they can take in dns.edns.udpsize
+CLASSIC_UDP_SIZE = 512
+# What we can take, 1232 bytes fit into any path without IP fragmentation
+EDNS_UDP_SIZE = 1232
+
+HEADER = struct.Struct("!HHHHHH")
+QUESTION = struct.Struct("!HH")
+RR = struct.Struct("!HHIH")
+
+def udpLimit(message, ownSize=EDNS_UDP_SIZE):
+	"""Biggest UDP response we may send for a query
+
+	Args:
+		message (dict): the query
+		ownSize (int): the most we are willing to send, default = EDNS_UDP_SIZE
+
+	Returns:
+		int: bytes
+	"""
+	return max(CLASSIC_UDP_SIZE, min(ownSize, message.get("dns.edns.udpsize", CLASSIC_UDP_SIZE)))
+
+class JSON_CODEC():
+	name = "json"
+
+	def decode(self, data):
+		"""Turns a datagram into our message dictionary
+
+		Args:
+			data (bytes): the datagram
+
+		Returns:
+			dict: the message
+		"""
+		return json.loads(data.decode('utf-8'))
+
+	def encode(self, message):
+		"""Turns our message dictionary into a datagram, the same pretty JSON we always sent
+
+		Args:
+			message (dict): the message
+
+		Returns:
+			bytes: the datagram
+		"""
+		return json.dumps(message, indent=4).encode('utf-8')
+
+	def compile(self, body):
+		"""Precompiles a response that only depends on the zone, not on the query
+
+		Args:
+			body (dict): the response without dns.qry.name, dns.qry.type and dns.id
+
+		Returns:
+			JSON_TEMPLATE: the template
+		"""
+		return JSON_TEMPLATE(body)
+
+	def text(self, data, message):
+		"""Human readable form of a message for the dumps
+
+		Args:
+			data (bytes): the datagram
+			message (dict): the decoded message
+
+		Returns:
+			str: the message as text
+		"""
+		return data.decode('utf-8')
+
+class JSON_TEMPLATE():
+	def __init__(self, body):
+		"""Precompiled JSON response, only the question and transaction ID of a query get patched in
+
+		Args:
+			body (dict): the response without dns.qry.name, dns.qry.type and dns.id
+		"""
+		# Everything after the opening brace, already serialized
+		self.tail = json.dumps(body, indent=4)[1:].encode('utf-8')
+
+	def render(self, query):
+		"""Builds the response for a query
+
+		Args:
+			query (dict): the decoded query
+
+		Returns:
+			bytes: the datagram
+		"""
+		head = '{\n    "dns.qry.name": ' + json.dumps(query["dns.qry.name"]) + ',\n    "dns.qry.type": ' + json.dumps(query["dns.qry.type"]) + ','
+		if "dns.id" in query:
+			head += '\n    "dns.id": ' + json.dumps(query["dns.id"]) + ','
+		return head.encode('utf-8') + self.tail
+
+class BINARY_CODEC():
+	name = "binary"
+
+	@staticmethod
+	def optRecord(udpSize):
+		"""EDNS OPT pseudo record for the additional section, it abuses the class field for the UDP size
+
+		Args:
+			udpSize (int): bytes we can take over UDP
+
+		Returns:
+			bytes: the record
+		"""
+		return b"\x00" + RR.pack(TYPE_OPT, udpSize, 0, 0)
+
+	@staticmethod
+	def wireName(name):
+		"""Encodes a domain name without compression
+
+		Args:
+			name (str): e.g. "www.switch.telematik."
+
+		Returns:
+			bytes: length prefixed labels
+		"""
+		wire = b""
+		for label in name.split("."):
+			if label:
+				label = label.encode('ascii')
+				wire += bytes((len(label),)) + label
+		return wire + b"\x00"
+
+	def encodeName(self, name, packet, offsets):
+		"""Appends a domain name to the packet, pointing to an earlier copy of any suffix we already wrote
+
+		Args:
+			name (str): e.g. "www.switch.telematik."
+			packet (bytearray): the packet so far
+			offsets (dict): suffix -> position in the packet, updated with the suffixes we write
+		"""
+		labels = [label for label in name.split(".") if label]
+		for i in range(len(labels)):
+			suffix = ".".join(labels[i:]).lower()
+			if suffix in offsets:
+				packet += struct.pack("!H", 0xC000 | offsets[suffix])
+				return
+			# Pointers have 14 bits, names further back can't be pointed to
+			if len(packet) < 0x3FFF:
+				offsets[suffix] = len(packet)
+			label = labels[i].encode('ascii')
+			packet.append(len(label))
+			packet += label
+		packet.append(0)
+
+	def decodeName(self, data, offset):
+		"""Reads a (possibly compressed) domain name
+
+		Args:
+			data (bytes): the packet
+			offset (int): where the name starts
+
+		Returns:
+			tuple: the name with trailing dot and the offset right behind it
+		"""
+		labels = []
+		end = None
+		jumps = 0
+		while 1:
+			length = data[offset]
+			if length & 0xC0 == 0xC0:
+				if end is None:
+					end = offset + 2
+				jumps += 1
+				# A packet pointing in circles is broken or malicious
+				if jumps > 64:
+					raise ValueError("Compression loop")
+				offset = ((length & 0x3F) << 8) | data[offset + 1]
+				continue
+			offset += 1
+			if length == 0:
+				break
+			labels.append(data[offset:offset + length].decode('ascii'))
+			offset += length
+		if end is None:
+			end = offset
+		return (".".join(labels) + ".", end)
+
+	def encodeRR(self, packet, offsets, name, rtype, ttl, rdata):
+		"""Appends a resource record, NS targets get compressed as well
+
+		Args:
+			packet (bytearray): the packet so far
+			offsets (dict): known name positions
+			name (str): owner name
+			rtype (int): TYPE_A or TYPE_NS
+			ttl (int): time to live
+			rdata (str): IPv4 address for A, name for NS
+		"""
+		self.encodeName(name, packet, offsets)
+		if rtype == TYPE_A:
+			packet += RR.pack(rtype, CLASS_IN, ttl, 4)
+			packet += socket.inet_aton(rdata)
+		else:
+			start = len(packet)
+			packet += RR.pack(rtype, CLASS_IN, ttl, 0)
+			self.encodeName(rdata, packet, offsets)
+			struct.pack_into("!H", packet, start + 8, len(packet) - start - RR.size)
+
+	def encode(self, message):
+		"""Builds an RFC 1035 message from our message dictionary
+
+		Answers go into the answer section as A record, referrals into the authority section as NS record
+		of the zone, with the A record of its server as glue in the additional section
+
+		Args:
+			message (dict): the message
+
+		Returns:
+			bytes: the datagram
+		"""
+		flags = 0
+		if message.get("dns.flags.response"):
+			flags |= 0x8000
+		if message.get("dns.flags.authoritative"):
+			flags |= 0x0400
+		if message.get("dns.flags.truncated"):
+			flags |= 0x0200
+		if message.get("dns.flags.recdesired"):
+			flags |= 0x0100
+		if message.get("dns.flags.recavail"):
+			flags |= 0x0080
+		flags |= message.get("dns.flags.rcode", 0) & 0x000F
+
+		answers = message.get("dns.count.answers", 0) if "dns.a" in message else 0
+		referrals = message.get("dns.count_auth_rr", 0) if "dns.a" in message else 0
+		# A zone with several name servers has glue for every one of them
+		glue = message.get("dns.auth.a", [message.get("dns.a")]) if referrals else []
+		edns = "dns.edns.udpsize" in message
+		packet = bytearray(HEADER.pack(message.get("dns.id", 0), flags, 1, answers, referrals, len(glue) + edns))
+		offsets = {}
+		self.encodeName(message["dns.qry.name"], packet, offsets)
+		packet += QUESTION.pack(message["dns.qry.type"], CLASS_IN)
+		if answers:
+			self.encodeRR(packet, offsets, message["dns.ns"], TYPE_A, message["dns.resp.ttl"], message["dns.a"])
+		elif referrals:
+			# Our name servers are named like their zones
+			self.encodeRR(packet, offsets, message["dns.ns"], TYPE_NS, message["dns.resp.ttl"], message["dns.ns"])
+			for address in glue:
+				self.encodeRR(packet, offsets, message["dns.ns"], TYPE_A, message["dns.resp.ttl"], address)
+		if edns:
+			packet += self.optRecord(message["dns.edns.udpsize"])
+		return bytes(packet)
+
+	def decodeRR(self, data, offset):
+		"""Reads a resource record
+
+		Returns:
+			tuple: owner, type, ttl, rdata (address or name) and the offset right behind the record
+		"""
+		name, offset = self.decodeName(data, offset)
+		rtype, rclass, ttl, length = RR.unpack_from(data, offset)
+		offset += RR.size
+		if rtype == TYPE_A:
+			rdata = socket.inet_ntoa(data[offset:offset + length])
+		elif rtype == TYPE_NS:
+			rdata = self.decodeName(data, offset)[0]
+		elif rtype == TYPE_OPT:
+			# The UDP size of the sender hides in the class field
+			rdata = rclass
+		else:
+			rdata = data[offset:offset + length]
+		return (name, rtype, ttl, rdata, offset + length)
+
+	def decodeEdns(self, message, records):
+		"""Takes the UDP size of the sender from its OPT record, if it sent one
+
+		Args:
+			message (dict): the message so far
+			records (list): the decoded additional records
+		"""
+		for owner, rtype, ttl, rdata, end in records:
+			if rtype == TYPE_OPT:
+				message["dns.edns.udpsize"] = rdata
+
+	def decode(self, data):
+		"""Reads an RFC 1035 message into the same dictionary the JSON codec would give us
+
+		Args:
+			data (bytes): the datagram
+
+		Returns:
+			dict: the message
+		"""
+		ident, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data, 0)
+		offset = HEADER.size
+		name, offset = self.decodeName(data, offset)
+		qtype, qclass = QUESTION.unpack_from(data, offset)
+		offset += QUESTION.size
+		message = {"dns.id": ident, "dns.flags.response": (flags >> 15) & 1}
+		if not message["dns.flags.response"]:
+			message.update({"dns.flags.recdesired": (flags >> 8) & 1, "dns.qry.name": name, "dns.qry.type": qtype})
+			# Queries only carry an OPT record in the additional section, if anything
+			records = []
+			for i in range(ancount + nscount + arcount):
+				record = self.decodeRR(data, offset)
+				records.append(record)
+				offset = record[4]
+			self.decodeEdns(message, records)
+			return message
+
+		message.update({
+			"dns.flags.recavail": (flags >> 7) & 1,
+			"dns.qry.name": name,
+			"dns.qry.type": qtype,
+			"dns.flags.rcode": flags & 0x000F,
+			"dns.flags.authoritative": (flags >> 10) & 1,
+			"dns.count.answers": ancount})
+		if flags & 0x0200:
+			message["dns.flags.truncated"] = 1
+		records = []
+		for i in range(ancount + nscount + arcount):
+			record = self.decodeRR(data, offset)
+			records.append(record)
+			offset = record[4]
+		self.decodeEdns(message, records[ancount + nscount:])
+		if ancount:
+			owner, rtype, ttl, rdata, end = records[0]
+			message.update({"dns.ns": owner, "dns.a": rdata, "dns.resp.ttl": ttl})
+		elif nscount:
+			owner, rtype, ttl, target, end = records[ancount]
+			glue = [record[3] for record in records[ancount + nscount:] if record[0] == target and record[1] == TYPE_A]
+			message.update({"dns.count_auth_rr": nscount, "dns.ns": owner, "dns.resp.ttl": ttl})
+			if glue:
+				message["dns.a"] = glue[0]
+			if len(glue) > 1:
+				message["dns.auth.a"] = glue
+		return message
+
+	def compile(self, body):
+		"""Precompiles a response that only depends on the zone, not on the query
+
+		Args:
+			body (dict): the response without dns.qry.name, dns.qry.type and dns.id
+
+		Returns:
+			BINARY_TEMPLATE: the template
+		"""
+		return BINARY_TEMPLATE(self, body)
+
+	def text(self, data, message):
+		return "(%d bytes binary) " % len(data) + json.dumps(message, indent=4)
+
+class BINARY_TEMPLATE():
+	def __init__(self, codec, body):
+		"""Precompiled RFC 1035 response, the question of a query is written in front of the finished sections
+
+		Every record owner is the queried name or one of its suffixes, so the owners are pointers into the question
+
+		Args:
+			codec (BINARY_CODEC): the codec that knows the wire format
+			body (dict): the response without dns.qry.name, dns.qry.type and dns.id
+		"""
+		# Same message minus question, encoded once so we know flags and counts
+		probe = codec.encode(dict(body, **{"dns.qry.name": body.get("dns.ns", "."), "dns.qry.type": TYPE_A}))
+		self.flagsAndCounts = probe[2:HEADER.size]
+		# Queries with an OPT record get ours back at the end, one more additional record
+		self.flagsAndCountsEdns = self.flagsAndCounts[:-2] + struct.pack("!H", struct.unpack("!H", self.flagsAndCounts[-2:])[0] + 1)
+		self.opt = codec.optRecord(EDNS_UDP_SIZE)
+		self.ownerWire = codec.wireName(body["dns.ns"]) if "dns.ns" in body else None
+		# Every record starts with a pointer to its owner, None inside a record stands for that pointer as well
+		self.sections = []
+		if body.get("dns.count.answers") and "dns.a" in body:
+			self.sections = [[RR.pack(TYPE_A, CLASS_IN, body["dns.resp.ttl"], 4) + socket.inet_aton(body["dns.a"])]]
+		elif body.get("dns.count_auth_rr") and "dns.a" in body:
+			# NS record whose target is its owner (a pointer is 2 bytes), then the glue A records
+			self.sections = [[RR.pack(TYPE_NS, CLASS_IN, body["dns.resp.ttl"], 2), None]]
+			for address in body.get("dns.auth.a", [body["dns.a"]]):
+				self.sections.append([RR.pack(TYPE_A, CLASS_IN, body["dns.resp.ttl"], 4) + socket.inet_aton(address)])
+
+	def render(self, query):
+		"""Builds the response for a query
+
+		Args:
+			query (dict): the decoded query
+
+		Returns:
+			bytes: the datagram
+		"""
+		qname = BINARY_CODEC.wireName(query["dns.qry.name"])
+		edns = "dns.edns.udpsize" in query
+		packet = [struct.pack("!H", query.get("dns.id", 0)), self.flagsAndCountsEdns if edns else self.flagsAndCounts, qname, QUESTION.pack(query["dns.qry.type"], CLASS_IN)]
+		if self.sections:
+			# Owner of every record is the queried name or a suffix of it, which ends the question
+			pointer = struct.pack("!H", 0xC000 | (HEADER.size + len(qname) - len(self.ownerWire)))
+			for record in self.sections:
+				packet.append(pointer)
+				packet += [pointer if part is None else part for part in record]
+		if edns:
+			packet.append(self.opt)
+		return b"".join(packet)
+
+CODECS = {"json": JSON_CODEC(), "binary": BINARY_CODEC()}
+
+def isMessage(message):
+	"""Checks that a decoded datagram is a message we can work with, every query and response carries its question
+
+	Args:
+		message: whatever the codec decoded
+
+	Returns:
+		bool: a dict with a name and a type in its question, and a 16 bit UDP size if it announces one
+	"""
+	if not (isinstance(message, dict) and isinstance(message.get("dns.qry.name"), str) and isinstance(message.get("dns.qry.type"), int)):
+		return False
+	udpSize = message.get("dns.edns.udpsize", CLASSIC_UDP_SIZE)
+	return isinstance(udpSize, int) and 0 <= udpSize <= 0xFFFF
+
+def negotiate(data, accepted="auto"):
+	"""Finds the codec of a datagram, a listener answers in the codec it was asked in
+
+	Args:
+		data (bytes): the datagram
+		accepted (str): "json", "binary" or "auto" for both
+
+	Returns:
+		tuple: the codec and the decoded message
+
+	Raises:
+		ValueError: the datagram isn't a message in an accepted codec
+	"""
+	if accepted != "auto":
+		codec = CODECS[accepted]
+		try:
+			message = codec.decode(data)
+		except (struct.error, IndexError, UnicodeDecodeError, OSError) as error:
+			raise ValueError("No %s message: %s" % (accepted, error))
+		if not isMessage(message):
+			raise ValueError("No %s message: question or UDP size missing or broken" % accepted)
+		return (codec, message)
+	# A binary message starting with "{" is possible, so JSON only wins if it really is JSON
+	if data[:1] == b"{":
+		try:
+			message = CODECS["json"].decode(data)
+		except ValueError:
+			pass
+		else:
+			if not isMessage(message):
+				raise ValueError("No JSON message: question or UDP size missing or broken")
+			return (CODECS["json"], message)
+	try:
+		message = CODECS["binary"].decode(data)
+	except (struct.error, IndexError, UnicodeDecodeError, OSError) as error:
+		raise ValueError("Neither JSON nor RFC 1035 message: %s" % error)
+	if not isMessage(message):
+		raise ValueError("No RFC 1035 message: question or UDP size missing or broken")
+	return (CODECS["binary"], message)
@@ -0,0 +1,135 @@
+import json, threading, atexit, multiprocessing
+from persist import atomicWrite
+
+MESSAGES = ("sent", "recv")
+
+def counterName(name):
+	"""Servers are named like their zone ("fuberlin."), messages.json drops the trailing dot
+
+	Args:
+		name (str): server name
+
+	Returns:
+		str: key in messages.json
+	"""
+	if name[-1] == ".":
+		return name[0:-1]
+	return name
+
+class COUNTER():
+	def __init__(self, values, offset):
+		"""Handle on the sent/recv counters of one server, cheap enough to be handed to a Process
+
+		Args:
+			values (multiprocessing.Array): counters of all servers
+			offset (int): where the counters of this server start
+		"""
+		self.values = values
+		self.offset = offset
+
+	def get(self, message):
+		return self.values[self.offset + MESSAGES.index(message)]
+
+	def increment(self, message):
+		"""Counts a message
+
+		Args:
+			message (str): "sent" or "recv"
+
+		Returns:
+			int: the new count
+		"""
+		index = self.offset + MESSAGES.index(message)
+		with self.values.get_lock():
+			self.values[index] += 1
+			return self.values[index]
+
+class COUNTERS():
+	def __init__(self, path="messages.json", names=None, owned=None, interval=5):
+		"""Sent/recv counters of every server in shared memory, written to messages.json by a single thread
+
+		run.py creates one instance and hands every server its COUNTER, so no server touches messages.json
+		while answering queries and increments from different processes can't overwrite each other
+
+		Args:
+			path (str): the counter file, default = messages.json
+			names (list): servers that need counters even if messages.json doesn't know them yet
+			owned (list): servers whose counts we write back, None = all of them
+			interval (float): Seconds between two writes of the file, default = 5
+		"""
+		self.path = path
+		self.interval = interval
+		totals = self.read()
+		for name in names or []:
+			totals.setdefault(counterName(name), {message: 0 for message in MESSAGES})
+		self.names = list(totals)
+		self.owned = self.names if owned is None else [counterName(name) for name in owned]
+		self.values = multiprocessing.Array('q', [totals[name].get(message, 0) for name in self.names for message in MESSAGES])
+		self.stopped = threading.Event()
+		self.thread = None
+
+	@classmethod
+	def standalone(cls, name):
+		"""Counters for a server that was started without run.py, it only writes back its own counts
+
+		Args:
+			name (str): server name
+
+		Returns:
+			COUNTER: the counter of that server
+		"""
+		counters = cls(names=[name], owned=[name])
+		counters.start()
+		atexit.register(counters.stop)
+		return counters.counter(name)
+
+	def read(self):
+		"""Reads the counter file
+
+		Returns:
+			dict: name -> {"sent": n, "recv": n}
+		"""
+		try:
+			with open(self.path) as jsonfile:
+				return json.load(jsonfile)
+		except IOError:
+			return {}
+
+	def counter(self, name):
+		return COUNTER(self.values, self.names.index(counterName(name)) * len(MESSAGES))
+
+	def totals(self):
+		"""Current counts of every server
+
+		Returns:
+			dict: name -> {"sent": n, "recv": n}
+		"""
+		values = self.values[:]
+		return {name: {message: values[i * len(MESSAGES) + j] for j, message in enumerate(MESSAGES)} for i, name in enumerate(self.names)}
+
+	def flush(self):
+		"""Writes our counts into the counter file, entries of servers we don't own are kept as they are
+		"""
+		data = self.read()
+		totals = self.totals()
+		for name in self.owned:
+			data[name] = totals[name]
+		atomicWrite(self.path, json.dumps(data, indent=4))
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.flush()
+
+	def start(self):
+		"""Starts writing the counter file in the background
+		"""
+		self.thread = threading.Thread(target=self.run, name="counters", daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		"""Stops the background thread and writes the final counts
+		"""
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		self.flush()
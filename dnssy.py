@@ -1,7 +1,50 @@
-import socket, glob, json, datetime, time, os
+import socket, glob, json, datetime, time, os, asyncio, threading, signal, selectors
+from suffixindex import SUFFIX_INDEX
+from counters import COUNTERS, counterName
+from logpipe import LOG_WRITER, wanted
+from codec import negotiate, udpLimit, EDNS_UDP_SIZE
+from zone import ZONE
+from zonedb import ZONE_DB
+from snapshot import ZONE_SNAPSHOT
+from latency import LATENCY
+from metrics import METRICS
+from stream import STREAM_PROTOCOL, FRAME_READER, frame, listenTcp
+from ratelimit import RATE_LIMITER, LIMIT_LABELS, SEND, SLIP, DROP, responseKind
+
+# Metric labels are built once, not per query
+STAGES = {stage: (("stage", stage),) for stage in ("decode", "lookup", "recursion", "forward", "encode", "log")}
+CODEC_LABELS = {name: (("codec", name),) for name in ("json", "binary")}
+RCODE_LABELS = {}
+
+def rcodeLabels(rcode):
+	labels = RCODE_LABELS.get(rcode)
+	if labels is None:
+		labels = RCODE_LABELS[rcode] = (("rcode", str(rcode)),)
+	return labels
+
+class DNS_PROTOCOL(asyncio.DatagramProtocol):
+	def __init__(self, server, attribute="transport"):
+		"""asyncio endpoint that hands every datagram to its DNS Server or Resolver
+
+		Args:
+			server (DNS_SERVER or RESOLVER): The server answering the datagrams, needs a handleDatagram method
+			attribute (str): The server finds the transport of the endpoint under this name, default = "transport"
+		"""
+		self.server = server
+		self.attribute = attribute
+
+	def connection_made(self, transport):
+		setattr(self.server, self.attribute, transport)
+
+	def datagram_received(self, data, addr):
+		self.server.handleDatagram(data, addr)
+
+	def error_received(self, exc):
+		# ICMP errors from clients that went away, nothing we can do about them
+		pass
 
 class DNS_SERVER():
-	def __init__(self, ip, server_name, authoritative, port=53053):
+	def __init__(self, ip, server_name, authoritative, port=53053, mode="sync", sleepSec=0, counter=None, logLevel="dump", dumpSample=1.0, codec="auto", reusePort=False, worker=0, serve=True, watchSec=2, latency=None, metricsPort=None, udpSize=EDNS_UDP_SIZE, tcp=True, rateLimit=None, ready=None):
 		"""Create a DNS Server
 
 		Args:
@@ -9,134 +52,474 @@ class DNS_SERVER():
 			port (int): The Server port, default = 53053
 			server_name (str): Name of server, should be the same as its root file
 			authoritative (boolean): Can give authoritative answers or not
+			mode (str): "sync" answers one query after another, "async" answers every query independently on an event loop
+			sleepSec (float): Fixed artificial delay before every answer, short for latency={"fixedSec": sleepSec}, default = 0
+			counter (COUNTER): Shared message counter handed out by run.py, default = None (the server keeps its own)
+			logLevel (str): "dump" writes logfiles and dumps, "log" only logfiles, "off" nothing, default = "dump"
+			dumpSample (float): Share of messages that are dumped, e.g. 0.01 under load, default = 1.0
+			codec (str): Message format we accept, "json", "binary" (RFC 1035) or "auto" for both, default = "auto"
+			reusePort (boolean): Share IP and port with other worker processes of the same zone (SO_REUSEPORT), default = False
+			worker (int): Number of this worker process, workers after the first get their own log and dump files, default = 0
+			serve (boolean): Start serving right away, a SERVER_HOST sets this to False and calls attach() itself, default = True
+			watchSec (float): Seconds between two checks if the zone file changed, None or 0 = only reload on SIGHUP, default = 2
+			latency (dict): Emulated delay and loss of our answers, in total and per receiving IP, see LATENCY.fromSpec(), default = None (wire speed)
+			metricsPort (int): Serve our metrics at http://IP:metricsPort/metrics, workers add their number to the port, default = None (not served)
+			udpSize (int): Biggest UDP response we send to clients that announce they can take it (EDNS), bigger ones are sent truncated, default = 1232
+			tcp (boolean): Also answer over TCP on the same IP and port, default = True
+			rateLimit (dict): UDP responses per second per client and response kind, see RATE_LIMITER.fromSpec(), default = None (no limit)
+			ready (multiprocessing.Queue): gets (name, seconds our start took) once we are ready to serve, default = None
 		"""
+		started = time.perf_counter()
 		self.PORT = port
 		self.IP = ip
 		self.NAME = server_name
 		self.authoritative = authoritative
+		self.mode = mode
+		self.codec = codec
+		self.reusePort = reusePort
+		self.logName = counterName(server_name) if not worker else "%s-worker%d" % (counterName(server_name), worker)
+		self.logLevel = logLevel
+		self.dumpSample = dumpSample
+		self.logWriter = LOG_WRITER.get()
+		self.counter = counter if counter is not None else COUNTERS.standalone(server_name)
 		self.sent = self.getMessages("sent")
 		self.recv = self.getMessages("recv")
-		self.sleepSec = 5
+		self.latency = LATENCY.fromSpec(latency if latency is not None else sleepSec)
+		self.udpSize = udpSize
+		self.tcp = tcp
+		self.limiter = RATE_LIMITER.fromSpec(rateLimit)
 		self.bindSock()
-		self.zoneData = self.loadZones()
-		self.run()
+		self.startMetrics(metricsPort, worker)
+		self.zone = self.buildZone()
+		self.reloadLock = threading.Lock()
+		self.watchSec = watchSec
+		if self.watchSec:
+			threading.Thread(target=self.watchZone, name="watch " + server_name, daemon=True).start()
+		self.startupSec = time.perf_counter() - started
+		self.note("STARTED IN %.1f ms, %d names from %s" % (self.startupSec * 1e3, len(self.zone.records), self.zonePath()))
+		if not serve:
+			return
+		if ready is not None:
+			ready.put((self.logName, self.startupSec))
+		if self.mode == "async":
+			self.runAsync()
+		else:
+			self.run()
+
+	def startMetrics(self, port, worker):
+		"""Sets up our counters and stage timings, and the HTTP endpoint that serves them
+
+		Args:
+			port (int): port of the endpoint, None = don't serve them
+			worker (int): number of this worker process
+		"""
+		self.metrics = METRICS(zone=self.NAME, worker=worker)
+		self.metrics.describe("dns_requests_total", "counter", "Queries received, by codec")
+		self.metrics.describe("dns_malformed_requests_total", "counter", "Datagrams that were no query we understand")
+		self.metrics.describe("dns_responses_total", "counter", "Responses sent, by rcode")
+		self.metrics.describe("dns_stage_seconds", "histogram", "Time spent per query in decode, lookup, encode and log (logging and dumping, observed once when the query arrives and once when the answer leaves)")
+		self.metrics.describe("dns_emulated_losses_total", "counter", "Answers dropped by the latency emulation")
+		self.metrics.describe("dns_truncated_total", "counter", "UDP responses too big for the client, sent truncated")
+		self.metrics.describe("dns_rate_limited_total", "counter", "UDP responses over the rate limit of their client, dropped or sent truncated (slip), by response kind")
+		self.metrics.collect("dns_", lambda: {"emulatedLosses": self.latency.dropped})
+		if port is None:
+			return
+		try:
+			self.metrics.serve(self.IP, port + worker)
+			self.note("SERVING METRICS ON http://%s:%d/metrics" % (self.IP, port + worker))
+		except OSError as error:
+			self.note("NOT SERVING METRICS ON %s:%d: %s" % (self.IP, port + worker, error))
+
+	@property
+	def zoneData(self):
+		return self.zone.records
 
 	def getMessages(self, message):
-		name = self.NAME
-		if self.NAME[-1] == ".":
-			name = self.NAME[0:-1]
-		with open("messages.json", "r") as jsonfile:
-			data = json.load(jsonfile)
-			return data[name][message]
+		"""Current count of sent or received messages, kept in memory and saved to messages.json in the background
+
+		Args:
+			message (str): "sent" or "recv"
+
+		Returns:
+			int: the count
+		"""
+		return self.counter.get(message)
 
 	def updateMessages(self, message):
-		name = self.NAME
-		if self.NAME[-1] == ".":
-			name = self.NAME[0:-1]
-		with open("messages.json", "r+") as jsonfile:
-			data = json.load(jsonfile)
-			data[name][message] += 1
-			jsonfile.seek(0)
-			json.dump(data, jsonfile, indent=4)
-			jsonfile.truncate()
+		"""Counts a sent or received message
 
+		Args:
+			message (str): "sent" or "recv"
+
+		Returns:
+			int: the new count
+		"""
+		return self.counter.increment(message)
 
 	def bindSock(self):
 		"""Bind socket to IP and Port
 		"""
 		#SOCK_DGRAM for UDP, SOCK_STREAM for TCP
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		if self.reusePort:
+			# Every worker binds the same address, the kernel spreads the queries over them
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		self.sock.bind((self.IP, self.PORT))
 		self.log((self.IP, self.PORT), 0, "BINDING SOCKET")
+		self.tcpSock = None
+		if self.tcp:
+			# Responses too big for UDP are fetched over TCP, on the same IP and port
+			self.tcpSock = listenTcp(self.IP, self.PORT, self.reusePort)
+			# No message, so it isn't counted as a sent one
+			self.note("BINDING TCP SOCKET")
 
 	def loadZones(self):
 		"""Load zone file corresponding to Server name
 
 		Returns:
-			dict: zone file as dictionary/JSON
+			SUFFIX_INDEX: zone file as dictionary/JSON, indexed by labels for suffix matching
 		"""
 		zones = {}
-		name = self.NAME
-		if self.NAME[-1] == ".":
-			name = self.NAME[0:-1]
-		with open('./zones/%s.zone' % name) as zonefile:
-			zones = json.load(zonefile)
+		with open('./zones/%s.zone' % counterName(self.NAME)) as zonefile:
+			zones = SUFFIX_INDEX(json.load(zonefile))
 		return zones
 
+	def zonePath(self):
+		"""Zone file we serve, a zone converted with zonedb.py wins over the JSON file, then a snapshot of the JSON file unless it was changed since
+
+		Returns:
+			str: ./zones/NAME.zonedb, ./zones/NAME.zone.snap or ./zones/NAME.zone
+		"""
+		path = './zones/%s.zone' % counterName(self.NAME)
+		if os.path.exists(path + "db"):
+			return path + "db"
+		try:
+			if os.stat(path + ".snap").st_mtime_ns >= os.stat(path).st_mtime_ns:
+				return path + ".snap"
+		except OSError:
+			pass
+		return path
+
+	def buildZone(self):
+		"""Opens the SQLite zone or the snapshot, or loads the JSON zone file and precompiles all responses
+
+		Returns:
+			ZONE: the zone, ready to be swapped in
+		"""
+		path = self.zonePath()
+		if path.endswith(".zonedb"):
+			return ZONE_DB(path, self.authoritative)
+		if path.endswith(".snap"):
+			try:
+				return ZONE_SNAPSHOT(path, self.authoritative)
+			except (OSError, ValueError) as error:
+				self.note("NOT USING ZONE SNAPSHOT: " + str(error))
+		return ZONE(self.loadZones(), self.authoritative)
+
+	def reloadZone(self):
+		"""Builds the zone again and swaps it in with a single assignment, queries use the old zone until then
+
+		Runs outside the serving path (watcher thread or signal thread), a broken zone file keeps the old zone
+
+		Returns:
+			boolean: the new zone is in place
+		"""
+		with self.reloadLock:
+			start = time.perf_counter()
+			try:
+				zone = self.buildZone()
+			except Exception as error:
+				# Whatever is wrong with the file, the old zone keeps serving and the next edit is tried again
+				self.note("ZONE RELOAD FAILED, KEEPING OLD ZONE: %r" % error)
+				return False
+			built = time.perf_counter()
+			old, self.zone = self.zone, zone
+			swapped = time.perf_counter()
+			# A zone database would keep its connection open forever
+			old.close()
+			self.note("ZONE RELOADED (%d names) built in %.2f ms, swapped in %.2f us" % (len(zone.records), (built - start) * 1e3, (swapped - built) * 1e6))
+			return True
+
+	def requestReload(self, *args):
+		"""Reloads the zone in a thread of its own, used as SIGHUP handler
+		"""
+		threading.Thread(target=self.reloadZone, name="reload " + self.NAME, daemon=True).start()
+
+	def watchZone(self):
+		"""Reloads the zone whenever the modification time of its file changes
+		"""
+		try:
+			mtime = os.stat(self.zonePath()).st_mtime_ns
+		except OSError:
+			mtime = None
+		while 1:
+			time.sleep(self.watchSec)
+			try:
+				current = os.stat(self.zonePath()).st_mtime_ns
+			except OSError:
+				# File is being replaced right now, check again next time
+				continue
+			if current != mtime:
+				mtime = current
+				self.reloadZone()
+
 	def run(self):
 		"""Keep server
 		"""
 		self.log((self.IP, self.PORT), 0, "WAITING FOR MSGS")
+		if hasattr(signal, "SIGHUP"):
+			signal.signal(signal.SIGHUP, self.requestReload)
+		selector = selectors.DefaultSelector()
+		selector.register(self.sock, selectors.EVENT_READ)
+		if self.tcpSock is not None:
+			selector.register(self.tcpSock, selectors.EVENT_READ)
+		# TCP connection -> (client address, FRAME_READER)
+		connections = {}
 		while 1:
-			# Receive 512 bytes Max as per IETF standard, also receive address
-			data, addr = self.sock.recvfrom(512)
-			self.log(addr, json.loads(data.decode('utf-8')), "recv")
-			self.dump(addr, data.decode('utf-8'), "recv")
-			response = self.buildResponse(json.loads(data.decode('utf-8')))
-			#Send response to sender after n seconds
-			time.sleep(self.sleepSec)
-				
-			#Check for error for logging purposes
-			if(json.loads(response)["dns.flags.rcode"] != 0):
-				self.log(addr, json.loads(response), "error")
-			else:
-				self.log(addr, json.loads(response), "send")
-				
-			#Send answer
-			self.dump(addr, response, "send")
-			self.sock.sendto(response.encode('utf-8'), addr)
-		
+			for key, events in selector.select():
+				if key.fileobj is self.sock:
+					# EDNS clients may send more than the classic 512 bytes
+					data, addr = self.sock.recvfrom(65535)
+					try:
+						self.answerSync(data, addr)
+					except Exception as error:
+						# One broken datagram must not stop the server for everybody
+						self.note("DROPPED MESSAGE FROM %s:%d: %r" % (addr[0], addr[1], error))
+				elif key.fileobj is self.tcpSock:
+					connection, addr = self.tcpSock.accept()
+					connections[connection] = (addr, FRAME_READER())
+					selector.register(connection, selectors.EVENT_READ)
+				else:
+					connection = key.fileobj
+					addr, reader = connections[connection]
+					try:
+						data = connection.recv(65535)
+					except OSError:
+						data = b""
+					try:
+						if data:
+							for message in reader.feed(data):
+								self.answerSync(message, addr, lambda response: connection.sendall(frame(response)), strict=True)
+							continue
+					except Exception as error:
+						# Whatever follows a broken frame can't be trusted, only this connection goes
+						self.note("CLOSED TCP CONNECTION OF %s:%d: %r" % (addr[0], addr[1], error))
+					selector.unregister(connection)
+					del connections[connection]
+					connection.close()
 
-	def buildResponse(self, query):
-		"""Generates custom response for client
+	def answerSync(self, data, addr, send=None, strict=False):
+		"""Answers a message right away, one query after another
 
 		Args:
-			query (string): the domain the stub asks for
+			data (bytes): The received message
+			addr (tuple): Information about the sender
+			send (callable): sends the answer over TCP, None = over UDP
+			strict (bool): Raise ValueError for a message we don't understand instead of ignoring it, default = False
 
-		Returns:
-			str: Response as JSON Formatted string
-		"""
-		# Static things that every response has
-		response = {
-			"dns.flags.response": 1, 
-			"dns.flags.recavail": 0,
-			"dns.qry.name": query["dns.qry.name"],
-			"dns.qry.type": query["dns.qry.type"],
-			"dns.flags.rcode": 0}
-
-		if(self.authoritative):
-			response.update({"dns.flags.authoritative": 1})
+		Raises:
+			ValueError: strict and the message is no query in a codec we accept
+		"""
+		try:
+			query, codec, compiled = self.process(data, addr)
+		except ValueError:
+			# Not a message we understand, nobody to answer
+			if strict:
+				raise
+			return
+		#Send response to sender after the emulated delay
+		delay = self.latency.delay(addr)
+		if delay is None:
+			if send is None:
+				return
+			# TCP retransmits what the network loses
+			delay = 0
+		if delay > 0:
+			time.sleep(delay)
+		try:
+			self.reply(query, compiled, addr, codec, send)
+		except OSError:
+			# The TCP client went away
+			pass
+
+	def runAsync(self):
+		"""Keep server alive on an event loop, so every query is answered independently of the others
+		"""
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_until_complete(self.attach(self.loop))
+		try:
+			self.loop.add_signal_handler(signal.SIGHUP, self.requestReload)
+		except (NotImplementedError, AttributeError):
+			pass
+		try:
+			self.loop.run_forever()
+		finally:
+			self.close()
+			self.loop.close()
+
+	async def attach(self, loop):
+		"""Serves this server on an event loop, which may serve other servers as well, run it on the loop
+
+		Args:
+			loop (asyncio.AbstractEventLoop): the loop
+		"""
+		self.loop = loop
+		self.log((self.IP, self.PORT), 0, "WAITING FOR MSGS")
+		# Hand our already bound sockets to the loop, it switches them to non-blocking
+		await loop.create_datagram_endpoint(lambda: DNS_PROTOCOL(self), sock=self.sock)
+		self.tcpServer = None
+		if self.tcpSock is not None:
+			self.tcpServer = await loop.create_server(lambda: STREAM_PROTOCOL(self), sock=self.tcpSock)
+
+	def close(self):
+		"""Stops listening
+		"""
+		self.transport.close()
+		if self.tcpServer is not None:
+			self.tcpServer.close()
+
+	def handleStream(self, data, addr, send):
+		"""Answers a message that came in over TCP, on the event loop
+
+		Args:
+			data (bytes): The received message, without its length
+			addr (tuple): Information about the sender
+			send (callable): sends the answer back over the connection
+		"""
+		try:
+			query, codec, compiled = self.process(data, addr)
+		except ValueError:
+			return
+		# TCP retransmits what the network loses, that only costs time
+		delay = self.latency.delay(addr) or 0
+		if delay > 0:
+			self.loop.call_later(delay, self.reply, query, compiled, addr, codec, send)
 		else:
-			response.update({"dns.flags.authoritative": 0})
+			self.reply(query, compiled, addr, codec, send)
+
+	def handleDatagram(self, data, addr):
+		"""Answers a single datagram on the event loop, the delay only postpones this one answer
 
-		#Count Answers, or rather check if answer or nahw
+		Args:
+			data (bytes): The received datagram
+			addr (tuple): Information about the sender
+		"""
 		try:
-			#This triggers if the server is the parent of the target request
-			dns_name = query["dns.qry.name"]
-			self.zoneData[dns_name]
-			response.update({"dns.count.answers": 1, "dns.ns": dns_name, "dns.a": self.zoneData[dns_name]["A"], "dns.resp.ttl": self.zoneData[dns_name]["TTL"]})
-
-		except KeyError:
-			# We didn't find any answer, so we look for a redirect we can give
-			response.update({"dns.count.answers": 0})
-
-			#Suffix matching
-			suffix = self.biggestSuffix(query["dns.qry.name"])
-
-			# Make sure we really don't have any answers, but we have a suffix, return said suffix
-			if not response["dns.count.answers"] and suffix:
-				response.update({"dns.count_auth_rr": 1, "dns.ns": suffix, "dns.a": self.zoneData[suffix]["A"], "dns.resp.ttl": self.zoneData[suffix]["TTL"]})
-			else:
-				# Check if we are authoritative
-				if self.authoritative:
-					#Name error
-					response["dns.flags.rcode"] = 3
-				else:
-					#Cant process query
-					response["dns.flags.rcode"] = 2
+			query, codec, compiled = self.process(data, addr)
+		except ValueError:
+			# Not a message we understand, nobody to answer
+			return
+		delay = self.latency.delay(addr)
+		if delay is None:
+			# Emulated loss, the client has to ask again
+			return
+		if delay > 0:
+			self.loop.call_later(delay, self.reply, query, compiled, addr, codec)
+		else:
+			self.reply(query, compiled, addr, codec)
 
-		return json.dumps(response, indent=4)
+	def process(self, data, addr):
+		"""Decodes and logs a query and looks up the precompiled response for it
 
+		Args:
+			data (bytes): The received datagram
+			addr (tuple): Information about the sender
+
+		Returns:
+			tuple: the query, the codec we answer in and the compiled response (body and templates)
+
+		Raises:
+			ValueError: the datagram is no message in a codec we accept
+		"""
+		start = time.perf_counter()
+		try:
+			codec, query = negotiate(data, self.codec)
+		except ValueError:
+			self.metrics.count("dns_malformed_requests_total")
+			raise
+		decoded = time.perf_counter()
+		self.log(addr, query, "recv")
+		if self.dumping():
+			self.dump(addr, codec.text(data, query), "recv")
+		logged = time.perf_counter()
+		compiled = self.zone.lookup(query["dns.qry.name"])
+		self.metrics.observe("dns_stage_seconds", decoded - start, STAGES["decode"])
+		self.metrics.observe("dns_stage_seconds", logged - decoded, STAGES["log"])
+		self.metrics.observe("dns_stage_seconds", time.perf_counter() - logged, STAGES["lookup"])
+		self.metrics.count("dns_requests_total", CODEC_LABELS[codec.name])
+		return (query, codec, compiled)
+
+	def reply(self, query, compiled, addr, codec, send=None):
+		"""Logs, renders and sends a response
+
+		Args:
+			query (dict): the query we answer
+			compiled (tuple): response body and codec name -> template, from ZONE.lookup
+			addr (tuple): Information about the receiver
+			codec (JSON_CODEC or BINARY_CODEC): the codec the query came in
+			send (callable): sends the response over TCP, default = None (UDP)
+		"""
+		body, templates = compiled
+		action = SEND
+		if send is None and self.limiter.active:
+			kind = responseKind(body)
+			action = self.limiter.check(addr[0], kind)
+			if action != SEND:
+				self.metrics.count("dns_rate_limited_total", LIMIT_LABELS[(action, kind)])
+				if action == DROP:
+					return
+		start = time.perf_counter()
+		#Check for error for logging purposes
+		if action == SLIP:
+			# Only the empty truncated response goes out, log that instead of the answer
+			self.log(addr, body, "slip")
+		elif(body["dns.flags.rcode"] != 0):
+			self.log(addr, body, "error")
+		else:
+			self.log(addr, body, "send")
+		logged = time.perf_counter()
+
+		#Send answer, the template only patches in the question
+		if action == SLIP:
+			# Over the limit, a real client asks again over TCP
+			data = self.zone.truncated[1][codec.name].render(query)
+		else:
+			data = templates[codec.name].render(query)
+			if send is None and len(data) > udpLimit(query, self.udpSize):
+				# Doesn't fit into what the client can take over UDP, tell it to ask over TCP
+				data = self.zone.truncated[1][codec.name].render(query)
+				self.metrics.count("dns_truncated_total")
+		encoded = time.perf_counter()
+		if self.dumping():
+			self.dump(addr, codec.text(data, self.buildResponse(query)), "send")
+		self.metrics.observe("dns_stage_seconds", encoded - logged, STAGES["encode"])
+		self.metrics.observe("dns_stage_seconds", (logged - start) + (time.perf_counter() - encoded), STAGES["log"])
+		self.metrics.count("dns_responses_total", rcodeLabels(body["dns.flags.rcode"]))
+		if send is not None:
+			send(data)
+		elif self.mode == "async":
+			self.transport.sendto(data, addr)
+		else:
+			self.sock.sendto(data, addr)
+
+
+	def buildResponse(self, query):
+		"""Generates custom response for client, the full message that the precompiled templates render
+
+		Args:
+			query (dict): the query the stub sent
+
+		Returns:
+			dict: Response, the codec turns it into a datagram
+		"""
+		body, templates = self.zone.lookup(query["dns.qry.name"])
+		response = {"dns.qry.name": query["dns.qry.name"], "dns.qry.type": query["dns.qry.type"]}
+		# Echo the transaction ID, so clients with many queries in flight can match our answer
+		if "dns.id" in query:
+			response["dns.id"] = query["dns.id"]
+		response.update(body)
+		return response
 
 	def log(self, addr, data, logtype):
 		"""Write to logfile
@@ -150,38 +533,46 @@ class DNS_SERVER():
 		typeString = ""
 		#else if else if else if else if
 		if(logtype == "recv"):
-			self.recv += 1
-			self.updateMessages("recv")
+			self.recv = self.updateMessages("recv")
 			typeString = "Request received for name " + data["dns.qry.name"] + " from " + str(addr) + " [RECEIVED MESSAGE #" + str(self.recv) + "]"
 		elif(logtype == "send"):
-			self.sent += 1
-			self.updateMessages("sent")
+			self.sent = self.updateMessages("sent")
 			typeString = "Sending answer " + data["dns.a"] + " for " + data["dns.ns"] + " to " + str(addr) + " [SENT MESSAGE #" + str(self.sent) + "]"
 		elif(logtype == "error"):
-			self.sent += 1
-			self.updateMessages("sent")
+			self.sent = self.updateMessages("sent")
 			typeString = "Sending error " + str(data["dns.flags.rcode"]) + " to " + str(addr) + " [SENT MESSAGE #" + str(self.sent) + "]"
+		elif(logtype == "slip"):
+			self.sent = self.updateMessages("sent")
+			typeString = "Sending truncated reply (rate limited) to " + str(addr) + " [SENT MESSAGE #" + str(self.sent) + "]"
 		else:
-			self.sent += 1
-			self.updateMessages("sent")
+			self.sent = self.updateMessages("sent")
 			typeString = logtype + " [SENT MESSAGE #" + str(self.sent) + "]"
 
+		# Counting always happens, writing only if our level wants it
+		if not wanted(self.logLevel, "log"):
+			return
+
 		logString = str(datetime.datetime.now()) + " | " + self.NAME + " | " + typeString + "\n"
-		
-		# Make sure we have a logfiles folder
-		if not os.path.exists('logfiles'):
-			os.makedirs('logfiles')
-
-		#Make sure we have a NAME.log file and write to it
-		name = self.NAME
-		if self.NAME[-1] == ".":
-			name = self.NAME[0:-1]
-		try:
-			with open('logfiles/%s.log' % name, "a") as logfile:
-				logfile.write(logString)
-		except IOError:
-			with open('logfiles/%s' % name, "w+") as logfile:
-				logfile.write(logString)
+
+		# The writer thread creates logfiles/NAME.log and appends to it
+		self.logWriter.write('logfiles/%s.log' % self.logName, logString)
+
+	def note(self, text):
+		"""Write a line to the logfile that is no message and isn't counted as one
+
+		Args:
+			text (str): what happened
+		"""
+		if wanted(self.logLevel, "log"):
+			self.logWriter.write('logfiles/%s.log' % self.logName, str(datetime.datetime.now()) + " | " + self.NAME + " | " + text + "\n")
+
+	def dumping(self):
+		"""Decides if the next message gets dumped, ask before building the dump text
+
+		Returns:
+			bool: dump it or not
+		"""
+		return wanted(self.logLevel, "dump", self.dumpSample)
 
 	def dump(self, addr, data, dumptype):
 		"""Basically the log function with extra steps
@@ -202,22 +593,9 @@ class DNS_SERVER():
 			typeString = dumptype
 
 		dumpString = str(datetime.datetime.now()) + " | " + self.NAME + " | " + typeString + "\n \n"
-		
-		# Same as log. Make sure dumps and SERVER.dump exists and write into it
-		if not os.path.exists('dumps'):
-			os.makedirs('dumps')
-			
-		name = self.NAME
-		if self.NAME[-1] == ".":
-			name = self.NAME[0:-1]
-		try:
-		
-			with open('dumps/%s.dump' % name, "a") as dumpfile:
-				dumpfile.write(dumpString)
-				
-		except IOError:
-			with open('dumps/%s' % name, "w+") as dumpfile:
-				dumpfile.write(dumpString)
+
+		# Same as log, the writer thread takes care of dumps/NAME.dump
+		self.logWriter.write('dumps/%s.dump' % self.logName, dumpString)
 
 	def biggestSuffix(self, domain):
 		"""Looks through zones to find the biggest redirect we can give
@@ -228,9 +606,5 @@ class DNS_SERVER():
 		Returns:
 			str: Name of the longest suffix we can answer from domain
 		"""
-		biggestZone = ""
-		for zone in self.zoneData:
-			if zone in domain and len(zone) > len(biggestZone):
-				biggestZone = zone
-		return biggestZone
+		return self.zoneData.longestSuffix(domain)
 		
\ No newline at end of file
@@ -0,0 +1,74 @@
+from multiprocessing import Process
+import socket, asyncio, signal, time
+import dnssy
+
+class SERVER_HOST():
+	def __init__(self, zones, workers=1, worker=0, counters=None, latencies=None, ready=None, **options):
+		"""Serves several zones from one process through a single event loop, every zone on its own IP
+
+		Args:
+			zones (list): (ip, name, authoritative) of every zone we serve
+			workers (int): Processes serving the same zones, with more than one they share the ports via SO_REUSEPORT, default = 1
+			worker (int): Which of those processes we are, default = 0
+			counters (dict): zone name -> COUNTER handed out by run.py, default = None
+			latencies (dict): zone name -> latency of its DNS_SERVER, default = None
+			ready (multiprocessing.Queue): gets (name, seconds our start took) once every zone is served, default = None
+			options: passed on to every DNS_SERVER, e.g. logLevel or codec
+		"""
+		started = time.perf_counter()
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.servers = []
+		for ip, name, authoritative in zones:
+			counter = counters.get(name) if counters else None
+			zoneOptions = dict(options)
+			if latencies and name in latencies:
+				zoneOptions["latency"] = latencies[name]
+			server = dnssy.DNS_SERVER(ip, name, authoritative, mode="async", counter=counter, reusePort=workers > 1, worker=worker, serve=False, **zoneOptions)
+			self.loop.run_until_complete(server.attach(self.loop))
+			self.servers.append(server)
+		if ready is not None:
+			name = ",".join(server.NAME for server in self.servers)
+			ready.put((name if not worker else "%s-worker%d" % (name, worker), time.perf_counter() - started))
+		self.run()
+
+	def run(self):
+		"""Keep all servers alive
+		"""
+		try:
+			self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+			self.loop.add_signal_handler(signal.SIGHUP, self.reloadZones)
+		except (NotImplementedError, AttributeError):
+			pass
+		try:
+			self.loop.run_forever()
+		finally:
+			for server in self.servers:
+				server.close()
+			self.loop.close()
+
+	def reloadZones(self):
+		"""SIGHUP reloads the zones of every server we host
+		"""
+		for server in self.servers:
+			server.requestReload()
+
+def startHost(zones, workers=1, counters=None, latencies=None, **options):
+	"""Starts the worker processes of a host
+
+	Args:
+		zones (list): (ip, name, authoritative) of every zone the host serves
+		workers (int): Number of processes, only platforms with SO_REUSEPORT get more than one, default = 1
+		counters (dict): zone name -> COUNTER, default = None
+		latencies (dict): zone name -> latency of its DNS_SERVER, default = None
+		options: passed on to every DNS_SERVER
+
+	Returns:
+		list: the started processes
+	"""
+	if not hasattr(socket, "SO_REUSEPORT"):
+		workers = 1
+	processes = [Process(target=SERVER_HOST, args=(zones, workers, worker, counters, latencies), kwargs=options) for worker in range(workers)]
+	for process in processes:
+		process.start()
+	return processes
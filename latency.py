@@ -0,0 +1,117 @@
+import random
+
+# How a delay is drawn from fixedSec and jitterSec
+DISTRIBUTIONS = ("uniform", "normal", "exponential")
+
+class DELAY():
+	def __init__(self, fixedSec=0, jitterSec=0, distribution="uniform", loss=0, rng=None):
+		"""Artificial delay and packet loss of one link
+
+		Args:
+			fixedSec (float): Delay every message gets, default = 0
+			jitterSec (float): Random part of the delay, what it means depends on the distribution, default = 0
+			distribution (str): "uniform" adds 0 to jitterSec, "normal" adds a Gaussian with jitterSec standard deviation,
+				"exponential" adds an exponential with jitterSec mean (a long tail), default = "uniform"
+			loss (float): Share of messages that never arrive, e.g. 0.01, default = 0
+			rng (Random): random source, default = the random module
+		"""
+		if distribution not in DISTRIBUTIONS:
+			raise ValueError("unknown distribution %r, pick from %s" % (distribution, ", ".join(DISTRIBUTIONS)))
+		self.fixedSec = fixedSec
+		self.jitterSec = jitterSec
+		self.distribution = distribution
+		self.loss = loss
+		self.rng = rng or random
+
+	def sample(self):
+		"""Draws the delay of a single message
+
+		Returns:
+			float: seconds, None if the message is lost
+		"""
+		if self.loss and self.rng.random() < self.loss:
+			return None
+		if not self.jitterSec:
+			return self.fixedSec
+		if self.distribution == "normal":
+			return max(0, self.rng.gauss(self.fixedSec, self.jitterSec))
+		if self.distribution == "exponential":
+			return self.fixedSec + self.rng.expovariate(1 / self.jitterSec)
+		return self.fixedSec + self.rng.uniform(0, self.jitterSec)
+
+	def __bool__(self):
+		return bool(self.fixedSec or self.jitterSec or self.loss)
+
+class LATENCY():
+	def __init__(self, links=None, seed=None, **delay):
+		"""Emulated network between a server and everybody it sends messages to, zero delay by default
+
+		The delay is applied to every message the server sends, so a link between two of our processes gets the
+		latency of both ends, like a round trip
+
+		Args:
+			links (dict): peer IP -> DELAY arguments for messages to that peer, everybody else gets the default
+			seed (int): seed for the random source, so runs can be repeated, default = None
+			delay: DELAY arguments of the default link, e.g. fixedSec=0.02, loss=0.01
+		"""
+		rng = random.Random(seed)
+		self.default = DELAY(rng=rng, **delay)
+		self.links = {ip: DELAY(rng=rng, **spec) for ip, spec in (links or {}).items()}
+		self.active = bool(self.default) or any(self.links.values())
+		self.dropped = 0
+
+	@classmethod
+	def fromSpec(cls, spec):
+		"""Builds the latency from a configuration value
+
+		Args:
+			spec: None or 0 for none, a number for a fixed delay in seconds (what sleepSec used to be), a dict of
+				LATENCY arguments like {"fixedSec": 0.02, "links": {"127.0.0.11": {"loss": 0.05}}} or a LATENCY
+
+		Returns:
+			LATENCY: the latency
+		"""
+		if isinstance(spec, cls):
+			return spec
+		if not spec:
+			return cls()
+		if isinstance(spec, dict):
+			return cls(**spec)
+		return cls(fixedSec=float(spec))
+
+	def delay(self, addr):
+		"""Draws the delay of a message to addr
+
+		Args:
+			addr (tuple): the receiver
+
+		Returns:
+			float: seconds, None if the message is lost
+		"""
+		if not self.active:
+			return 0
+		seconds = self.links.get(addr[0], self.default).sample()
+		if seconds is None:
+			self.dropped += 1
+		return seconds
+
+	def send(self, loop, transport, data, addr):
+		"""Sends a datagram after its delay without blocking the event loop, or loses it
+
+		Args:
+			loop (asyncio.AbstractEventLoop): the loop of the transport
+			transport (asyncio.DatagramTransport): where the datagram goes out
+			data (bytes): the datagram
+			addr (tuple): the receiver
+
+		Returns:
+			bool: the datagram is (or will be) sent
+		"""
+		seconds = self.delay(addr)
+		if seconds is None:
+			return False
+		if seconds > 0:
+			loop.call_later(seconds, transport.sendto, data, addr)
+		else:
+			transport.sendto(data, addr)
+		return True
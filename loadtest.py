@@ -0,0 +1,457 @@
+from multiprocessing import Process, Queue
+import socket, select, json, time, os, shutil, tempfile, argparse, random, bisect, subprocess, datetime, queue
+from codec import negotiate
+from counters import COUNTERS
+from run import allZones, startAll
+import dnssy
+
+#Measures how many queries per second a single DNS Server answers, once for every serving mode,
+#or replays a query mix against the whole hierarchy and reports latency percentiles
+
+def createServer(ip, name, auth, mode, sleepSec, ready=None):
+	dnssy.DNS_SERVER(ip, name, auth, mode=mode, sleepSec=sleepSec, ready=ready)
+
+def prepareWorkdir():
+	"""Copies zones and messages.json into a temporary folder, so load tests don't pollute the real logs and counters
+
+	Returns:
+		str: path of the temporary folder
+	"""
+	here = os.path.dirname(os.path.abspath(__file__))
+	workdir = tempfile.mkdtemp(prefix="dnsloadtest")
+	shutil.copytree(os.path.join(here, "zones"), os.path.join(workdir, "zones"))
+	shutil.copy(os.path.join(here, "messages.json"), workdir)
+	return workdir
+
+def waitForServer(ip, port, timeout=10):
+	"""Polls the server until it answers, so the measurement doesn't include the startup
+
+	Args:
+		ip (str): Server IP
+		port (int): Server Port
+		timeout (float): Seconds until we give up
+	"""
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.settimeout(0.2)
+	query = json.dumps({"dns.flags.response": 0, "dns.flags.recdesired": 0, "dns.qry.name": "telematik.", "dns.qry.type": 1}, indent=4)
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			sock.sendto(query.encode('utf-8'), (ip, port))
+			sock.recvfrom(65535)
+			sock.close()
+			return
+		except (socket.timeout, ConnectionError):
+			continue
+	sock.close()
+	raise RuntimeError("Server %s:%s did not come up" % (ip, port))
+
+def checkRunning(processes):
+	"""Makes sure the servers we started still run, an answer may come from another server on the same address
+
+	Args:
+		processes (list): the processes we started
+
+	Raises:
+		RuntimeError: one of them has exited
+	"""
+	for process in processes:
+		if not process.is_alive():
+			raise RuntimeError("%s exited with code %s, is its address taken by another server?" % (process.name, process.exitcode))
+
+def waitForReady(ready, processes, timeout=60):
+	"""Waits until every process we started reports that it serves, which it only does once its sockets are bound
+
+	Args:
+		ready (Queue): the processes put (name, seconds) into it, see DNS_SERVER and RESOLVER
+		processes (list): the processes
+		timeout (float): Seconds until we give up
+
+	Raises:
+		RuntimeError: a process exited or didn't report in time
+	"""
+	deadline = time.time() + timeout
+	for n in range(len(processes)):
+		while 1:
+			try:
+				ready.get(timeout=0.2)
+				break
+			except queue.Empty:
+				checkRunning(processes)
+				if time.time() > deadline:
+					raise RuntimeError("%d of %d servers did not come up" % (len(processes) - n, len(processes)))
+
+def blast(ip, port, names, queries, concurrency, timeout=60):
+	"""Keeps a number of queries in flight over one socket until every query got answered
+
+	Args:
+		ip (str): Server IP
+		port (int): Server Port
+		names (list): Domains we ask for, round robin
+		queries (int): Number of queries in total
+		concurrency (int): Number of queries in flight at the same time
+		timeout (float): Seconds without any answer until we give up
+
+	Returns:
+		tuple: answered queries and elapsed seconds
+	"""
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.setblocking(False)
+	encoded = [json.dumps({"dns.flags.response": 0, "dns.flags.recdesired": 0, "dns.qry.name": name, "dns.qry.type": 1}, indent=4).encode('utf-8') for name in names]
+	sentCount = 0
+	answered = 0
+	start = time.time()
+	while answered < queries:
+		# Refill the window
+		while sentCount < queries and sentCount - answered < concurrency:
+			sock.sendto(encoded[sentCount % len(encoded)], (ip, port))
+			sentCount += 1
+		readable, _, _ = select.select([sock], [], [], timeout)
+		if not readable:
+			break
+		while 1:
+			try:
+				sock.recvfrom(65535)
+				answered += 1
+			except BlockingIOError:
+				break
+	elapsed = time.time() - start
+	sock.close()
+	return answered, elapsed
+
+def measure(mode, args):
+	"""Starts the server in the given mode and measures it
+
+	Args:
+		mode (str): "sync" or "async"
+		args (Namespace): parsed command line
+
+	Returns:
+		dict: result of the run
+	"""
+	ready = Queue()
+	server = Process(target=createServer, args=(args.ip, args.zone, args.auth, mode, args.sleep, ready))
+	server.start()
+	try:
+		waitForReady(ready, [server])
+		waitForServer(args.ip, args.port)
+		checkRunning([server])
+		with open(os.path.join("zones", "%s.zone" % args.zone.rstrip("."))) as zonefile:
+			names = list(json.load(zonefile))
+		answered, elapsed = blast(args.ip, args.port, names, args.queries, args.concurrency)
+	finally:
+		server.terminate()
+		server.join()
+	return {"mode": mode, "queries": args.queries, "answered": answered, "seconds": round(elapsed, 3), "qps": round(answered / elapsed, 1)}
+
+# Queries of the hierarchy run are one of these kinds
+KINDS = ("hit", "referral", "nxdomain")
+
+def percentile(times, share, digits=1):
+	times = sorted(times)
+	return round(times[min(len(times) - 1, int(len(times) * share))], digits)
+
+def parseMix(text):
+	"""Reads a query mix like "hit=70,referral=20,nxdomain=10", the weights don't have to add up to 100
+
+	Returns:
+		dict: kind -> weight
+	"""
+	mix = {}
+	for part in text.split(","):
+		kind, _, weight = part.partition("=")
+		if kind not in KINDS:
+			raise argparse.ArgumentTypeError("unknown query kind %r, pick from %s" % (kind, ", ".join(KINDS)))
+		mix[kind] = float(weight)
+	return mix
+
+def readLatency(text):
+	"""Reads the emulated network of a run, zone name or "resolver" -> latency, see run.LATENCY
+
+	Args:
+		text (str): JSON text or the path of a JSON file
+
+	Returns:
+		dict: the latencies
+	"""
+	if os.path.exists(text):
+		with open(text) as latencyfile:
+			return json.load(latencyfile)
+	return json.loads(text)
+
+def zoneNames(name):
+	with open(os.path.join("zones", "%s.zone" % name.rstrip("."))) as zonefile:
+		return sorted(json.load(zonefile))
+
+def namePools(target):
+	"""Names every kind of query is drawn from
+
+	The resolver gets hits for names of the authoritative zones, which it answers from its cache once it asked for them,
+	referrals for new names below the authoritative zones, which it has to ask their servers for, and nxdomains below a
+	top level domain that doesn't exist, which the root turns down. A server gets hits for the names in its zone,
+	referrals for new names below them and nxdomains for new names right below its zone
+
+	Args:
+		target (str): "resolver" or the name of a zone
+
+	Returns:
+		dict: kind -> names, hits ask for the names themselves, the other kinds put a new label in front
+	"""
+	if target == "resolver":
+		zones = [name for ip, name, auth in allZones() if auth]
+		return {"hit": [record for name in zones for record in zoneNames(name)], "referral": zones, "nxdomain": ["invalid."]}
+	records = zoneNames(target)
+	return {"hit": records, "referral": records, "nxdomain": ["invalid." if target == "ROOT" else target]}
+
+def buildQueries(pools, mix, count, zipf, rng):
+	"""Draws the queries of a run
+
+	Hits follow a Zipf distribution, the n-th most popular name is asked n ** zipf times less often than the most
+	popular one. Every other query asks for a name nobody asked before, so no cache can answer it
+
+	Args:
+		pools (dict): kind -> names, see namePools()
+		mix (dict): kind -> weight
+		count (int): number of queries
+		zipf (float): Zipf exponent, 0 asks every name equally often
+		rng (Random): random source, seeded so runs of different commits ask the same names
+
+	Returns:
+		list: (kind, name) of every query
+	"""
+	popular = list(pools["hit"])
+	rng.shuffle(popular)
+	cumulative = []
+	total = 0
+	for rank in range(1, len(popular) + 1):
+		total += 1 / rank ** zipf
+		cumulative.append(total)
+	kinds = [kind for kind in KINDS if mix.get(kind, 0) > 0]
+	token = "lt%x" % rng.getrandbits(24)
+	queries = []
+	for number, kind in enumerate(rng.choices(kinds, weights=[mix[kind] for kind in kinds], k=count)):
+		if kind == "hit":
+			queries.append((kind, popular[bisect.bisect(cumulative, rng.random() * total)]))
+		else:
+			queries.append((kind, "%s-%d.%s" % (token, number, rng.choice(pools[kind]))))
+	return queries
+
+def replay(ip, port, queries, rate=0, concurrency=100, timeout=5, sockets=1):
+	"""Sends the queries and times every one of them
+
+	With a rate the queries go out on a fixed schedule, no matter how fast the answers come back (open loop), and a
+	query's latency counts from the moment it was due, so a server that falls behind can't hide it by slowing us down.
+	Without a rate the next query goes out as soon as there is room in the window (closed loop)
+
+	Args:
+		ip (str): Server IP
+		port (int): Server Port
+		queries (list): (kind, name) of every query
+		rate (float): queries per second, 0 = as fast as the window allows
+		concurrency (int): Queries in flight at the same time at most
+		timeout (float): Seconds until a query counts as lost
+		sockets (int): Source ports the queries take turns on, SO_REUSEPORT hands all queries from one port to the same worker, default = 1
+
+	Returns:
+		tuple: (kind, rcode, seconds) of every query, rcode and seconds are None for lost ones, and the seconds the run took
+	"""
+	socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for n in range(sockets)]
+	for sock in socks:
+		sock.setblocking(False)
+	# transaction ID -> (kind, name, time due, time sent)
+	inflight = {}
+	results = []
+	nextQuery = 0
+	nextId = 0
+	start = time.perf_counter()
+	while nextQuery < len(queries) or inflight:
+		now = time.perf_counter()
+		while nextQuery < len(queries) and len(inflight) < min(concurrency, 65536):
+			due = start + nextQuery / rate if rate else now
+			if due > now:
+				break
+			while nextId in inflight:
+				nextId = (nextId + 1) % 65536
+			kind, name = queries[nextQuery]
+			message = {"dns.id": nextId, "dns.flags.response": 0, "dns.flags.recdesired": 1, "dns.qry.name": name, "dns.qry.type": 1}
+			inflight[nextId] = (kind, name, due, now)
+			socks[nextQuery % sockets].sendto(json.dumps(message).encode('utf-8'), (ip, port))
+			nextQuery += 1
+		# Sleep until an answer arrives, the oldest query is lost or the next one is due
+		wake = min([sent + timeout for kind, name, due, sent in inflight.values()] or [now + timeout])
+		if rate and nextQuery < len(queries) and len(inflight) < concurrency:
+			wake = min(wake, start + nextQuery / rate)
+		readable, _, _ = select.select(socks, [], [], max(0, wake - time.perf_counter()))
+		for sock in readable:
+			while 1:
+				try:
+					data, addr = sock.recvfrom(65535)
+				except BlockingIOError:
+					break
+				try:
+					reply = negotiate(data)[1]
+				except ValueError:
+					continue
+				waiting = inflight.get(reply.get("dns.id"))
+				if addr != (ip, port) or waiting is None or reply.get("dns.qry.name", waiting[1]) != waiting[1]:
+					continue
+				del inflight[reply["dns.id"]]
+				results.append((waiting[0], reply.get("dns.flags.rcode"), time.perf_counter() - waiting[2]))
+		now = time.perf_counter()
+		for ident, (kind, name, due, sent) in list(inflight.items()):
+			if now - sent >= timeout:
+				del inflight[ident]
+				results.append((kind, None, None))
+	elapsed = time.perf_counter() - start
+	for sock in socks:
+		sock.close()
+	return results, elapsed
+
+def summarize(target, results, elapsed):
+	"""Boils the results of a target down to one JSON line
+
+	Returns:
+		dict: throughput, latency percentiles in ms, lost queries and rcodes, for all queries and per kind
+	"""
+	def latencies(times):
+		if not times:
+			return {}
+		return {"p50Ms": percentile(times, 0.5, 3), "p99Ms": percentile(times, 0.99, 3), "p999Ms": percentile(times, 0.999, 3)}
+
+	answered = [seconds * 1000 for kind, rcode, seconds in results if seconds is not None]
+	summary = {"target": target, "queries": len(results), "answered": len(answered), "lost": len(results) - len(answered), "seconds": round(elapsed, 3), "qps": round(len(answered) / elapsed, 1)}
+	summary.update(latencies(answered))
+	rcodes = {}
+	for kind, rcode, seconds in results:
+		if rcode is not None:
+			rcodes[str(rcode)] = rcodes.get(str(rcode), 0) + 1
+	summary["rcodes"] = rcodes
+	summary["kinds"] = {}
+	for name in KINDS:
+		times = [seconds * 1000 for kind, rcode, seconds in results if kind == name and seconds is not None]
+		count = sum(1 for kind, rcode, seconds in results if kind == name)
+		if count:
+			summary["kinds"][name] = dict(queries=count, lost=count - len(times), **latencies(times))
+	return summary
+
+def commitId():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(results, baselinePath):
+	"""Prints how every target did against a saved run, e.g. of the previous commit
+
+	Args:
+		results (list): summaries of this run
+		baselinePath (str): results file written with --out
+	"""
+	with open(baselinePath) as baselineFile:
+		baseline = {result["target"]: result for result in json.load(baselineFile)["results"]}
+	for result in results:
+		old = baseline.get(result["target"])
+		if old is None:
+			continue
+		change = {"target": result["target"], "baseline": baselinePath}
+		for key in ("qps", "p50Ms", "p99Ms", "p999Ms"):
+			if old.get(key) and key in result:
+				change[key] = "%+.1f%%" % ((result[key] - old[key]) / old[key] * 100)
+		print(json.dumps(change))
+
+def hierarchy(args):
+	"""Starts every server and the resolver like run.py does, at wire speed or with --latency, and replays a query mix against each target
+
+	Args:
+		args (Namespace): parsed command line
+
+	Returns:
+		list: summary of every target
+	"""
+	addresses = {name: ip for ip, name, auth in allZones()}
+	addresses["resolver"] = "127.0.0.10"
+	targets = args.targets.split(",")
+	for target in targets:
+		if target not in addresses:
+			raise SystemExit("unknown target %s, pick from %s" % (target, ", ".join(sorted(addresses))))
+	os.chdir(prepareWorkdir())
+	rng = random.Random(args.seed)
+	counters = COUNTERS(names=list(addresses))
+	ready = Queue()
+	quiet = {"logLevel": "off", "metricsPort": args.metricsPort, "ready": ready}
+	processes = startAll(counters, quiet, dict(quiet, cacheEntries=args.cacheEntries), args.latency, args.resolverWorkers)
+	results = []
+	try:
+		waitForReady(ready, processes)
+		for ip in addresses.values():
+			waitForServer(ip, args.port)
+		checkRunning(processes)
+		for target in targets:
+			pools = namePools(target)
+			if not args.cold:
+				# Ask every name once, so hits really are hits
+				replay(addresses[target], args.port, [("hit", name) for name in pools["hit"]], 0, args.concurrency, args.timeout, args.sockets)
+			queries = buildQueries(pools, args.mix, args.queries, args.zipf, rng)
+			summary = summarize(target, *replay(addresses[target], args.port, queries, args.rate, args.concurrency, args.timeout, args.sockets))
+			print(json.dumps(summary))
+			results.append(summary)
+	finally:
+		for process in processes:
+			process.terminate()
+			process.join()
+	return results
+
+def modes(args):
+	os.chdir(prepareWorkdir())
+	for mode in args.modes.split(","):
+		print(json.dumps(measure(mode, args)))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Load tests for a single DNS Server or the whole hierarchy")
+	sub = parser.add_subparsers(dest="test")
+	sub.required = True
+
+	server = sub.add_parser("modes", help="queries/second of a single DNS Server in sync and async mode")
+	server.add_argument("--zone", default="telematik.", help="Server name, same as its zone file")
+	server.add_argument("--ip", default="127.0.0.12")
+	server.add_argument("--port", type=int, default=53053)
+	server.add_argument("--auth", action="store_true", help="Server is authoritative")
+	server.add_argument("--sleep", type=float, default=0.05, help="Artificial delay per answer in seconds")
+	server.add_argument("--queries", type=int, default=100)
+	server.add_argument("--concurrency", type=int, default=100, help="Queries in flight at the same time")
+	server.add_argument("--modes", default="sync,async", help="Comma separated serving modes to compare")
+	server.set_defaults(run=modes)
+
+	tree = sub.add_parser("hierarchy", help="replays a query mix against the resolver and servers of run.py")
+	tree.add_argument("--targets", default="resolver", help="Comma separated targets, resolver or zone names like ROOT,telematik.")
+	tree.add_argument("--mix", type=parseMix, default="hit=80,referral=10,nxdomain=10", help="weights of the query kinds: %s" % ", ".join(KINDS))
+	tree.add_argument("--zipf", type=float, default=1.0, help="Zipf exponent of the hit names, 0 = uniform")
+	tree.add_argument("--queries", type=int, default=10000, help="queries per target")
+	tree.add_argument("--rate", type=float, default=0, help="queries/second on a fixed schedule, 0 = closed loop")
+	tree.add_argument("--concurrency", type=int, default=100, help="Queries in flight at the same time at most")
+	tree.add_argument("--timeout", type=float, default=5, help="seconds until a query counts as lost")
+	tree.add_argument("--port", type=int, default=53053)
+	tree.add_argument("--sockets", type=int, default=8, help="source ports the queries are spread over, so every worker of a target gets some")
+	tree.add_argument("--resolverWorkers", type=int, help="resolver processes, default = run.RESOLVER_WORKERS")
+	tree.add_argument("--cacheEntries", type=int, default=100000, help="resolver cache size, new names of the mix fill it up")
+	tree.add_argument("--latency", type=readLatency, help="emulated network like run.LATENCY, JSON text or a file with it, default = wire speed")
+	tree.add_argument("--metricsPort", type=int, help="serve the metrics of every server and the resolver on this port while the test runs, default = off")
+	tree.add_argument("--cold", action="store_true", help="don't ask every hit name once before measuring")
+	tree.add_argument("--seed", type=int, default=53053)
+	tree.add_argument("--out", help="save the results with commit, time and arguments as JSON")
+	tree.add_argument("--baseline", help="results file of an earlier run to compare against")
+	tree.set_defaults(run=hierarchy)
+
+	args = parser.parse_args()
+	# The servers run in a temporary folder, files given on the command line are meant relative to here
+	for option in ("out", "baseline"):
+		if getattr(args, option, None):
+			setattr(args, option, os.path.abspath(getattr(args, option)))
+	results = args.run(args)
+	if args.test == "hierarchy":
+		if args.out:
+			settings = {key: value for key, value in vars(args).items() if key not in ("run", "out", "baseline")}
+			with open(args.out, "w") as outfile:
+				json.dump({"commit": commitId(), "time": datetime.datetime.now().isoformat(timespec="seconds"), "args": settings, "results": results}, outfile, indent=4)
+		if args.baseline:
+			compare(results, args.baseline)
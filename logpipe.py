@@ -0,0 +1,125 @@
+import os, queue, threading, atexit, random
+
+LEVELS = ("off", "log", "dump")
+
+class LOG_WRITER():
+	shared = None
+
+	def __init__(self, maxBytes=10 * 1024 * 1024, backups=3, interval=0.5):
+		"""Writes log and dump lines from a background thread, so no query waits for the disk
+
+		Files stay open, lines are written in batches and a file is rotated once it grows over maxBytes
+
+		Args:
+			maxBytes (int): Size at which a file is rotated, default = 10 MiB
+			backups (int): Rotated files we keep (NAME.log.1 ... NAME.log.n), default = 3
+			interval (float): Seconds the writer waits for more lines before it flushes, default = 0.5
+		"""
+		self.maxBytes = maxBytes
+		self.backups = backups
+		self.interval = interval
+		self.lines = queue.SimpleQueue()
+		self.files = {}
+		self.thread = threading.Thread(target=self.run, name="logwriter", daemon=True)
+		self.thread.start()
+		atexit.register(self.close)
+
+	@classmethod
+	def get(cls):
+		"""All servers of a process share one writer thread
+
+		Returns:
+			LOG_WRITER: the writer of this process
+		"""
+		if cls.shared is None:
+			cls.shared = cls()
+		return cls.shared
+
+	def write(self, path, text):
+		"""Queues text for a file, called from the query path
+
+		Args:
+			path (str): e.g. logfiles/ROOT.log
+			text (str): what to append
+		"""
+		self.lines.put((path, text))
+
+	def run(self):
+		"""Collects lines until the queue runs dry or interval passes, then writes them file by file
+		"""
+		stopping = False
+		while not stopping:
+			batch = {}
+			try:
+				item = self.lines.get(timeout=self.interval)
+			except queue.Empty:
+				continue
+			while item is not None:
+				batch.setdefault(item[0], []).append(item[1])
+				try:
+					item = self.lines.get_nowait()
+				except queue.Empty:
+					break
+			if item is None:
+				# close() wants us to stop, but write what we have first
+				stopping = True
+			for path, texts in batch.items():
+				self.writeBatch(path, "".join(texts))
+		for logfile in self.files.values():
+			logfile.close()
+		self.files = {}
+
+	def writeBatch(self, path, text):
+		"""Appends text to a file and rotates it if it got too big
+
+		Args:
+			path (str): the file
+			text (str): what to append
+		"""
+		logfile = self.files.get(path)
+		if logfile is None:
+			directory = os.path.dirname(path)
+			if directory and not os.path.exists(directory):
+				os.makedirs(directory)
+			logfile = self.files[path] = open(path, "a")
+		logfile.write(text)
+		logfile.flush()
+		if logfile.tell() >= self.maxBytes:
+			self.rotate(path)
+
+	def rotate(self, path):
+		"""Moves NAME.log to NAME.log.1, NAME.log.1 to NAME.log.2 and so on, the oldest one is dropped
+
+		Args:
+			path (str): the file
+		"""
+		self.files.pop(path).close()
+		for number in range(self.backups - 1, 0, -1):
+			if os.path.exists("%s.%d" % (path, number)):
+				os.replace("%s.%d" % (path, number), "%s.%d" % (path, number + 1))
+		if self.backups > 0:
+			os.replace(path, path + ".1")
+		else:
+			os.remove(path)
+
+	def close(self):
+		"""Writes everything that is still queued and closes the files
+		"""
+		if self.thread.is_alive():
+			self.lines.put(None)
+			self.thread.join()
+
+def wanted(level, logtype, dumpSample=1.0):
+	"""Decides if a line should be written at all
+
+	Args:
+		level (str): "off" writes nothing, "log" only logfiles, "dump" logfiles and dumps
+		logtype (str): "log" or "dump"
+		dumpSample (float): Share of dumps we write, e.g. 0.01 for every hundredth, default = 1.0
+
+	Returns:
+		bool: write it or not
+	"""
+	if LEVELS.index(level) < LEVELS.index(logtype):
+		return False
+	return logtype != "dump" or dumpSample >= 1.0 or random.random() < dumpSample
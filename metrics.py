@@ -0,0 +1,164 @@
+import bisect, re, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency buckets in seconds, 10 µs to 10 s
+SECONDS_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds for things we count, like upstream queries of a recursion
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+class HISTOGRAM():
+	def __init__(self, buckets):
+		"""Counts observations per bucket, like a Prometheus histogram
+
+		Args:
+			buckets (tuple): upper bounds of the buckets, ascending, +Inf is added
+		"""
+		self.buckets = buckets
+		# One more for +Inf, not cumulative yet, render() adds them up
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+class METRICS():
+	def __init__(self, **labels):
+		"""Counters and histograms of one server, rendered in the Prometheus text format
+
+		Labels of a single metric are tuples of (name, value) pairs, build them once and reuse them on the hot path
+
+		Args:
+			labels: labels every metric gets, e.g. zone="telematik."
+		"""
+		self.constLabels = tuple(labels.items())
+		# name -> (type, help text)
+		self.descriptions = {}
+		# name -> {labels -> value}
+		self.counters = {}
+		# name -> {labels -> HISTOGRAM}
+		self.histograms = {}
+		# (prefix, function returning name -> value, names that are gauges)
+		self.collectors = []
+		self.server = None
+
+	def describe(self, name, kind, text):
+		"""Sets the type and help text of a metric
+
+		Args:
+			name (str): metric name
+			kind (str): "counter", "gauge" or "histogram"
+			text (str): help text
+		"""
+		self.descriptions[name] = (kind, text)
+
+	def count(self, name, labels=(), amount=1):
+		"""Adds to a counter
+
+		Args:
+			name (str): metric name, ends in _total
+			labels (tuple): (name, value) pairs, default = none
+			amount (int): default = 1
+		"""
+		values = self.counters.setdefault(name, {})
+		values[labels] = values.get(labels, 0) + amount
+
+	def observe(self, name, value, labels=(), buckets=SECONDS_BUCKETS):
+		"""Puts a value into a histogram
+
+		Args:
+			name (str): metric name
+			value (float): the observation, seconds for timings
+			labels (tuple): (name, value) pairs, default = none
+			buckets (tuple): bucket bounds, only used when the histogram is new, default = SECONDS_BUCKETS
+		"""
+		values = self.histograms.setdefault(name, {})
+		histogram = values.get(labels)
+		if histogram is None:
+			histogram = values[labels] = HISTOGRAM(buckets)
+		histogram.observe(value)
+
+	def collect(self, prefix, function, gauges=()):
+		"""Adds values that are counted elsewhere, read whenever the metrics are rendered
+
+		Args:
+			prefix (str): put in front of every name, e.g. "dns_resolver_"
+			function (callable): returns camelCase name -> value, e.g. RESOLVER.stats
+			gauges (collection): names that can go down, everything else is a counter
+		"""
+		self.collectors.append((prefix, function, gauges))
+
+	def labelText(self, labels, extra=()):
+		pairs = self.constLabels + labels + extra
+		if not pairs:
+			return ""
+		return "{" + ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in pairs) + "}"
+
+	def header(self, lines, name, kind):
+		text = self.descriptions.get(name, (kind, ""))[1]
+		if text:
+			lines.append("# HELP %s %s" % (name, text))
+		lines.append("# TYPE %s %s" % (name, kind))
+
+	def render(self):
+		"""All metrics in the Prometheus text exposition format
+
+		Returns:
+			str: the metrics, one sample per line
+		"""
+		lines = []
+		# The serving thread keeps counting while we read, copy before iterating
+		for name, values in sorted(self.counters.items()):
+			self.header(lines, name, "counter")
+			for labels, value in list(values.items()):
+				lines.append("%s%s %s" % (name, self.labelText(labels), value))
+		for prefix, function, gauges in self.collectors:
+			for key, value in sorted(function().items()):
+				gauge = key in gauges
+				name = prefix + re.sub(r"(?<!^)(?=[A-Z])", "_", key).lower() + ("" if gauge else "_total")
+				self.header(lines, name, "gauge" if gauge else "counter")
+				lines.append("%s%s %s" % (name, self.labelText(()), value))
+		for name, values in sorted(self.histograms.items()):
+			self.header(lines, name, "histogram")
+			for labels, histogram in list(values.items()):
+				cumulative = 0
+				for bound, count in zip(histogram.buckets + ("+Inf",), list(histogram.counts)):
+					cumulative += count
+					lines.append("%s_bucket%s %d" % (name, self.labelText(labels, (("le", bound),)), cumulative))
+				lines.append("%s_sum%s %r" % (name, self.labelText(labels), histogram.sum))
+				lines.append("%s_count%s %d" % (name, self.labelText(labels), histogram.count))
+		return "\n".join(lines) + "\n"
+
+	def serve(self, ip, port):
+		"""Serves GET /metrics over HTTP from a background thread
+
+		Args:
+			ip (str): IP to listen on
+			port (int): Port to listen on
+
+		Raises:
+			OSError: the address is taken
+		"""
+		metrics = self
+
+		class HANDLER(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] != "/metrics":
+					self.send_error(404)
+					return
+				body = metrics.render().encode('utf-8')
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				# Scrapes every few seconds would flood stderr
+				pass
+
+		self.server = ThreadingHTTPServer((ip, port), HANDLER)
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, name="metrics %s:%d" % (ip, port), daemon=True).start()
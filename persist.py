@@ -0,0 +1,142 @@
+import json, os, threading, queue, time, tempfile
+
+def entryJSON(entry):
+	# Cache entries are objects, they know how they look in cache.json
+	return entry.toJSON()
+
+def atomicWrite(path, text):
+	"""Writes text into a temporary file next to path and renames it over path, so nobody ever reads half a file
+
+	Args:
+		path (str): the target file
+		text (str or bytes): the new content, bytes are written as they are
+	"""
+	directory = os.path.dirname(os.path.abspath(path))
+	fd, tmpPath = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb" if isinstance(text, bytes) else "w") as tmpFile:
+			tmpFile.write(text)
+			tmpFile.flush()
+			os.fsync(tmpFile.fileno())
+		os.replace(tmpPath, path)
+	except BaseException:
+		if os.path.exists(tmpPath):
+			os.remove(tmpPath)
+		raise
+
+def loadSnapshot(path):
+	"""Loads a snapshot and replays the journal that was written after it
+
+	Args:
+		path (str): the snapshot, the journal is path + ".journal"
+
+	Returns:
+		dict: the content, empty if there is no snapshot yet
+	"""
+	try:
+		with open(path) as snapshot:
+			content = json.load(snapshot)
+	except IOError:
+		content = {}
+	try:
+		with open(path + ".journal") as journal:
+			for line in journal:
+				try:
+					name, entry = json.loads(line)
+				except ValueError:
+					# Torn last line of a crash, everything before it is fine
+					break
+				if entry is None:
+					content.pop(name, None)
+				else:
+					content[name] = entry
+	except IOError:
+		pass
+	return content
+
+class CACHE_WRITER():
+	def __init__(self, path, content, interval=5, journal=False, compactSec=60):
+		"""Persists a cache from a background thread, so the query path only hands over its changes
+
+		Args:
+			path (str): the snapshot file, e.g. cache.json
+			content (dict): what is in the cache right now, entries need a toJSON() method
+			interval (float): Seconds between two flushes, default = 5
+			journal (bool): Append changes to path + ".journal" on every flush and only write a full snapshot every compactSec seconds
+			compactSec (float): Seconds between two snapshots in journal mode, default = 60
+		"""
+		self.path = path
+		self.journalPath = path + ".journal"
+		# Our own copy of the cache, entries are never changed after they are created (only their hit count, which isn't saved), so sharing them is fine
+		self.content = dict(content)
+		self.interval = interval
+		self.journal = journal
+		self.compactSec = compactSec
+		self.changes = queue.SimpleQueue()
+		self.dirty = False
+		self.journalDirty = os.path.exists(self.journalPath)
+		self.lastSnapshot = time.time()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, name="writer " + path, daemon=True)
+		self.thread.start()
+
+	def record(self, name, entry):
+		"""Remembers a change, called from the query path so it must stay cheap
+
+		Args:
+			name (str): the changed name
+			entry (ENTRY): the new entry or None if the name is gone
+		"""
+		self.changes.put((name, entry))
+
+	def run(self):
+		"""Flushes every interval seconds until close() is called
+		"""
+		while not self.stopped.wait(self.interval):
+			self.flush()
+
+	def flush(self, snapshot=False):
+		"""Writes all recorded changes, either as journal lines or as a new snapshot
+
+		Args:
+			snapshot (bool): Write a snapshot even if compactSec hasn't passed yet
+		"""
+		lines = []
+		while 1:
+			try:
+				name, entry = self.changes.get_nowait()
+			except queue.Empty:
+				break
+			if entry is None:
+				self.content.pop(name, None)
+			else:
+				self.content[name] = entry
+			lines.append(json.dumps([name, entry], default=entryJSON) + "\n")
+		if lines:
+			self.dirty = True
+
+		if self.journal and lines:
+			with open(self.journalPath, "a") as journal:
+				journal.writelines(lines)
+			self.journalDirty = True
+
+		if not self.journal or snapshot or time.time() - self.lastSnapshot >= self.compactSec:
+			self.snapshot()
+
+	def snapshot(self):
+		"""Writes the whole cache atomically and empties the journal, which the snapshot now contains
+		"""
+		if self.dirty or self.journalDirty:
+			atomicWrite(self.path, json.dumps(self.content, indent=4, default=entryJSON))
+			if self.journalDirty:
+				os.remove(self.journalPath)
+			self.dirty = False
+			self.journalDirty = False
+		self.lastSnapshot = time.time()
+
+	def close(self):
+		"""Stops the thread and writes a final snapshot
+		"""
+		self.stopped.set()
+		self.thread.join()
+		self.flush(snapshot=True)
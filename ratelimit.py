@@ -0,0 +1,133 @@
+import time
+
+# What a server does with a response, see RATE_LIMITER.check()
+SEND, SLIP, DROP = "send", "slip", "drop"
+
+# Kinds of responses that get buckets of their own, see responseKind(). The resolver also keeps a "recursion" bucket per client
+KINDS = ("answer", "referral", "nxdomain", "error")
+
+# Metric labels are built once, not per query
+LIMIT_LABELS = {(action, kind): (("action", action), ("kind", kind)) for action in (SLIP, DROP) for kind in KINDS}
+
+def responseKind(response):
+	"""Sorts a response into the bucket it is charged to
+
+	Args:
+		response (dict): the response, or the body of a compiled one, or a result of the resolver
+
+	Returns:
+		str: "answer", "referral", "nxdomain" or "error"
+	"""
+	rcode = response.get("dns.flags.rcode", 0)
+	if rcode == 3:
+		return "nxdomain"
+	if rcode:
+		return "error"
+	if "dns.count_auth_rr" in response:
+		return "referral"
+	return "answer"
+
+class RATE_LIMITER():
+	def __init__(self, ratePerSec=0, burst=None, slip=2, maxClients=100000, clock=time.monotonic):
+		"""Token buckets per client address and response kind, like Response Rate Limiting in BIND
+
+		A client gets ratePerSec responses of every kind per second and can save up to burst of them. Once a bucket is
+		empty, the responses of that kind to that client are dropped, except every slip-th one, which is sent truncated:
+		a real client asks again over TCP, which isn't limited, a flood with a spoofed address only gets a tiny answer
+
+		Args:
+			ratePerSec (float): responses per second, client and kind, 0 = no limit, default = 0
+			burst (float): size of a bucket, default = ratePerSec (one second of responses)
+			slip (int): every slip-th limited response is truncated instead of dropped, 1 = all of them, 0 = none, default = 2
+			maxClients (int): buckets we keep at most, the idle ones are forgotten first, default = 100000
+			clock (callable): seconds, default = time.monotonic
+		"""
+		self.ratePerSec = ratePerSec
+		self.burst = burst or ratePerSec
+		self.slip = slip
+		self.maxClients = maxClients
+		self.clock = clock
+		self.active = ratePerSec > 0
+		# (client IP, kind) -> [tokens, time of the last refill, limited responses]
+		self.buckets = {}
+		self.slipped = 0
+		self.dropped = 0
+
+	@classmethod
+	def fromSpec(cls, spec):
+		"""Builds the limiter from a configuration value
+
+		Args:
+			spec: None or 0 for no limit, a number for responses per second, a dict of RATE_LIMITER arguments like
+				{"ratePerSec": 50, "burst": 200, "slip": 3} or a RATE_LIMITER
+
+		Returns:
+			RATE_LIMITER: the limiter
+		"""
+		if isinstance(spec, cls):
+			return spec
+		if not spec:
+			return cls()
+		if isinstance(spec, dict):
+			return cls(**spec)
+		return cls(ratePerSec=float(spec))
+
+	def bucket(self, key, now):
+		bucket = self.buckets.get(key)
+		if bucket is None:
+			if len(self.buckets) >= self.maxClients:
+				self.forget(now)
+			bucket = self.buckets[key] = [self.burst, now, 0]
+		else:
+			bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.ratePerSec)
+			bucket[1] = now
+		return bucket
+
+	def forget(self, now):
+		"""Drops the buckets that have filled up again, they are the same as new ones. If every client is busy, we start over
+		"""
+		refillSec = self.burst / self.ratePerSec
+		self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < refillSec}
+		if len(self.buckets) >= self.maxClients:
+			self.buckets = {}
+
+	def allow(self, ip, kind):
+		"""Takes a token from the bucket of a client, for work that can't be truncated
+
+		Args:
+			ip (str): the client
+			kind (str): e.g. "recursion"
+
+		Returns:
+			bool: there was a token
+		"""
+		if not self.active:
+			return True
+		bucket = self.bucket((ip, kind), self.clock())
+		if bucket[0] >= 1:
+			bucket[0] -= 1
+			return True
+		return False
+
+	def check(self, ip, kind):
+		"""Decides what happens to a UDP response
+
+		Args:
+			ip (str): the client
+			kind (str): see responseKind()
+
+		Returns:
+			str: SEND, SLIP (send it truncated) or DROP
+		"""
+		if not self.active:
+			return SEND
+		bucket = self.bucket((ip, kind), self.clock())
+		if bucket[0] >= 1:
+			bucket[0] -= 1
+			return SEND
+		bucket[2] += 1
+		if self.slip and bucket[2] % self.slip == 0:
+			self.slipped += 1
+			return SLIP
+		self.dropped += 1
+		return DROP
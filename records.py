@@ -0,0 +1,194 @@
+import socket, struct, sys, time, functools
+
+# An IPv4 address as the int of its 4 bytes, 32 bytes per address instead of 59 for "127.0.0.14"
+IPV4 = struct.Struct("!I")
+
+def packAddress(address):
+	"""Packs a dotted IPv4 address into an int
+
+	Args:
+		address (str): e.g. "127.0.0.14"
+
+	Returns:
+		int: the address, or the string as it was if it is no IPv4 address
+	"""
+	try:
+		return IPV4.unpack(socket.inet_aton(address))[0]
+	except (OSError, TypeError):
+		return address
+
+def unpackAddress(address):
+	"""Turns a packed address back into its dotted form
+
+	Args:
+		address (int): see packAddress()
+
+	Returns:
+		str: e.g. "127.0.0.14"
+	"""
+	if isinstance(address, int):
+		return socket.inet_ntoa(IPV4.pack(address))
+	return address
+
+@functools.lru_cache(maxsize=4096)
+def humanTime(unixTime):
+	# Many entries die in the same second, cache.json is written over and over
+	return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(unixTime))
+
+class RECORD():
+	__slots__ = ("addresses", "ttl")
+
+	def __init__(self, addresses, ttl):
+		"""Entry of a zone file, kept for every name of a zone
+
+		Args:
+			addresses (tuple): packed addresses of the name, see packAddress()
+			ttl (int): time to live in seconds
+		"""
+		self.addresses = addresses
+		self.ttl = ttl
+
+	@classmethod
+	def fromJSON(cls, record):
+		"""Builds the record from its zone file entry
+
+		Args:
+			record (dict): e.g. {"A": "127.0.0.14", "TTL": 400}, or {"A": [...], ...} for several name servers
+
+		Returns:
+			RECORD: the record
+		"""
+		addresses = record["A"] if isinstance(record["A"], list) else [record["A"]]
+		return cls(tuple(packAddress(address) for address in addresses), record["TTL"])
+
+	def pack(self):
+		return (self.addresses, self.ttl)
+
+	def addressList(self):
+		return [unpackAddress(address) for address in self.addresses]
+
+class ENTRY():
+	# lookups that returned the entry since it was cached, the only field that changes, it isn't saved
+	__slots__ = ("ttl", "dieTime", "hits")
+
+	def __init__(self, ttl, dieTime=None):
+		"""Base of the resolver cache entries, something that dies at dieTime
+
+		Args:
+			ttl (int): time to live in seconds
+			dieTime (int): unix time the entry dies, default = ttl seconds from now
+		"""
+		self.ttl = ttl
+		self.dieTime = int(time.time() + ttl) if dieTime is None else dieTime
+		self.hits = 0
+
+	def size(self):
+		"""Estimates how many bytes the entry occupies in memory
+
+		Returns:
+			int: size in bytes
+		"""
+		return sys.getsizeof(self) + sum(sys.getsizeof(field) for field in self.pack())
+
+	def toJSON(self):
+		"""The entry as it is saved in cache.json, with its time of death readable for humans
+
+		Returns:
+			dict: the entry
+		"""
+		entry = self.fields()
+		entry.update({"TTL": self.ttl, "dieTime": self.dieTime, "dieTimeHR": humanTime(self.dieTime)})
+		return entry
+
+	@staticmethod
+	def fromJSON(entry, delegation=False):
+		"""Builds an entry from cache.json
+
+		Args:
+			entry (dict): the entry as saved by toJSON()
+			delegation (bool): it is the entry of a zone, not of a query
+
+		Returns:
+			ENTRY: a DELEGATION, a NEGATIVE if there is an rcode, else an ANSWER
+		"""
+		if delegation:
+			servers = entry.get("servers")
+			return DELEGATION(packAddress(entry["A"]), entry["TTL"], entry["dieTime"], tuple(packAddress(server) for server in servers) if servers else None)
+		if "rcode" in entry:
+			return NEGATIVE(entry["rcode"], entry["TTL"], entry["dieTime"])
+		return ANSWER(packAddress(entry["A"]), entry["TTL"], entry["dieTime"])
+
+class ANSWER(ENTRY):
+	__slots__ = ("address",)
+	rcode = None
+
+	def __init__(self, address, ttl, dieTime=None):
+		"""The final A record of a query
+
+		Args:
+			address (int): packed address, see packAddress()
+			ttl (int): time to live in seconds
+			dieTime (int): unix time the entry dies, default = ttl seconds from now
+		"""
+		super().__init__(ttl, dieTime)
+		self.address = address
+
+	def fields(self):
+		return {"A": unpackAddress(self.address)}
+
+	def pack(self):
+		return (self.address, self.ttl, self.dieTime)
+
+class DELEGATION(ANSWER):
+	__slots__ = ("servers",)
+
+	def __init__(self, address, ttl, dieTime=None, servers=None):
+		"""The servers of a zone we were referred to
+
+		Args:
+			address (int): packed address of the server we ask first
+			ttl (int): time to live in seconds
+			dieTime (int): unix time the entry dies, default = ttl seconds from now
+			servers (tuple): packed addresses of all servers if there are several, default = None
+		"""
+		super().__init__(address, ttl, dieTime)
+		self.servers = servers
+
+	def fields(self):
+		if not self.servers:
+			return {"A": unpackAddress(self.address)}
+		return {"A": unpackAddress(self.address), "servers": [unpackAddress(server) for server in self.servers]}
+
+	def addressList(self):
+		"""Every address we know, the A record first
+
+		Returns:
+			list: dotted addresses
+		"""
+		if not self.servers:
+			return [unpackAddress(self.address)]
+		return [unpackAddress(server) for server in self.servers]
+
+	def pack(self):
+		return (self.address, self.ttl, self.dieTime, self.servers)
+
+class NEGATIVE(ENTRY):
+	__slots__ = ("rcode",)
+	address = None
+
+	def __init__(self, rcode, ttl, dieTime=None):
+		"""A query that failed
+
+		Args:
+			rcode (int): 3 for NXDOMAIN, 2 for SERVFAIL
+			ttl (int): time to live in seconds
+			dieTime (int): unix time the entry dies, default = ttl seconds from now
+		"""
+		super().__init__(ttl, dieTime)
+		self.rcode = rcode
+
+	def fields(self):
+		return {"rcode": self.rcode}
+
+	def pack(self):
+		return (self.rcode, self.ttl, self.dieTime)
@@ -1,152 +1,697 @@
-import socket, json, datetime, time, os
+import socket, json, datetime, time, asyncio, random, signal, contextvars
+from multiprocessing import Process
+import dnssy
+from cache import CACHE
+from persist import CACHE_WRITER, loadSnapshot
+from counters import COUNTERS
+from logpipe import LOG_WRITER, wanted
+from codec import CODECS, negotiate, udpLimit, EDNS_UDP_SIZE
+from rtt import RTT_TABLE
+from latency import LATENCY
+from metrics import METRICS, COUNT_BUCKETS
+from stream import STREAM_PROTOCOL, STREAM_POOL, listenTcp
+from suffixindex import SUFFIX_INDEX
+from shard import HASH_RING
+from snapshot import loadCache, writeCache
+from records import unpackAddress
+from ratelimit import RATE_LIMITER, LIMIT_LABELS, SEND, SLIP, DROP, responseKind
+
+# TTL of answers from dead cache entries, as recommended by RFC 8767
+STALE_TTL = 30
+
+# [upstream queries, seconds of cache lookups, admitted to ask the servers, stub IP] of the recursion the running task belongs to, None outside of one
+RECURSION = contextvars.ContextVar("recursion", default=None)
 
 class RESOLVER():
-	def __init__(self, ip='127.0.0.10', port=53053):
+	def __init__(self, ip='127.0.0.10', port=53053, sleepSec=0, cacheEntries=10000, cacheBytes=None, negativeTTL=60, sweepSec=10, flushSec=5, journal=False, compactSec=60, counter=None, logLevel="dump", dumpSample=1.0, codec="auto", upstreamCodec="json", timeoutSec=2.0, retries=3, prefetch=0, prefetchHits=3, staleSec=0, latency=None, metricsPort=None, udpSize=EDNS_UDP_SIZE, tcp=True, upstreamTcp=False, workers=1, worker=0, shardTimeoutSec=10, rateLimit=None, maxRecursions=1000, ready=None):
 		"""Create a Resolver
 
 		Args:
 			ip (str): The IP the server should listen to in range from 127.0.0.10 to 127.0.0.100
 			port (int): The Server port, default = 53053
+			sleepSec (float): Fixed artificial delay before every sent message, short for latency={"fixedSec": sleepSec}, default = 0
+			cacheEntries (int): Maximum number of cache entries, default = 10000
+			cacheBytes (int): Rough memory budget of the cache in bytes, default = None (unlimited)
+			negativeTTL (int): Seconds we remember NXDOMAIN and SERVFAIL answers, default = 60
+			sweepSec (float): Seconds between two sweeps over expired cache entries, default = 10
+			flushSec (float): Seconds between two background writes of cache.json, default = 5
+			journal (bool): Append cache changes to cache.json.journal and only rewrite cache.json every compactSec seconds
+			compactSec (float): Seconds between two full rewrites of cache.json in journal mode, default = 60
+			counter (COUNTER): Shared message counter handed out by run.py, default = None (the resolver keeps its own)
+			logLevel (str): "dump" writes logfiles and dumps, "log" only logfiles, "off" nothing, default = "dump"
+			dumpSample (float): Share of messages that are dumped, e.g. 0.01 under load, default = 1.0
+			codec (str): Message format we accept from stubs, "json", "binary" (RFC 1035) or "auto" for both, default = "auto"
+			upstreamCodec (str): Message format we use to ask the DNS Servers, default = "json"
+			timeoutSec (float): How long we wait for a server we never asked before, afterwards its round trip times decide, default = 2.0
+			retries (int): How often a query is sent again after a timeout, to the fastest other server of the zone if it has one, default = 3
+			prefetch (float): Refresh a popular entry in the background once only this share of its TTL is left, e.g. 0.1, default = 0 (off)
+			prefetchHits (int): Lookups an entry needs since it was cached to count as popular, default = 3
+			staleSec (int): Answer from an entry up to this many seconds after it died while it is refreshed in the background (RFC 8767), default = 0 (off)
+			latency (dict): Emulated delay and loss of everything we send, in total and per server IP, see LATENCY.fromSpec(), default = None (wire speed)
+			metricsPort (int): Serve our metrics at http://IP:metricsPort/metrics, default = None (not served)
+			udpSize (int): Biggest UDP message we take from servers and send to stubs that announce they can take it (EDNS), default = 1232
+			tcp (boolean): Also answer stubs over TCP on the same IP and port, default = True
+			upstreamTcp (boolean): Ask the servers over persistent TCP connections right away, not only after a truncated answer, default = False
+			workers (int): Processes sharing IP and port via SO_REUSEPORT, every name is resolved and cached by one of them, default = 1
+			worker (int): Which of those processes we are, workers after the first get their own cache, log and dump files, default = 0
+			shardTimeoutSec (float): How long we wait for the worker a name belongs to before we resolve it ourselves, default = 10
+			rateLimit (dict): UDP responses per second per stub and response kind, and recursions per second per stub, see RATE_LIMITER.fromSpec(), default = None (no limit)
+			maxRecursions (int): Recursions waiting for servers at most, further cache misses get SERVFAIL right away, 0 = no limit, default = 1000
+			ready (multiprocessing.Queue): gets (name, seconds our start took) once we are ready to serve, default = None
 		"""
+		self.started = time.perf_counter()
+		self.ready = ready
 		self.PORT = port
 		self.IP = ip
-		self.root = ("127.0.0.11", self.PORT)
+		self.worker = worker
+		self.logName = "resolver" if not worker else "resolver-worker%d" % worker
+		# With more than one worker every name belongs to one of them, the others forward it there, so a name resolved
+		# once is a cache hit whichever worker the kernel hands the next query for it to
+		self.shards = HASH_RING(workers) if workers > 1 else None
+		# Worker n sends its upstream queries and forwards names from port + 1 + n, the shared port could hand the answers to any of us
+		self.peers = [(ip, port + 1 + n) for n in range(workers)] if self.shards else []
+		self.peerSet = set(self.peers)
+		self.shardTimeoutSec = shardTimeoutSec
+		self.forwardedQueries = 0
+		self.forwardTimeouts = 0
+		self.peerQueries = 0
+		self.logLevel = logLevel
+		self.dumpSample = dumpSample
+		self.codec = codec
+		self.upstreamCodec = CODECS[upstreamCodec]
+		self.logWriter = LOG_WRITER.get()
+		self.roots = [("127.0.0.11", self.PORT)]
+		self.rtt = RTT_TABLE(timeoutSec)
+		self.retries = retries
+		self.timeouts = 0
+		self.udpSize = udpSize
+		self.tcp = tcp
+		self.upstreamTcp = upstreamTcp
+		self.truncatedAnswers = 0
+		self.limiter = RATE_LIMITER.fromSpec(rateLimit)
+		self.maxRecursions = maxRecursions
+		# Recursions that got past the cache and wait for servers right now
+		self.recursions = 0
+		self.shedRecursions = 0
+		self.limitedRecursions = 0
+		self.cacheEntries = cacheEntries
+		self.cacheBytes = cacheBytes
+		self.negativeTTL = negativeTTL
+		self.sweepSec = sweepSec
+		self.flushSec = flushSec
+		self.journal = journal
+		self.compactSec = compactSec
+		self.staleSec = staleSec
+		self.prefetch = prefetch
+		self.prefetchHits = prefetchHits
+		# (name, type) being refreshed in the background right now
+		self.refreshing = set()
+		self.prefetches = 0
 		self.loadOrCreateCache()
+		self.counter = counter if counter is not None else COUNTERS.standalone("resolver")
 		self.sent = self.getMessages("sent")
 		self.recv = self.getMessages("recv")
-		self.sleepSec = 5
+		self.latency = LATENCY.fromSpec(latency if latency is not None else sleepSec)
+		# Upstream queries in flight, (transaction ID, server) -> future of the answer
+		self.pending = {}
+		# Recursions in flight, (name, type) -> task, stubs asking the same thing wait for the same task
+		self.inflight = {}
+		# Upstream queries in flight that end in a referral for more than one name, (servers, zone one label below the one we ask) -> future of the answer
+		self.referrals = {}
+		self.coalescedQueries = 0
+		self.coalescedReferrals = 0
 		self.bindSock()
+		self.startMetrics(metricsPort)
 		self.run()
 
 
 	def getMessages(self, message):
-		name = "resolver"
-		with open("messages.json", "r") as jsonfile:
-			data = json.load(jsonfile)
-			return data[name][message]
+		"""Current count of sent or received messages, kept in memory and saved to messages.json in the background
+
+		Args:
+			message (str): "sent" or "recv"
+
+		Returns:
+			int: the count
+		"""
+		return self.counter.get(message)
 
 	def updateMessages(self, message):
-		name = "resolver"
-		with open("messages.json", "r+") as jsonfile:
-			data = json.load(jsonfile)
-			data[name][message] += 1
-			jsonfile.seek(0)
-			json.dump(data, jsonfile, indent=4)
-			jsonfile.truncate()
+		"""Counts a sent or received message
+
+		Args:
+			message (str): "sent" or "recv"
+
+		Returns:
+			int: the new count
+		"""
+		return self.counter.increment(message)
 
 	def loadOrCreateCache(self):
-		"""Checks if we already have a cache and loads it into memory
+		"""Checks if we already have a cache and loads it into memory, then hands every change to a background writer
+
+		The snapshot we left behind when we stopped last time is restored in one go, cache.json is only parsed if
+		the snapshot is missing or doesn't hold what cache.json holds
 		"""
+		# Workers cache different names, every one keeps its own file
+		self.cachePath = 'cache.json' if not self.worker else 'cache-worker%d.json' % self.worker
+		options = {"maxEntries": self.cacheEntries, "maxBytes": self.cacheBytes, "negativeTTL": self.negativeTTL, "staleSec": self.staleSec}
+		self.cache = None
 		try:
-			with open('cache.json') as cache:
-				self.cache = json.load(cache)
-		except IOError:
-			self.cache = {}
+			self.cache = loadCache(self.cachePath, **options)
+		except ValueError as error:
+			self.log((self.IP, self.PORT), "NOT USING CACHE SNAPSHOT: " + str(error), "note")
+		if self.cache is None:
+			self.cache = CACHE(loadSnapshot(self.cachePath), **options)
+		self.writer = CACHE_WRITER(self.cachePath, self.cache.toDict(), self.flushSec, self.journal, self.compactSec)
+		self.cache.listener = self.writer.record
 
 	def bindSock(self):
 		"""Bind socket to IP and Port
 		"""
 		#SOCK_DGRAM for UDP, SOCK_STREAM for TCP
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		if self.shards:
+			# Every worker binds the same address, the kernel spreads the stubs over them
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		self.sock.bind((self.IP, self.PORT))
 		self.log((self.IP, self.PORT), 0, "BINDING SOCKET")
+		self.tcpSock = None
+		if self.tcp:
+			self.tcpSock = listenTcp(self.IP, self.PORT, self.shards is not None)
+			self.log((self.IP, self.PORT), 0, "BINDING TCP SOCKET")
+		self.peerSock = None
+		if self.shards:
+			self.peerSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			self.peerSock.bind(self.peers[self.worker])
+			self.log(self.peers[self.worker], 0, "BINDING WORKER SOCKET")
+
+	def startMetrics(self, port):
+		"""Sets up our counters and stage timings, and the HTTP endpoint that serves them
+
+		Args:
+			port (int): port of the endpoint, workers add their number, None = don't serve them
+		"""
+		self.metrics = METRICS(zone="resolver", worker=self.worker)
+		self.metrics.describe("dns_requests_total", "counter", "Stub queries received, by codec")
+		self.metrics.describe("dns_malformed_requests_total", "counter", "Datagrams that were no message we understand")
+		self.metrics.describe("dns_responses_total", "counter", "Responses sent to stubs, by rcode")
+		self.metrics.describe("dns_upstream_queries_total", "counter", "Queries sent to DNS Servers, retries included")
+		self.metrics.describe("dns_stage_seconds", "histogram", "Time spent per query in decode, lookup (cache), recursion (waiting for servers, only queries that asked one), forward (waiting for the worker a name belongs to), encode and log")
+		self.metrics.describe("dns_truncated_total", "counter", "UDP replies too big for the stub, sent truncated")
+		self.metrics.describe("dns_rate_limited_total", "counter", "UDP replies over the rate limit of their stub, dropped or sent truncated (slip), by response kind")
+		self.metrics.describe("dns_upstream_queries_per_recursion", "histogram", "Queries sent to DNS Servers per recursion, 0 = answered from the cache")
+		self.metrics.collect("dns_resolver_", self.stats, gauges=("cacheEntries", "pendingRecursions"))
+		if port is None:
+			return
+		port += self.worker
+		try:
+			self.metrics.serve(self.IP, port)
+			self.log((self.IP, port), "SERVING METRICS ON http://%s:%d/metrics" % (self.IP, port), "note")
+		except OSError as error:
+			self.log((self.IP, port), "NOT SERVING METRICS ON %s:%d: %s" % (self.IP, port, error), "note")
 
 	def run(self):
 		"""Keep server alive
 		"""
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
 		self.log((self.IP, self.PORT), 0, "WAITING FOR MSGS")
+		# Stub queries and upstream answers both arrive on this one socket, handleDatagram tells them apart
+		self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: dnssy.DNS_PROTOCOL(self), sock=self.sock))
+		if self.peerSock is not None:
+			# Upstream answers and names of other workers, handleDatagram tells them apart as well
+			self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: dnssy.DNS_PROTOCOL(self, "upstream"), sock=self.peerSock))
+		else:
+			self.upstream = self.transport
+		tcpServer = None
+		if self.tcpSock is not None:
+			tcpServer = self.loop.run_until_complete(self.loop.create_server(lambda: STREAM_PROTOCOL(self), sock=self.tcpSock))
+		# Connections to the servers, for answers that didn't fit into UDP
+		self.streams = STREAM_POOL(self.loop, self.receiveStream)
+		self.loop.call_later(self.sweepSec, self.sweepCache)
+		# Stop cleanly when run.py terminates us, so the writer gets to save the cache
+		try:
+			self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+		except (NotImplementedError, AttributeError):
+			pass
+		startupSec = time.perf_counter() - self.started
+		self.log((self.IP, self.PORT), "STARTED IN %.1f ms, %d cache entries" % (startupSec * 1e3, len(self.cache)), "note")
+		if self.ready is not None:
+			self.ready.put((self.logName, startupSec))
+		try:
+			self.loop.run_forever()
+		finally:
+			# Recursions still waiting for servers end here, not with a loop that is already closed
+			tasks = asyncio.all_tasks(self.loop)
+			for task in tasks:
+				task.cancel()
+			self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+			self.transport.close()
+			self.upstream.close()
+			if tcpServer is not None:
+				tcpServer.close()
+			self.streams.close()
+			self.loop.close()
+			self.writer.close()
+			try:
+				# cache.json is complete now, the next start restores the cache from the snapshot
+				writeCache(self.cache, self.cachePath)
+			except OSError as error:
+				self.log((self.IP, self.PORT), "NO CACHE SNAPSHOT: " + str(error), "note")
+			self.logWriter.close()
+
+	def handleDatagram(self, data, addr):
+		"""Sorts incoming datagrams: answers wake up the recursion waiting for them, queries start a new recursion
+
+		Args:
+			data (bytes): The received datagram
+			addr (tuple): Information about the sender
+		"""
+		start = time.perf_counter()
+		try:
+			codec, message = negotiate(data)
+		except ValueError:
+			# Not a message we understand, nobody to answer
+			self.metrics.count("dns_malformed_requests_total")
+			return
+		self.metrics.observe("dns_stage_seconds", time.perf_counter() - start, dnssy.STAGES["decode"])
+		if message.get("dns.flags.response") == 1:
+			self.receive(message, addr)
+		elif addr in self.peerSet:
+			self.loop.create_task(self.answerPeer(codec, message, addr))
+		# Stubs have to speak the codec we accept, servers answer in whatever we asked them in
+		elif self.codec == "auto" or codec.name == self.codec:
+			self.loop.create_task(self.answer(data, codec, message, addr))
+
+	def handleStream(self, data, addr, send):
+		"""Starts the recursion for a stub query that came in over TCP
+
+		Args:
+			data (bytes): The received message, without its length
+			addr (tuple): Information about the stub
+			send (callable): sends the answer back over the connection
+		"""
+		try:
+			codec, message = negotiate(data, self.codec)
+		except ValueError:
+			self.metrics.count("dns_malformed_requests_total")
+			return
+		if message.get("dns.flags.response") != 1:
+			self.loop.create_task(self.answer(data, codec, message, addr, send))
+
+	def receiveStream(self, data, server):
+		"""Takes an answer that came in over a pooled TCP connection to a server
+
+		Args:
+			data (bytes): The message, without its length
+			server (tuple): the server of the connection
+		"""
+		try:
+			codec, message = negotiate(data)
+		except ValueError:
+			return
+		if message.get("dns.flags.response") == 1:
+			self.receive(message, server)
+
+	async def answer(self, data, codec, query, addr, send=None):
+		"""Resolves a single stub query, while other queries keep being served
+
+		Args:
+			data (bytes): The received datagram
+			codec (JSON_CODEC or BINARY_CODEC): the codec the stub asked in
+			query (dict): The decoded query
+			addr (tuple): Information about the stub
+			send (callable): sends the answer over TCP, default = None (UDP)
+		"""
+		self.metrics.count("dns_requests_total", dnssy.CODEC_LABELS[codec.name])
+		start = time.perf_counter()
+		self.log(addr, query, "recv")
+		if self.dumping():
+			self.dump(addr, codec.text(data, query), "recv")
+		logSec = time.perf_counter() - start
+		result = await self.resolve(query, addr[0])
+		plain = codec.name == "json" and "dns.id" not in query
+		action = SEND
+		if send is None and self.limiter.active:
+			kind = responseKind(result)
+			action = self.limiter.check(addr[0], kind)
+			if action == SLIP and plain:
+				# Plain text stubs can't be told to come back over TCP
+				action = DROP
+			if action != SEND:
+				self.metrics.count("dns_rate_limited_total", LIMIT_LABELS[(action, kind)])
+				if action == DROP:
+					return
+
+		# The stub doesn't need anything except why it's query has failed or the right answer
+		start = time.perf_counter()
+		response = self.resultString(result)
+		#Send response to sender, JSON stubs get the plain text, binary ones and JSON ones with a transaction ID a real DNS answer
+		if plain:
+			data = response.encode('utf-8')
+		elif action == SLIP:
+			# Over the limit, a real stub asks again over TCP
+			data = codec.encode(self.truncate(self.buildReply(query, result)))
+		else:
+			reply = self.buildReply(query, result)
+			data = codec.encode(reply)
+			if send is None and len(data) > udpLimit(query, self.udpSize):
+				# Too big for the stub's buffer, it has to ask again over TCP
+				data = codec.encode(self.truncate(reply))
+				self.metrics.count("dns_truncated_total")
+		encoded = time.perf_counter()
+		self.log(addr, 0, response)
+		if self.dumping():
+			self.dump(addr, 0, response)
+		self.metrics.observe("dns_stage_seconds", encoded - start, dnssy.STAGES["encode"])
+		self.metrics.observe("dns_stage_seconds", logSec + time.perf_counter() - encoded, dnssy.STAGES["log"])
+		self.metrics.count("dns_responses_total", dnssy.rcodeLabels(result["dns.flags.rcode"]))
+		if send is None:
+			self.latency.send(self.loop, self.transport, data, addr)
+		else:
+			# TCP retransmits what the network loses, that only costs time
+			self.loop.call_later(self.latency.delay(addr) or 0, send, data)
+
+	async def resolve(self, query, client=None):
+		"""Resolves a query, if the same name and type is resolved right now we wait for that recursion instead of starting another
+
+		Args:
+			query (dict): decoded query
+			client (str): IP of the stub, a recursion we start for it is charged to its bucket, default = None (nobody's)
+
+		Returns:
+			dict: the final answer or error, see getResponse()
+		"""
+		key = (query["dns.qry.name"], query["dns.qry.type"])
+		task = self.inflight.get(key)
+		if task is None:
+			owner = self.shards.owner(key[0]) if self.shards else self.worker
+			task = self.inflight[key] = self.loop.create_task(self.recurse(query, client=client) if owner == self.worker else self.forward(query, owner, client))
+			task.add_done_callback(lambda done: self.inflight.pop(key, None))
+		else:
+			self.coalescedQueries += 1
+		# A waiting stub that goes away must not cancel the recursion for the others
+		return await asyncio.shield(task)
+
+	async def forward(self, query, owner, client=None):
+		"""Gets the result of a query from the worker its name belongs to, from that worker's cache or recursion
+
+		Args:
+			query (dict): decoded query
+			owner (int): number of the worker
+			client (str): IP of the stub, the owner charges its recursion to it, default = None
+
+		Returns:
+			dict: the final answer or error, see getResponse()
+		"""
+		peer = self.peers[owner]
+		ident = self.newId(peer)
+		future = self.loop.create_future()
+		self.pending[(ident, peer)] = future
+		self.forwardedQueries += 1
+		start = time.perf_counter()
+		message = {"dns.id": ident, "dns.flags.response": 0, "dns.flags.recdesired": 1, "dns.qry.name": query["dns.qry.name"], "dns.qry.type": query["dns.qry.type"]}
+		if client is not None:
+			# Only our JSON messages carry it, binary ones leave it out
+			message["dns.client"] = client
+		try:
+			# Both of us run on this host, no emulated latency in between
+			self.upstream.sendto(self.upstreamCodec.encode(message), peer)
+			result = await asyncio.wait_for(future, self.shardTimeoutSec)
+		except asyncio.TimeoutError:
+			# The owner is gone or stuck, a recursion of our own is slower than its cache but better than nothing
+			self.forwardTimeouts += 1
+			self.log(peer, {"timeout": self.shardTimeoutSec, "dns.qry.name": query["dns.qry.name"]}, "timeout")
+			return await self.recurse(query, client=client)
+		finally:
+			self.pending.pop((ident, peer), None)
+		self.metrics.observe("dns_stage_seconds", time.perf_counter() - start, dnssy.STAGES["forward"])
+		return result
+
+	async def answerPeer(self, codec, query, addr):
+		"""Resolves a name another worker forwarded to us, because it belongs to us
+
+		Args:
+			codec (JSON_CODEC or BINARY_CODEC): the codec the worker asked in
+			query (dict): The decoded query
+			addr (tuple): the worker socket of the other worker
+		"""
+		self.peerQueries += 1
+		result = await self.resolve(query, query.get("dns.client"))
+		self.upstream.sendto(codec.encode(self.buildReply(query, result)), addr)
+
+	def resultString(self, result):
+		"""Turns the result of a recursion into the text we always sent to our stub
+
+		Args:
+			result (dict): the final answer
+
+		Returns:
+			str: either returns errorstring or A record
+		"""
+		if result["dns.flags.rcode"] != 0:
+			return self.errorString(result["dns.flags.rcode"])
+		return result["dns.a"]
+
+	def buildReply(self, query, result):
+		"""Builds the response message for the stub from the result of a recursion
+
+		Args:
+			query (dict): the stub query
+			result (dict): the final answer
+
+		Returns:
+			dict: response for the stub
+		"""
+		reply = {
+			"dns.id": query.get("dns.id", 0),
+			"dns.flags.response": 1,
+			"dns.flags.recavail": 1,
+			"dns.flags.authoritative": 0,
+			"dns.qry.name": query["dns.qry.name"],
+			"dns.qry.type": query["dns.qry.type"],
+			"dns.flags.rcode": result["dns.flags.rcode"],
+			"dns.count.answers": 0}
+		if result["dns.flags.rcode"] == 0:
+			reply.update({"dns.count.answers": 1, "dns.ns": result["dns.ns"], "dns.a": result["dns.a"], "dns.resp.ttl": result["dns.resp.ttl"]})
+		if "dns.edns.udpsize" in query:
+			reply["dns.edns.udpsize"] = self.udpSize
+		return reply
+
+	@staticmethod
+	def truncate(reply):
+		"""Cuts a reply down to header and question, with the truncated flag set
+
+		Args:
+			reply (dict): the reply from buildReply()
+
+		Returns:
+			dict: the truncated reply
+		"""
+		keep = ("dns.id", "dns.flags.response", "dns.flags.recavail", "dns.flags.authoritative", "dns.qry.name", "dns.qry.type", "dns.flags.rcode", "dns.edns.udpsize")
+		truncated = {key: reply[key] for key in keep if key in reply}
+		truncated.update({"dns.flags.truncated": 1, "dns.count.answers": 0})
+		return truncated
+
+	def newId(self, server):
+		"""Picks a transaction ID that isn't in flight to the server yet
+
+		Args:
+			server (tuple): server information
+
+		Returns:
+			int: 16 bit transaction ID
+		"""
 		while 1:
-			# Receive 512 bytes Max as per IETF standard, also receive address
-			data, addr = self.sock.recvfrom(512)
-			self.log(addr, json.loads(data.decode('utf-8')), "recv")
-			self.dump(addr, data.decode('utf-8'), "recv")
-			response = self.getResponse(data, self.root)
-
-			# Check if answer is error or IP, because the stub doesn't need anything except why it's query has failed or the right answer
-			if(response.startswith("Error") or response.startswith('127.')):
-				self.log(addr, 0, response)
-				self.dump(addr, 0, response)
-			else:
-				self.log(addr, json.loads(response), "send")
-				self.dump(addr, response, "send")
+			ident = random.randrange(65536)
+			if (ident, server) not in self.pending:
+				return ident
 
-			#Send response to sender
-			time.sleep(self.sleepSec)
+	async def ask(self, message, servers):
+		"""Asks the fastest server of a zone, after a timeout the next fastest one, until retries run out
 
-			#If sender timed out
-			try:
-				self.sock.sendto(response.encode('utf-8'), addr)
-			except ConnectionError:
-				continue
+		Args:
+			message (dict): the query
+			servers (list): all servers of the zone
 
-	def send(self, message, server):
-		"""Sends a message to a server
+		Returns:
+			dict: the decoded answer or None if nobody answered in time
+		"""
+		tried = set()
+		for attempt in range(self.retries + 1):
+			server = self.rtt.pick(servers, tried)
+			timeout = self.rtt.timeout(server)
+			try:
+				answer = await self.send(message, server, timeout, self.upstreamTcp)
+				if answer.get("dns.flags.truncated"):
+					# Didn't fit into UDP, the whole answer comes over our connection to the server
+					self.truncatedAnswers += 1
+					answer = await self.send(message, server, timeout, True)
+				return answer
+			except (asyncio.TimeoutError, OSError):
+				# Asking the same server again waits twice as long
+				self.rtt.timedOut(server)
+				self.timeouts += 1
+				tried.add(server)
+				self.log(server, {"timeout": timeout, "dns.qry.name": message["dns.qry.name"]}, "timeout")
+		return None
+
+	async def send(self, message, server, timeout=None, tcp=False):
+		"""Sends a message to a server and waits for the answer without blocking other recursions
 
 		Args:
-			message (str): the encoded message
+			message (dict): the query
 			server (tuple): server information
+			timeout (float): seconds we wait for the answer, default = None (forever)
+			tcp (boolean): Send it over our pooled connection to the server instead of UDP, default = False
+
+		Returns:
+			dict: the decoded answer
+
+		Raises:
+			asyncio.TimeoutError: no answer in time
+			OSError: the server doesn't take TCP connections
+		"""
+		ident = self.newId(server)
+		message["dns.id"] = ident
+		# Tell the server how big an answer we take over UDP
+		message["dns.edns.udpsize"] = self.udpSize
+		future = self.loop.create_future()
+		self.pending[(ident, server)] = future
+		self.log(server, message, "ask")
+		self.metrics.count("dns_upstream_queries_total")
+		record = RECURSION.get()
+		if record is not None:
+			record[0] += 1
+		data = self.upstreamCodec.encode(message)
+		start = self.loop.time()
+		try:
+			if tcp:
+				# Connecting counts into the timeout, the connection stays open for the next queries to this server
+				await asyncio.wait_for(self.streams.send(server, data), timeout)
+				timeout = None if timeout is None else max(0, timeout - (self.loop.time() - start))
+			else:
+				# A lost query simply never gets an answer, the timeout takes care of it
+				self.latency.send(self.loop, self.upstream, data, server)
+			answer = await asyncio.wait_for(future, timeout)
+			self.rtt.measured(server, self.loop.time() - start)
+			return answer
+		finally:
+			self.pending.pop((ident, server), None)
+
+	def receive(self, message, addr):
+		"""Routes an upstream answer to the recursion waiting for it, by transaction ID and sender address
+
+		Args:
+			message (dict): the decoded answer
+			addr (tuple): Information about the sender
+		"""
+		future = self.pending.pop((message.get("dns.id"), addr), None)
+		# Late, duplicated or spoofed answer, nobody is waiting for it
+		if future is None or future.done():
+			return
+		self.log(addr, message, "recv")
+		future.set_result(message)
+
+	def sweepCache(self):
+		"""Drops expired cache entries every sweepSec seconds, even if nobody asks for them anymore, and logs our stats
+		"""
+		self.cache.sweep()
+		self.log((self.IP, self.PORT), self.stats(), "stats")
+		self.loop.call_later(self.sweepSec, self.sweepCache)
+
+	def stats(self):
+		"""What the resolver did since it started
+
+		Returns:
+			dict: counter name -> value
 		"""
-		time.sleep(self.sleepSec)
-		self.log(server, json.loads(message.decode('utf-8')), "ask")
-		self.sock.sendto(message, server)
-		
-	def listen(self):
-		"""Listens for incoming messages
+		return {
+			"cacheEntries": len(self.cache),
+			"cacheHits": self.cache.hits,
+			"cacheMisses": self.cache.misses,
+			"cacheEvictions": self.cache.evictions,
+			"cacheExpired": self.cache.expired,
+			"staleAnswers": self.cache.staleHits,
+			"prefetches": self.prefetches,
+			"timeouts": self.timeouts,
+			"coalescedQueries": self.coalescedQueries,
+			"coalescedReferrals": self.coalescedReferrals,
+			"emulatedLosses": self.latency.dropped,
+			"truncatedAnswers": self.truncatedAnswers,
+			"tcpConnections": self.streams.opened,
+			"forwardedQueries": self.forwardedQueries,
+			"forwardTimeouts": self.forwardTimeouts,
+			"peerQueries": self.peerQueries,
+			"pendingRecursions": self.recursions,
+			"shedRecursions": self.shedRecursions,
+			"limitedRecursions": self.limitedRecursions,
+			"rateLimitDrops": self.limiter.dropped,
+			"rateLimitSlips": self.limiter.slipped}
+
+	@staticmethod
+	def zoneBelow(domain, zone):
+		"""The zone one label below the zone we ask, on the way to the domain
+
+		Args:
+			domain (str): e.g. www.switch.telematik.
+			zone (str): e.g. telematik. or "" for the root
 
 		Returns:
-			list: returns list containing encoded datastring and sender address
+			str: e.g. switch.telematik.
 		"""
-		data, addr = self.sock.recvfrom(512)
-		self.log(addr, json.loads(data.decode('utf-8')), "recv")
+		labels = SUFFIX_INDEX.labels(domain)[:len(SUFFIX_INDEX.labels(zone)) + 1]
+		return ".".join(reversed(labels)) + "."
 
-		return [data, addr]
+	@staticmethod
+	def isSuffix(zone, domain):
+		labels = SUFFIX_INDEX.labels(zone)
+		return SUFFIX_INDEX.labels(domain)[:len(labels)] == labels
 
-	def overwriteCache(self, newContent):
-		"""Because of lazyness we don't update the cache, but rather delete everything inside and write the new content into it
+	async def askShared(self, message, servers, zone):
+		"""Asks the servers of a zone, unless an upstream query to them for the same zone below is already in flight
+
+		A thousand stubs asking for different names in telematik. with a cold cache need one referral to telematik.,
+		not a thousand. The waiting recursions take the referral if it leads towards their name, everything else
+		(answers, errors, referrals to other zones) they have to ask for themselves
 
 		Args:
-			newContent (dict): new cache content
+			message (dict): the query
+			servers (list): all servers of the zone
+			zone (str): the zone the servers serve, "" for the root
+
+		Returns:
+			dict: the decoded answer or None if nobody answered in time
 		"""
-		with open("cache.json", "w") as cache:
-			cache.write(json.dumps(newContent, indent=4))
+		key = (tuple(sorted(servers)), self.zoneBelow(message["dns.qry.name"], zone))
+		shared = self.referrals.get(key)
+		if shared is not None:
+			data = await asyncio.shield(shared)
+			# A referral to the name itself is no use, the name is answered by the zone above it
+			if data is not None and "dns.count_auth_rr" in data and data["dns.ns"] != message["dns.qry.name"] and self.isSuffix(data["dns.ns"], message["dns.qry.name"]):
+				self.coalescedReferrals += 1
+				return data
+			return await self.ask(message, servers)
+		shared = self.referrals[key] = self.loop.create_future()
+		data = None
+		try:
+			data = await self.ask(message, servers)
+			return data
+		finally:
+			self.referrals.pop(key, None)
+			shared.set_result(data)
 
 	def checkCache(self, domain):
-		"""Searches Cache for biggest suffix possible
+		"""Searches the cached delegations for the biggest zone of the domain
 
 		Args:
 			domain (str): string of the request
 
 		Returns:
-			tuple: contains biggest Suffix and A record or is None, if cache doesn't have request
-		"""
-		#Suffix matching
-		domain = self.biggestSuffix(domain)
-
-		# We don't have a suffix in our cache
-		if domain == "":
-			return None
-		
-		# Entry still has time to live
-		if self.cache[domain]["dieTime"] > int(time.time()):
-			return (domain, self.cache[domain]["A"])
-
-		# Entry would be old about right now (edge case, let's say it's okay to return the entry)
-		#Deletes cache entry and returns the deleted one
-		elif self.cache[domain]["dieTime"] == int(time.time()):
-			temp = self.cache[domain]
-			self.cache.pop(domain)
-			self.overwriteCache(self.cache)
-			return (domain, temp["A"])
-
-		# The entry we found is too old. Deletes entry and returns
-		elif self.cache[domain]["dieTime"] < int(time.time()):
-			self.cache.pop(domain)
-			self.overwriteCache(self.cache)
-			return None
-		
-		# If this ever happens, something probably went wrong
-		else: 
-			return None
+			tuple: contains biggest zone and the A record of its server or is None, if cache doesn't know any
+		"""
+		return self.cache.lookupDelegation(domain)
 	
 	def biggestSuffix(self, domain):
 		"""Looks through zones to find the biggest redirect we can give
@@ -157,107 +702,196 @@ class RESOLVER():
 		Returns:
 			str: Name of the longest suffix we can answer from domain
 		"""
-		biggestCache = ""
-		for cache in self.cache:
-			if cache in domain and len(cache) > len(biggestCache):
-				biggestCache = cache
-		return biggestCache
+		return self.cache.longestSuffix(domain)
 
-	def getResponse(self, data, server):
-		"""Recursively queries servers until it gets an error or a response
+	def errorString(self, rcode):
+		"""Explains an rcode to the stub
 
 		Args:
-			data (str): encoded json data string
-			server (tuple): server information
+			rcode (int): 2 or 3
 
 		Returns:
-			str: either returns errorstring or A record
+			str: the error message
 		"""
-		data = json.loads(data.decode('utf-8'))
+		if rcode == 2:
+			return "Error " + str(rcode) + " Server failure - The name server was unable to process this query due to a problem with the name server"
+		return "Error " + str(rcode) + " Name Error - The server seems to understand your query, but refuses to answer it or it doesn't have any entries for your query"
 
-		# Check cache. Immediately return the result if we have it cached. Or query already cached subserver
-		cacheCheck = self.checkCache(data["dns.qry.name"])
-		if(cacheCheck is not None and cacheCheck[0] == data["dns.qry.name"]):
-			return cacheCheck[1]
-		elif(cacheCheck is not None): 
-			server = (cacheCheck[1], self.PORT)
+	def refresh(self, query):
+		"""Resolves a cached name again in the background, the stubs keep getting the cached entry meanwhile
 
-		# Ask cached server or root
-		try:
-			self.send(json.dumps(data,indent=4).encode('utf-8'), server)
-		except ConnectionError:
-			return "Error your requested domain does not exist"
-		data, addr = self.listen()
-		data = json.loads(data.decode('utf-8'))
-
-		# Cache result
-		if "dns.ns" in data and "dns.resp.ttl" in data:
-			dieTime = int(time.time() + data["dns.resp.ttl"])
-			newServer = {"A": data["dns.a"], "TTL": data["dns.resp.ttl"], "dieTime": dieTime, "dieTimeHR":  time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(dieTime))}
-			self.cache[data["dns.ns"]] = newServer
-			self.overwriteCache(self.cache)
+		Args:
+			query (dict): decoded query
+		"""
+		key = (query["dns.qry.name"], query["dns.qry.type"])
+		if key in self.refreshing:
+			return
+		self.refreshing.add(key)
+		self.prefetches += 1
+		task = self.loop.create_task(self.recurse({"dns.qry.name": key[0], "dns.qry.type": key[1]}, fresh=True))
+		task.add_done_callback(lambda done: self.refreshing.discard(key))
 
-	
-		# Could also be done with "dns.count_auth_rr" in data, but I forgot about basic python syntax
+	async def recurse(self, query, fresh=False, client=None):
+		"""Runs one recursion from the root, in a task of its own, and records its stage times and upstream queries
+
+		Args:
+			query (dict): decoded query
+			fresh (bool): Ignore the cached answer of the query, see getResponse()
+			client (str): IP of the stub we resolve it for, default = None
+
+		Returns:
+			dict: the final answer or error, see getResponse()
+		"""
+		# Tasks get a copy of the context, everything this recursion awaits adds to this record and nothing else does
+		record = [0, 0.0, False, client]
+		RECURSION.set(record)
+		start = time.perf_counter()
 		try:
-			# we have a reroute
-			data["dns.count_auth_rr"]
-			#static data for requests
-			exampleData = json.dumps({"dns.flags.response": 0, "dns.flags.recdesired": 1, "dns.qry.name": data["dns.qry.name"], "dns.qry.type": data["dns.qry.type"]}, indent=4)
-		
+			result = await self.getResponse(query, self.roots, fresh=fresh)
+		finally:
+			if record[2]:
+				self.recursions -= 1
+		self.metrics.observe("dns_stage_seconds", record[1], dnssy.STAGES["lookup"])
+		if record[0]:
+			self.metrics.observe("dns_stage_seconds", time.perf_counter() - start - record[1], dnssy.STAGES["recursion"])
+		self.metrics.observe("dns_upstream_queries_per_recursion", record[0], buckets=COUNT_BUCKETS)
+		return result
+
+	async def getResponse(self, query, servers, zone="", fresh=False):
+		"""Recursively queries servers until it gets an error or a response
+
+		Args:
+			query (dict): decoded query
+			servers (list): server information of every server of the zone we ask
+			zone (str): the zone these servers serve, default = "" (the root)
+			fresh (bool): Ignore the cached answer of the query, for refreshing it, default = False
+
+		Returns:
+			dict: the final answer or error, at least with dns.flags.rcode and for answers dns.ns, dns.a and dns.resp.ttl
+		"""
+		name = query["dns.qry.name"]
+		qtype = query["dns.qry.type"]
+		start = time.perf_counter()
+		if not fresh:
+			entry = self.cache.lookupEntry(name, qtype)
+			# Queries that failed recently fail again, without asking anyone
+			if entry is not None and entry.rcode is not None:
+				self.lookupTime(start)
+				return {"dns.flags.rcode": entry.rcode}
+			# Queries that were answered recently get the same answer, without asking anyone
+			if entry is not None:
+				if self.prefetch and self.cache.prefetchDue(name, qtype, self.prefetch, self.prefetchHits):
+					self.refresh(query)
+				self.lookupTime(start)
+				return {"dns.flags.rcode": 0, "dns.ns": name, "dns.a": unpackAddress(entry.address), "dns.resp.ttl": self.cache.remainingTTL(self.cache.answerKey(name, qtype))}
+			stale = self.cache.lookupStale(name, qtype) if self.staleSec else None
+			if stale is not None:
+				# Dead but not for long, answer with it and get a fresh one for the next stub
+				self.refresh(query)
+				self.lookupTime(start)
+				return {"dns.flags.rcode": 0, "dns.ns": name, "dns.a": stale, "dns.resp.ttl": STALE_TTL}
+
+		# Skip down to the deepest zone we know servers of. A name is answered by the zone above it, not by its own server
+		cacheCheck = self.checkCache(name.partition(".")[2])
+		if(cacheCheck is not None and len(cacheCheck[0]) > len(zone)):
+			servers = [(address, self.PORT) for address in self.cache.servers(cacheCheck[0])]
+			zone = cacheCheck[0]
+		self.lookupTime(start)
+		if not self.admit():
+			# Not cached, there may be room for the next stub asking
+			return {"dns.flags.rcode": 2}
+
+		# Ask cached server or root
+		data = await self.askShared({"dns.flags.response": 0, "dns.flags.recdesired": 1, "dns.qry.name": name, "dns.qry.type": qtype}, servers, zone)
+		if data is None:
+			# Every server of the zone timed out, that's a server failure. Not cached, they might be back for the next query
+			return {"dns.flags.rcode": 2}
+
+		# we have a reroute, remember the zone so the next query for a name in it can start there
+		if "dns.count_auth_rr" in data:
+			self.cache.putDelegation(data["dns.ns"], data["dns.a"], data["dns.resp.ttl"], data.get("dns.auth.a"))
 			# Let's just say every server has the same port
-			return self.getResponse(exampleData.encode('utf-8'), (data["dns.a"], self.PORT))
-		except KeyError:
-			# We got an answer or an error
-			
-			# Error handling
-			if data["dns.flags.rcode"] == 2:
-				return "Error " + str(data["dns.flags.rcode"]) + " Server failure - The name server was unable to process this query due to a problem with the name server"
-			elif data["dns.flags.rcode"] == 3:
-				return "Error " + str(data["dns.flags.rcode"]) + " Name Error - The server seems to understand your query, but refuses to answer it or it doesn't have any entries for your query"
-			else:
-				# Actual result
-				return data["dns.a"]
+			return await self.getResponse(query, [(address, self.PORT) for address in data.get("dns.auth.a", [data["dns.a"]])], data["dns.ns"], fresh)
+
+		# We got an answer or an error, remember it so the next stub asking for it doesn't cause a recursion
+		if data["dns.flags.rcode"] == 0 and "dns.a" in data:
+			self.cache.putAnswer(name, qtype, data["dns.a"], data["dns.resp.ttl"])
+		elif data["dns.flags.rcode"] in (2, 3):
+			self.cache.putNegative(name, qtype, data["dns.flags.rcode"])
+		# Actual result or error
+		return data
+
+	def admit(self):
+		"""Lets the running recursion ask the servers, decided once when it first misses the cache
+
+		Recursions waiting for servers are bounded by maxRecursions and every stub has a bucket of them, so a flood of
+		names nobody asked before gets SERVFAIL right away instead of making every stub wait longer and longer
+
+		Returns:
+			bool: go ahead, False = answer SERVFAIL
+		"""
+		record = RECURSION.get()
+		if record is None or record[2]:
+			return True
+		if self.maxRecursions and self.recursions >= self.maxRecursions:
+			self.shedRecursions += 1
+			return False
+		if record[3] is not None and not self.limiter.allow(record[3], "recursion"):
+			self.limitedRecursions += 1
+			return False
+		record[2] = True
+		self.recursions += 1
+		return True
+
+	@staticmethod
+	def lookupTime(start):
+		"""Adds the time since start to the cache lookups of the running recursion
+
+		Args:
+			start (float): time.perf_counter() when the lookups began
+		"""
+		record = RECURSION.get()
+		if record is not None:
+			record[1] += time.perf_counter() - start
 
 	def log(self, addr, data, logtype):
 		"""Look into dnssy.py for explanation
 		"""
 		typeString = ""
 		if(logtype == "recv"):
-			self.recv += 1
-			self.updateMessages("recv")
+			self.recv = self.updateMessages("recv")
 			typeString = "Request received for name " + data["dns.qry.name"] + " from " + str(addr) + " [RECEIVED MESSAGE #" + str(self.sent) + "]"
 		elif(logtype == "send"):
-			self.sent += 1
-			self.updateMessages("sent")
+			self.sent = self.updateMessages("sent")
 			typeString = "Sending answer " + data["dns.a"] + " for " + data["dns.ns"] + " to " + str(addr) + " [SENT MESSAGE #" + str(self.sent) + "]"
 		elif(logtype == "ask"):
-			self.sent += 1
-			self.updateMessages("sent")
+			self.sent = self.updateMessages("sent")
 			typeString = "Sending request for " + data["dns.qry.name"]  + " to " + str(addr) + " [SENT MESSAGE #" + str(self.sent) + "]"
 		elif(logtype == "error"):
-			self.sent += 1
-			self.updateMessages("sent")
+			self.sent = self.updateMessages("sent")
 			typeString = "Sending error " + str(data["dns.flags.rcode"]) + " to " + str(addr) + " [SENT MESSAGE #" + str(self.sent) + "]"
+		elif(logtype == "stats"):
+			typeString = "STATS " + json.dumps(data)
+		elif(logtype == "note"):
+			typeString = data
+		elif(logtype == "timeout"):
+			# Nothing was sent or received, nothing to count
+			typeString = "No answer from " + str(addr) + " for " + data["dns.qry.name"] + " within " + str(round(data["timeout"], 3)) + "s [TIMEOUT #" + str(self.timeouts) + "]"
 		else:
-			self.sent += 1
-			self.updateMessages("sent")
+			self.sent = self.updateMessages("sent")
 			typeString = "Sending " + logtype + " as answer to " + str(addr) + " [SENT MESSAGE #" + str(self.sent) + "]"
 
+		if not wanted(self.logLevel, "log"):
+			return
+
 		logString = str(datetime.datetime.now()) + " | RESOLVER | " + typeString + "\n"
-		
-		if not os.path.exists('logfiles'):
-			os.makedirs('logfiles')
-		name = "resolver"
-		try:
-		
-			with open('logfiles/%s.log' % name, "a") as logfile:
-				logfile.write(logString)
-				
-		except IOError:
-			with open('logfiles/%s' % name, "w+") as logfile:
-				logfile.write(logString)
-		
+		self.logWriter.write('logfiles/%s.log' % self.logName, logString)
+
+	def dumping(self):
+		"""refer to dnssy.py -> self.dumping()
+		"""
+		return wanted(self.logLevel, "dump", self.dumpSample)
+
 	def dump(self, addr, data, dumptype):
 		"""refer to dnssy.py -> self.log()
 		"""
@@ -270,15 +904,22 @@ class RESOLVER():
 			typeString = "SENDING MSG " + dumptype + " to " + str(addr)
 
 		dumpString = str(datetime.datetime.now()) + " | RESOLVER | " + typeString + "\n \n"
-		
-		if not os.path.exists('dumps'):
-			os.makedirs('dumps')
-		name = "resolver"
-		try:
-		
-			with open('dumps/%s.dump' % name, "a") as dumpfile:
-				dumpfile.write(dumpString)
-				
-		except IOError:
-			with open('dumps/%s' % name, "w+") as dumpfile:
-				dumpfile.write(dumpString)
\ No newline at end of file
+		self.logWriter.write('dumps/%s.dump' % self.logName, dumpString)
+
+def startResolver(workers=1, counter=None, **options):
+	"""Starts the worker processes of the resolver
+
+	Args:
+		workers (int): Number of processes, only platforms with SO_REUSEPORT get more than one, default = 1
+		counter (COUNTER): message counter of the resolver, shared by all workers, default = None
+		options: passed on to every RESOLVER
+
+	Returns:
+		list: the started processes
+	"""
+	if not hasattr(socket, "SO_REUSEPORT"):
+		workers = 1
+	processes = [Process(target=RESOLVER, kwargs=dict(options, counter=counter, workers=workers, worker=worker)) for worker in range(workers)]
+	for process in processes:
+		process.start()
+	return processes
@@ -0,0 +1,81 @@
+import random
+
+class RTT_TABLE():
+	def __init__(self, timeoutSec=2.0, minTimeoutSec=0.05, maxTimeoutSec=30.0, decay=0.98):
+		"""Round trip times of every server we asked, to pick the fastest one and to know how long to wait for it
+
+		Follows RFC 6298: SRTT and RTTVAR are moving averages of the samples and a server gets RTO = SRTT + 4 * RTTVAR
+		to answer. Every timeout doubles the RTO of the server until it answers again, and servers are picked by RTO,
+		so a server that stops answering is asked last
+
+		Args:
+			timeoutSec (float): Timeout for a server we never asked, default = 2.0
+			minTimeoutSec (float): Even a fast server gets at least this long, default = 0.05
+			maxTimeoutSec (float): The RTO never grows beyond this, default = 30.0
+			decay (float): Backed off servers we don't pick lose a bit of their backoff each time, so they get another chance eventually, default = 0.98
+		"""
+		self.timeoutSec = timeoutSec
+		self.minTimeoutSec = minTimeoutSec
+		self.maxTimeoutSec = maxTimeoutSec
+		self.decay = decay
+		# server -> [srtt, rttvar, rto] in seconds, srtt is None until the first answer
+		self.times = {}
+
+	def timeout(self, server):
+		"""How long we wait for the server before we ask again
+
+		Args:
+			server (tuple): server information
+
+		Returns:
+			float: seconds
+		"""
+		known = self.times.get(server)
+		return known[2] if known is not None else self.timeoutSec
+
+	def pick(self, servers, tried=()):
+		"""Picks the server with the smallest RTO, servers we never asked go first so every one gets measured
+
+		Args:
+			servers (list): servers of the zone
+			tried (collection): servers that already failed for this query, they only get picked if there is nobody else
+
+		Returns:
+			tuple: the server
+		"""
+		candidates = [server for server in servers if server not in tried] or list(servers)
+		# Shuffle first, so servers with equal times share the load
+		random.shuffle(candidates)
+		best = min(candidates, key=lambda server: self.times[server][2] if server in self.times else 0)
+		for server in servers:
+			known = self.times.get(server)
+			if server != best and known is not None and known[0] is not None:
+				known[2] = max(self.rto(known), known[2] * self.decay)
+		return best
+
+	def rto(self, known):
+		return min(self.maxTimeoutSec, max(self.minTimeoutSec, known[0] + 4 * known[1]))
+
+	def measured(self, server, rtt):
+		"""Takes in a round trip time, this also ends the backoff of the server
+
+		Args:
+			server (tuple): server information
+			rtt (float): seconds from sending the query to receiving the answer
+		"""
+		known = self.times.get(server)
+		if known is None or known[0] is None:
+			known = self.times[server] = [rtt, rtt / 2, 0]
+		else:
+			known[1] = 0.75 * known[1] + 0.25 * abs(known[0] - rtt)
+			known[0] = 0.875 * known[0] + 0.125 * rtt
+		known[2] = self.rto(known)
+
+	def timedOut(self, server):
+		"""The server didn't answer in time, we wait twice as long next time and ask the other servers first
+
+		Args:
+			server (tuple): server information
+		"""
+		known = self.times.setdefault(server, [None, None, self.timeoutSec])
+		known[2] = min(self.maxTimeoutSec, known[2] * 2)
@@ -1,36 +1,112 @@
-from multiprocessing import Process
-import dnssy, resolve, os
+from multiprocessing import Process, Queue
+from counters import COUNTERS
+import dnssy, resolve, host, os, queue, time
 
 
 #This probably could've been done prettier, but "what the user doesn't see, can be spaghett-ee"
 
-def createServer(ip, name, auth):
-	dnssy.DNS_SERVER(ip, name, auth)
-
-def resolver():
-	resolve.RESOLVER()
+def createServer(ip, name, auth, mode="sync", counter=None, **options):
+	dnssy.DNS_SERVER(ip, name, auth, mode=mode, counter=counter, **options)
 
 def window():
 	os.system("start python stubby.py")
 
+# Zones served by event loop hosts: host -> (worker processes, [(ip, zone, authoritative), ...])
+# All zones of a host share one process and one event loop. A host with more than one worker runs in that many processes,
+# which share the IPs via SO_REUSEPORT, so the busy root and top level zones get more cores than the idle leaves
+HOSTS = {
+	"root": (4, [("127.0.0.11", "ROOT", False)]),
+	"tld": (2, [("127.0.0.12", "telematik.", False), ("127.0.0.19", "fuberlin.", False)]),
+	"leaves": (1, [("127.0.0.20", "homework.fuberlin.", True), ("127.0.0.23", "pcpools.fuberlin.", True), ("127.0.0.16", "router.telematik.", True), ("127.0.0.13", "switch.telematik.", True)]),
+}
+
+# Resolver processes behind 127.0.0.10, names are spread over them by consistent hashing, see shard.py
+RESOLVER_WORKERS = 4
+
+# Zones that run on their own in "sync" mode and answer one query after another, move a zone here to try it
+SYNC_SERVERS = []
+
+# Emulated network, everything runs at wire speed by default. Zone name or "resolver" -> latency of the messages that process sends,
+# see latency.py. E.g. the old 5 seconds on every hop are {name: 5 for name in ["resolver"] + zone names}, and
+# {"resolver": {"fixedSec": 0.02, "jitterSec": 0.01, "distribution": "exponential", "links": {"127.0.0.11": {"fixedSec": 0.1, "loss": 0.05}}}}
+# gives the resolver a long tailed 20 ms to everybody and a slow, lossy link to the root
+LATENCY = {}
+
+# Every server and the resolver serve their metrics at http://IP:METRICS_PORT/metrics, worker n of a host on METRICS_PORT + n
+METRICS_PORT = 9153
+
+def allZones():
+	"""Every zone we serve
+
+	Returns:
+		list: (ip, name, authoritative) of every zone
+	"""
+	return [zone for workers, hostZones in HOSTS.values() for zone in hostZones] + SYNC_SERVERS
+
+def startAll(counters, serverOptions=None, resolverOptions=None, latencies=None, resolverWorkers=None):
+	"""Starts every host, every sync server and the resolver
+
+	Args:
+		counters (COUNTERS): message counters of all servers and the resolver
+		serverOptions (dict): passed on to every DNS_SERVER, e.g. logLevel, default = None
+		resolverOptions (dict): passed on to the RESOLVER, default = None
+		latencies (dict): zone name or "resolver" -> emulated latency, default = LATENCY
+		resolverWorkers (int): processes of the resolver, default = RESOLVER_WORKERS
+
+	Returns:
+		list: the started processes, the resolver workers last
+	"""
+	serverOptions = serverOptions or {}
+	latencies = LATENCY if latencies is None else latencies
+	processes = []
+	for workers, hostZones in HOSTS.values():
+		processes += host.startHost(hostZones, workers, {name: counters.counter(name) for ip, name, auth in hostZones}, latencies, **serverOptions)
+	for ip, name, auth in SYNC_SERVERS:
+		options = dict(serverOptions, latency=latencies[name]) if name in latencies else serverOptions
+		server = Process(target=createServer, args=(ip, name, auth, "sync", counters.counter(name)), kwargs=options)
+		server.start()
+		processes.append(server)
+
+	resolverOptions = dict(resolverOptions or {})
+	if "resolver" in latencies:
+		resolverOptions["latency"] = latencies["resolver"]
+	processes += resolve.startResolver(RESOLVER_WORKERS if resolverWorkers is None else resolverWorkers, counters.counter("resolver"), **resolverOptions)
+	return processes
+
+def reportStartup(ready, count, launched, timeoutSec=60):
+	"""Prints how long every process took to start, as their reports come in
+
+	Args:
+		ready (Queue): the processes put (name, seconds) into it once they serve
+		count (int): number of processes
+		launched (float): time.time() when the first process was started
+		timeoutSec (float): Stop waiting for reports after this long, default = 60
+	"""
+	for n in range(count):
+		try:
+			name, seconds = ready.get(timeout=timeoutSec)
+		except queue.Empty:
+			print("STARTUP: %d of %d processes didn't report within %ds" % (count - n, count, timeoutSec))
+			return
+		print("STARTUP: %-40s %8.1f ms" % (name, seconds * 1e3))
+	print("STARTUP: all %d processes serving after %.1f ms" % (count, (time.time() - launched) * 1e3))
+
 if __name__ == '__main__':
-	ROOT = Process(target=createServer, args=("127.0.0.11", "ROOT", False,))
-	fuberlin = Process(target=createServer, args=("127.0.0.19", "fuberlin.", False))
-	homework = Process(target=createServer, args=("127.0.0.20", "homework.fuberlin.", True))
-	pcpools = Process(target=createServer, args=("127.0.0.23", "pcpools.fuberlin.", True))
-	telematik = Process(target=createServer, args=("127.0.0.12", "telematik.", False))
-	router = Process(target=createServer, args=("127.0.0.16", "router.telematik.", True))
-	switch = Process(target=createServer, args=("127.0.0.13", "switch.telematik.", True))
-	resolve = Process(target=resolver)
-	stub = Process(target=window)
+	# Message counters of all servers live in shared memory, only this process writes messages.json
+	counters = COUNTERS(names=["resolver"] + [name for ip, name, auth in allZones()])
 
-	ROOT.start()
-	fuberlin.start()
-	homework.start()
-	pcpools.start()
-	telematik.start()
-	router.start()
-	switch.start()
-	resolve.start()
+	# Every process reports how long its start took, loading zones and the cache is most of it
+	ready = Queue()
+	launched = time.time()
+	processes = startAll(counters, {"metricsPort": METRICS_PORT, "ready": ready}, {"metricsPort": METRICS_PORT, "ready": ready})
+	stub = Process(target=window)
 	stub.start()
-	
\ No newline at end of file
+
+	# Keep writing messages.json until the servers are gone
+	counters.start()
+	try:
+		reportStartup(ready, len(processes), launched)
+		for process in processes + [stub]:
+			process.join()
+	finally:
+		counters.stop()
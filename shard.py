@@ -0,0 +1,35 @@
+import bisect, hashlib, zlib
+
+class HASH_RING():
+	def __init__(self, shards, replicas=160):
+		"""Consistent hashing of names onto the worker processes of the resolver
+
+		Every worker is put on the ring many times (virtual nodes), so the names spread evenly and a different number
+		of workers moves only the names of the added or removed ones, the caches the others saved stay useful.
+		crc32 instead of hash(), every process has to get the same owner, whatever its PYTHONHASHSEED. The points
+		themselves come from md5, crc32 of "0#1", "0#2", ... clusters and gives some workers twice the names of others
+
+		Args:
+			shards (int): number of workers
+			replicas (int): points of every worker on the ring, default = 160
+		"""
+		self.shards = shards
+		points = sorted((self.point("%d#%d" % (shard, replica)), shard) for shard in range(shards) for replica in range(replicas))
+		self.hashes = [point for point, shard in points]
+		self.owners = [shard for point, shard in points]
+
+	@staticmethod
+	def point(text):
+		return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:4], "big")
+
+	def owner(self, name):
+		"""The worker that resolves and caches a name, for every type of it
+
+		Args:
+			name (str): e.g. www.switch.telematik.
+
+		Returns:
+			int: number of the worker
+		"""
+		index = bisect.bisect(self.hashes, zlib.crc32(name.encode('utf-8')))
+		return self.owners[index % len(self.owners)]
@@ -0,0 +1,209 @@
+import marshal, mmap, struct, json, os, sys, glob, argparse
+from suffixindex import SUFFIX_INDEX
+from zone import ZONE
+from records import RECORD
+from cache import CACHE
+from persist import atomicWrite, loadSnapshot
+
+# Bump when the content of a snapshot changes, older snapshots are ignored until they are compiled again
+VERSION = 2
+# Magic, our version and the marshal version of the Python that wrote it, marshal formats differ between Python versions
+MAGIC = b"DNSSNAP"
+HEADER = struct.Struct("!7sBB")
+
+def sourceStamp(*paths):
+	"""Modification time and size of the files a snapshot is made from, a snapshot with another stamp is stale
+
+	Args:
+		paths (str): the files, missing ones are None
+
+	Returns:
+		list: [mtime in ns, size] or None per file
+	"""
+	stamps = []
+	for path in paths:
+		try:
+			info = os.stat(path)
+			stamps.append([info.st_mtime_ns, info.st_size])
+		except OSError:
+			stamps.append(None)
+	return stamps
+
+def writeSnapshot(path, content):
+	"""Writes a snapshot atomically, like every other file we write
+
+	Args:
+		path (str): the snapshot file
+		content (dict): anything marshal can store
+	"""
+	atomicWrite(path, HEADER.pack(MAGIC, VERSION, marshal.version) + marshal.dumps(content))
+
+def readSnapshot(path):
+	"""Maps a snapshot into memory and unmarshals it in one go
+
+	Args:
+		path (str): the snapshot file
+
+	Returns:
+		dict: the content
+
+	Raises:
+		OSError: there is no snapshot
+		ValueError: the file is no snapshot, or one of another version
+	"""
+	with open(path, "rb") as snapfile:
+		try:
+			mapped = mmap.mmap(snapfile.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			raise ValueError("%s is empty" % path)
+	with mapped:
+		if len(mapped) < HEADER.size or mapped[:len(MAGIC)] != MAGIC:
+			raise ValueError("%s is no snapshot" % path)
+		magic, version, marshalVersion = HEADER.unpack_from(mapped)
+		if (version, marshalVersion) != (VERSION, marshal.version):
+			raise ValueError("%s has snapshot version %d (marshal %d), we need %d (marshal %d)" % (path, version, marshalVersion, VERSION, marshal.version))
+		with memoryview(mapped) as view:
+			try:
+				return marshal.loads(view[HEADER.size:])
+			except (EOFError, TypeError) as error:
+				raise ValueError("%s is broken: %s" % (path, error))
+
+def compileZone(zonePath, snapPath=None):
+	"""Turns a JSON zone file into a snapshot of its lookup index, see ZONE_SNAPSHOT
+
+	Args:
+		zonePath (str): e.g. zones/switch.telematik.zone
+		snapPath (str): where the snapshot goes, default = zonePath + ".snap"
+
+	Returns:
+		str: path of the snapshot
+	"""
+	snapPath = snapPath or zonePath + ".snap"
+	# Stamp first, a zone that changes while we read it makes a stale snapshot, not a wrong one
+	source = sourceStamp(zonePath)
+	with open(zonePath) as zonefile:
+		records = SUFFIX_INDEX(json.load(zonefile))
+	packed = {name: RECORD.fromJSON(record).pack() for name, record in records.items()}
+	writeSnapshot(snapPath, {"kind": "zone", "source": source, "records": packed, "trie": records.trie})
+	return snapPath
+
+class ZONE_SNAPSHOT(ZONE):
+	def __init__(self, path, authoritative, zonePath=None):
+		"""A zone loaded from its snapshot, for a fast start of big zones
+
+		The snapshot holds the records and their label trie, so loading is a single unmarshal instead of parsing JSON
+		and walking every name. Responses are compiled on first use and kept, compiling all of them up front is what
+		takes seconds in a big ZONE
+
+		Args:
+			path (str): the snapshot, see compileZone()
+			authoritative (boolean): Can give authoritative answers or not
+			zonePath (str): the zone file it was made from, default = path without ".snap"
+
+		Raises:
+			OSError: there is no snapshot
+			ValueError: the snapshot is broken, of another version or older than the zone file
+		"""
+		zonePath = zonePath or path[:-len(".snap")]
+		content = readSnapshot(path)
+		if content.get("kind") != "zone":
+			raise ValueError("%s is no zone snapshot" % path)
+		if content["source"] != sourceStamp(zonePath):
+			raise ValueError("%s was made from another version of %s" % (path, zonePath))
+		# Records stay the tuples of RECORD.pack() until a response is compiled from them, that's most of a start
+		self.records = SUFFIX_INDEX.restore(content["records"], content["trie"])
+		self.authoritative = authoritative
+		self.answers = {}
+		self.referrals = {}
+		self.error = self.compile({"dns.count.answers": 0}, 3 if self.authoritative else 2)
+		self.truncated = self.compile({"dns.flags.truncated": 1, "dns.count.answers": 0})
+
+	def lookup(self, domain):
+		"""Finds the response for a domain: its answer, else a referral to the longest suffix we know, else the error
+
+		Args:
+			domain (str): the queried name
+
+		Returns:
+			tuple: response body without question, and codec name -> template
+		"""
+		compiled = self.answers.get(domain)
+		if compiled is not None:
+			return compiled
+		packed = self.records.get(domain)
+		if packed is not None:
+			record = RECORD(*packed)
+			compiled = self.answers[domain] = self.compile(self.answerBody(domain, record.addressList(), record.ttl))
+			return compiled
+		suffix = self.records.longestSuffix(domain)
+		if not suffix:
+			return self.error
+		compiled = self.referrals.get(suffix)
+		if compiled is None:
+			record = RECORD(*self.records[suffix])
+			compiled = self.referrals[suffix] = self.compile(self.referralBody(suffix, record.addressList(), record.ttl))
+		return compiled
+
+def writeCache(cache, cachePath, snapPath=None, source=None):
+	"""Saves the whole state of a cache next to the cache.json it holds the same entries as
+
+	Args:
+		cache (CACHE): the cache
+		cachePath (str): its cache.json, which has to be up to date
+		snapPath (str): where the snapshot goes, default = cachePath + ".snap"
+		source (list): stamp of cache.json and its journal when the cache was read from them, default = their stamp now
+
+	Returns:
+		str: path of the snapshot
+	"""
+	snapPath = snapPath or cachePath + ".snap"
+	content = cache.state()
+	content.update({"kind": "cache", "source": source or sourceStamp(cachePath, cachePath + ".journal")})
+	writeSnapshot(snapPath, content)
+	return snapPath
+
+def compileCache(cachePath, snapPath=None):
+	"""Turns a cache.json and its journal into a snapshot, without any entry limit, the resolver applies its own
+
+	Args:
+		cachePath (str): e.g. cache.json
+		snapPath (str): where the snapshot goes, default = cachePath + ".snap"
+
+	Returns:
+		str: path of the snapshot
+	"""
+	source = sourceStamp(cachePath, cachePath + ".journal")
+	return writeCache(CACHE(loadSnapshot(cachePath), sys.maxsize), cachePath, snapPath, source)
+
+def loadCache(cachePath, snapPath=None, **options):
+	"""Restores a cache from its snapshot, if the snapshot holds what cache.json and its journal hold right now
+
+	Args:
+		cachePath (str): e.g. cache.json
+		snapPath (str): the snapshot, default = cachePath + ".snap"
+		options: CACHE arguments, e.g. maxEntries
+
+	Returns:
+		CACHE: the cache, None if there is no snapshot
+
+	Raises:
+		ValueError: the snapshot is broken, of another version or stale
+	"""
+	snapPath = snapPath or cachePath + ".snap"
+	try:
+		content = readSnapshot(snapPath)
+	except OSError:
+		return None
+	if content.get("kind") != "cache":
+		raise ValueError("%s is no cache snapshot" % snapPath)
+	if content["source"] != sourceStamp(cachePath, cachePath + ".journal"):
+		raise ValueError("%s is older than %s" % (snapPath, cachePath))
+	return CACHE.restore(content, **options)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Compiles zone files and resolver caches into snapshots that load in one go, zones/NAME.zone.snap and cache.json.snap")
+	parser.add_argument("files", nargs="*", help="zone files (.zone) and caches (.json), default = every zone in zones/ and every cache of the resolver workers")
+	args = parser.parse_args()
+	files = args.files or sorted(glob.glob("zones/*.zone")) + sorted(glob.glob("cache.json") + glob.glob("cache-worker*.json"))
+	for path in files:
+		print(compileZone(path) if path.endswith(".zone") else compileCache(path))
@@ -0,0 +1,215 @@
+import asyncio, struct, socket
+
+# Over TCP every message has its length in front (RFC 1035 4.2.2), so it can be as big as 65535 bytes
+LENGTH = struct.Struct("!H")
+
+def frame(data):
+	"""Puts the length in front of a message for sending it over TCP
+
+	Args:
+		data (bytes): the message
+
+	Returns:
+		bytes: length and message
+	"""
+	return LENGTH.pack(len(data)) + data
+
+def listenTcp(ip, port, reusePort=False):
+	"""Binds the TCP socket of a server, next to its UDP socket on the same IP and port
+
+	Args:
+		ip (str): Server IP
+		port (int): Server Port
+		reusePort (boolean): Share the port with other worker processes (SO_REUSEPORT), default = False
+
+	Returns:
+		socket: the listening socket
+	"""
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reusePort:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind((ip, port))
+	sock.listen(128)
+	return sock
+
+class FRAME_READER():
+	def __init__(self):
+		"""Cuts a TCP byte stream back into messages, whatever way the stream was split into segments
+		"""
+		self.buffer = bytearray()
+
+	def feed(self, data):
+		"""Takes in received bytes
+
+		Args:
+			data (bytes): the bytes
+
+		Returns:
+			list: every message that is complete now
+		"""
+		self.buffer += data
+		messages = []
+		while len(self.buffer) >= LENGTH.size:
+			length = LENGTH.unpack_from(self.buffer)[0]
+			if len(self.buffer) < LENGTH.size + length:
+				break
+			messages.append(bytes(self.buffer[LENGTH.size:LENGTH.size + length]))
+			del self.buffer[:LENGTH.size + length]
+		return messages
+
+class STREAM_PROTOCOL(asyncio.Protocol):
+	def __init__(self, server, idleSec=10):
+		"""TCP connection of a client to a DNS Server or the Resolver
+
+		Clients may send many queries without waiting for the answers (pipelining), every one is handed to
+		server.handleStream(data, addr, send) right away and answered whenever it is ready, the transaction ID
+		tells the client which answer is which (RFC 7766)
+
+		Args:
+			server (DNS_SERVER or RESOLVER): answers the messages
+			idleSec (float): Connections without a message for this long are closed, default = 10
+		"""
+		self.server = server
+		self.idleSec = idleSec
+		self.reader = FRAME_READER()
+		self.transport = None
+		self.idleTimer = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.addr = transport.get_extra_info("peername")
+		self.resetIdle()
+
+	def resetIdle(self):
+		if self.idleTimer is not None:
+			self.idleTimer.cancel()
+		self.idleTimer = asyncio.get_event_loop().call_later(self.idleSec, self.transport.close)
+
+	def data_received(self, data):
+		self.resetIdle()
+		for message in self.reader.feed(data):
+			self.server.handleStream(message, self.addr, self.send)
+
+	def send(self, data):
+		"""Sends an answer, unless the client went away in the meantime
+
+		Args:
+			data (bytes): the message
+		"""
+		if not self.transport.is_closing():
+			self.transport.write(frame(data))
+
+	def connection_lost(self, exc):
+		if self.idleTimer is not None:
+			self.idleTimer.cancel()
+
+class CLIENT_STREAM(asyncio.Protocol):
+	def __init__(self, pool, server):
+		"""Our end of a pooled connection, hands every answer to the pool
+
+		Args:
+			pool (STREAM_POOL): the pool
+			server (tuple): (ip, port) of the server
+		"""
+		self.pool = pool
+		self.server = server
+		self.reader = FRAME_READER()
+		self.transport = None
+		self.lastUse = 0
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def data_received(self, data):
+		for message in self.reader.feed(data):
+			self.pool.receive(message, self.server)
+
+	def connection_lost(self, exc):
+		self.pool.lost(self)
+
+	def write(self, data):
+		self.transport.write(frame(data))
+
+class STREAM_POOL():
+	def __init__(self, loop, receive, idleSec=30, connectTimeoutSec=5):
+		"""Persistent TCP connections to the DNS Servers, at most one per server
+
+		A query is written to the connection right away, even if earlier queries are still waiting for their
+		answers (pipelining), so one connection carries any number of queries and only the first one pays for
+		the handshake. Answers come back in any order and are handed to receive(data, server)
+
+		Args:
+			loop (asyncio.AbstractEventLoop): the loop of the resolver
+			receive (callable): called with every answer and the server it came from
+			idleSec (float): Connections we didn't use for this long are closed, default = 30
+			connectTimeoutSec (float): Give up connecting after this long, default = 5
+		"""
+		self.loop = loop
+		self.receive = receive
+		self.idleSec = idleSec
+		self.connectTimeoutSec = connectTimeoutSec
+		# server -> CLIENT_STREAM, or future of it while connecting
+		self.connections = {}
+		self.opened = 0
+		self.loop.call_later(self.idleSec, self.closeIdle)
+
+	async def connection(self, server):
+		"""The connection to a server, opened if we have none, callers connecting at the same time share the handshake
+
+		Args:
+			server (tuple): (ip, port) of the server
+
+		Returns:
+			CLIENT_STREAM: the connection
+
+		Raises:
+			OSError: the server doesn't take connections
+			asyncio.TimeoutError: connecting took too long
+		"""
+		connection = self.connections.get(server)
+		if isinstance(connection, CLIENT_STREAM):
+			return connection
+		if connection is None:
+			connection = self.connections[server] = self.loop.create_task(self.connect(server))
+		return await asyncio.shield(connection)
+
+	async def connect(self, server):
+		try:
+			transport, connection = await asyncio.wait_for(self.loop.create_connection(lambda: CLIENT_STREAM(self, server), *server), self.connectTimeoutSec)
+		except BaseException:
+			self.connections.pop(server, None)
+			raise
+		connection.lastUse = self.loop.time()
+		self.connections[server] = connection
+		self.opened += 1
+		return connection
+
+	async def send(self, server, data):
+		"""Writes a message to the connection of a server
+
+		Args:
+			server (tuple): (ip, port) of the server
+			data (bytes): the message
+		"""
+		connection = await self.connection(server)
+		connection.lastUse = self.loop.time()
+		connection.write(data)
+
+	def lost(self, connection):
+		if self.connections.get(connection.server) is connection:
+			del self.connections[connection.server]
+
+	def closeIdle(self):
+		"""Closes connections we didn't use for idleSec, every idleSec seconds
+		"""
+		now = self.loop.time()
+		for connection in list(self.connections.values()):
+			if isinstance(connection, CLIENT_STREAM) and now - connection.lastUse >= self.idleSec:
+				connection.transport.close()
+		self.loop.call_later(self.idleSec, self.closeIdle)
+
+	def close(self):
+		for connection in list(self.connections.values()):
+			if isinstance(connection, CLIENT_STREAM):
+				connection.transport.close()
@@ -1,10 +1,18 @@
-import socket, datetime, json, time
+import socket, datetime, json, time, select, sys, argparse
+from codec import CODECS, negotiate, EDNS_UDP_SIZE
+from latency import LATENCY
 
 #if query empty
 class STUB:
-	def __init__(self):
+	def __init__(self, latency=None, pauseSec=0):
 		"""Create a stub (which in this case rather acts as a iterative resolver)
+
+		Args:
+			latency (dict): Emulated delay and loss of our queries, see LATENCY.fromSpec(), default = None (wire speed)
+			pauseSec (float): Pause before most chat messages, so you can read along, default = 0
 		"""
+		self.latency = LATENCY.fromSpec(latency)
+		self.pauseSec = pauseSec
 		#DGRAM for UDP
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 		#Queries that take longer than 60 seconds to get a answer will be ignored
@@ -121,8 +129,8 @@ class STUB:
 
 	def say(self, message, delay=True):
 		print()
-		if delay:
-			time.sleep(2.5)
+		if delay and self.pauseSec:
+			time.sleep(self.pauseSec)
 		print("Stubby:", message)
 
 	def buildQuery(self, domain, recDesired, qryType):
@@ -157,7 +165,11 @@ class STUB:
 			ip (str): Server IP
 			port (int): Server Port
 		"""
-		time.sleep(5)
+		delay = self.latency.delay((ip, port))
+		if delay is None:
+			self.say("Oops, I dropped your query on the way to %s:%s, the network is lossy today!" % (ip, port), False)
+			return
+		time.sleep(delay)
 		self.say("I'm asking %s:%s for %s" %(ip,port,data), False)
 		#Don't forget to encode!
 		self.sock.send(data.encode('utf-8'))
@@ -168,7 +180,7 @@ class STUB:
 		"""
 		self.say("Let's wait for the response!", False)
 		try:
-			data, addr = self.sock.recvfrom(512)
+			data, addr = self.sock.recvfrom(65535)
 			if(data.decode('utf-8').startswith("Error")):
 				self.say("Oh no! Got %s from as a result from %s" % (data.decode('utf-8'), addr), False)
 			else:
@@ -177,4 +189,135 @@ class STUB:
 			self.say("Timed out while trying to get a server response. Maybe your query was wrong?", False)
 
 
-stubby = STUB()
\ No newline at end of file
+# Query types of a query file by their dig name, anything else has to be given as a number
+QUERY_TYPES = {"A": 1, "NS": 2, "CNAME": 5, "SOA": 6, "PTR": 12, "MX": 15, "TXT": 16, "AAAA": 28, "ANY": 255}
+
+def readQueries(lines):
+	"""Reads a query file like dig -f: one name per line, optionally followed by the query type
+
+	Args:
+		lines (iterable): lines of the file, # starts a comment
+
+	Raises:
+		ValueError: a line has a query type that is neither in QUERY_TYPES nor a number
+
+	Returns:
+		list: (name, type) of every query
+	"""
+	queries = []
+	for number, line in enumerate(lines, 1):
+		fields = line.split("#")[0].split()
+		if not fields:
+			continue
+		name = fields[0] if fields[0].endswith(".") else fields[0] + "."
+		qtype = fields[1].upper() if len(fields) > 1 else "A"
+		if qtype in QUERY_TYPES:
+			qtype = QUERY_TYPES[qtype]
+		else:
+			try:
+				qtype = int(qtype)
+			except ValueError:
+				raise ValueError("line %d: unknown query type %r in %r, use one of %s or a number" % (number, fields[1], line.strip(), ", ".join(QUERY_TYPES))) from None
+		queries.append((name, qtype))
+	return queries
+
+def bulk(queries, ip="127.0.0.10", port=53053, codec="json", concurrency=100, timeout=5, out=sys.stdout):
+	"""Sends every query over one socket, keeps up to concurrency of them in flight and writes one JSON line per query
+
+	Replies are matched to their query by transaction ID, so they may come back in any order
+
+	Args:
+		queries (list): (name, type) of every query
+		ip (str): Server IP, default = the resolver
+		port (int): Server Port
+		codec (str): "json" or "binary", default = "json"
+		concurrency (int): Queries in flight at the same time, default = 100
+		timeout (float): Seconds until we give up on a query, default = 5
+		out (file): where the JSON lines go, default = stdout
+
+	Returns:
+		int: number of queries that got an answer
+	"""
+	codec = CODECS[codec]
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.setblocking(False)
+	# transaction ID -> (name, type, time sent)
+	inflight = {}
+	nextQuery = 0
+	nextId = 0
+	answered = 0
+
+	def report(name, qtype, started, reply):
+		result = {"name": name, "type": qtype, "server": "%s:%d" % (ip, port), "ms": round((time.perf_counter() - started) * 1000, 3)}
+		if reply is None:
+			result.update({"rcode": None, "error": "timeout"})
+		else:
+			result.update({"rcode": reply.get("dns.flags.rcode"), "answer": reply.get("dns.a") if reply.get("dns.count.answers") else None, "ttl": reply.get("dns.resp.ttl")})
+			if reply.get("dns.count_auth_rr"):
+				result["referral"] = reply.get("dns.ns")
+			if reply.get("dns.flags.truncated"):
+				# Too big for UDP, dig would ask again over TCP
+				result["truncated"] = True
+		out.write(json.dumps(result) + "\n")
+
+	while nextQuery < len(queries) or inflight:
+		# Refill the window, IDs only have to be unique among the queries in flight
+		while nextQuery < len(queries) and len(inflight) < min(concurrency, 65536):
+			while nextId in inflight:
+				nextId = (nextId + 1) % 65536
+			name, qtype = queries[nextQuery]
+			message = {"dns.id": nextId, "dns.flags.response": 0, "dns.flags.recdesired": 1, "dns.qry.name": name, "dns.qry.type": qtype, "dns.edns.udpsize": EDNS_UDP_SIZE}
+			inflight[nextId] = (name, qtype, time.perf_counter())
+			sock.sendto(codec.encode(message), (ip, port))
+			nextQuery += 1
+		oldest = min(started for name, qtype, started in inflight.values())
+		readable, _, _ = select.select([sock], [], [], max(0, oldest + timeout - time.perf_counter()))
+		while readable:
+			try:
+				data, addr = sock.recvfrom(65535)
+			except BlockingIOError:
+				break
+			try:
+				reply = negotiate(data)[1]
+			except ValueError:
+				continue
+			waiting = inflight.get(reply.get("dns.id"))
+			# Late answer to a query we gave up on, or not ours at all
+			if addr != (ip, port) or waiting is None or reply.get("dns.qry.name", waiting[0]) != waiting[0]:
+				continue
+			del inflight[reply["dns.id"]]
+			report(waiting[0], waiting[1], waiting[2], reply)
+			answered += 1
+		now = time.perf_counter()
+		for ident, (name, qtype, started) in list(inflight.items()):
+			if now - started >= timeout:
+				del inflight[ident]
+				report(name, qtype, started, None)
+		out.flush()
+	sock.close()
+	return answered
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Stubby, chatty by default. With -f it asks for every name in a file and prints JSON lines instead")
+	parser.add_argument("-f", dest="file", help="file with one name (and optionally a query type) per line, - for stdin")
+	parser.add_argument("-s", "--server", default="127.0.0.10", help="IP to ask in bulk mode, default = the resolver")
+	parser.add_argument("-p", "--port", type=int, default=53053)
+	parser.add_argument("--codec", default="json", choices=sorted(CODECS))
+	parser.add_argument("-c", "--concurrency", type=int, default=100, help="queries in flight at the same time")
+	parser.add_argument("-t", "--timeout", type=float, default=5, help="seconds until a query counts as lost")
+	parser.add_argument("--latency", type=json.loads, help='emulated delay and loss of chatty queries as JSON, e.g. 5 or \'{"fixedSec": 0.5, "loss": 0.1}\'')
+	parser.add_argument("--pause", type=float, default=0, help="seconds to pause before most chat messages, 2.5 to read along")
+	args = parser.parse_args()
+	if args.file is None:
+		stubby = STUB(args.latency, args.pause)
+	else:
+		try:
+			if args.file == "-":
+				queries = readQueries(sys.stdin)
+			else:
+				with open(args.file) as queryfile:
+					queries = readQueries(queryfile)
+		except ValueError as error:
+			parser.error("%s: %s" % (args.file, error))
+		answered = bulk(queries, args.server, args.port, args.codec, args.concurrency, args.timeout)
+		sys.exit(0 if answered == len(queries) else 1)
\ No newline at end of file
@@ -0,0 +1,124 @@
+import sys
+
+# Marks the node of a complete name inside the trie, labels are always strings so None can't collide
+END = None
+
+class SUFFIX_INDEX(dict):
+	def __init__(self, entries=None):
+		"""Dictionary of domain names, which also keeps a trie of the reversed labels of every name
+
+		The trie turns "longest known suffix of a name" into one walk over the labels of the name,
+		instead of a scan over every known name
+
+		Args:
+			entries (dict): Names and their records to start with
+		"""
+		super().__init__()
+		self.trie = {}
+		if entries:
+			self.update(entries)
+
+	@classmethod
+	def restore(cls, entries, trie):
+		"""Puts an index back together from its names and its trie, e.g. out of a snapshot, without walking the labels of every name
+
+		Args:
+			entries (dict): Names and their records
+			trie (dict): the trie of exactly these names
+
+		Returns:
+			SUFFIX_INDEX: the index
+		"""
+		index = cls()
+		dict.update(index, entries)
+		index.trie = trie
+		return index
+
+	@staticmethod
+	def labels(domain):
+		"""Splits a domain into its labels, starting at the top level
+
+		Args:
+			domain (str): e.g. "www.switch.telematik."
+
+		Returns:
+			list: e.g. ["telematik", "switch", "www"]
+		"""
+		return [label for label in reversed(domain.split(".")) if label]
+
+	def __setitem__(self, name, value):
+		if name not in self:
+			labels = self.labels(name)
+			# Names without any label would be a suffix of everything, the old scan never matched those either
+			if labels:
+				node = self.trie
+				for label in labels:
+					# "telematik" is a label of thousands of names, they all share one string
+					node = node.setdefault(sys.intern(label), {})
+				node[END] = name
+		super().__setitem__(name, value)
+
+	def __delitem__(self, name):
+		super().__delitem__(name)
+		path = [self.trie]
+		for label in self.labels(name):
+			node = path[-1].get(label)
+			if node is None:
+				return
+			path.append(node)
+		if path[-1].get(END) != name:
+			return
+		del path[-1][END]
+		# Prune nodes nobody needs anymore, bottom up
+		labels = self.labels(name)
+		for depth in range(len(labels), 0, -1):
+			if path[depth]:
+				break
+			del path[depth - 1][labels[depth - 1]]
+
+	def pop(self, name, *default):
+		if name in self:
+			value = self[name]
+			del self[name]
+			return value
+		if default:
+			return default[0]
+		raise KeyError(name)
+
+	def popitem(self):
+		name = next(reversed(self))
+		return (name, self.pop(name))
+
+	def setdefault(self, name, default=None):
+		if name not in self:
+			self[name] = default
+		return self[name]
+
+	def update(self, *args, **kwargs):
+		for name, value in dict(*args, **kwargs).items():
+			self[name] = value
+
+	def clear(self):
+		super().clear()
+		self.trie = {}
+
+	def longestSuffix(self, domain):
+		"""Finds the longest known name that is a whole-label suffix of the domain (or the domain itself)
+
+		Args:
+			domain (str): The Domain we want to answer
+
+		Returns:
+			str: the longest known suffix or "" if there is none
+		"""
+		node = self.trie
+		biggest = ""
+		for label in reversed(domain.split(".")):
+			if not label:
+				continue
+			node = node.get(label)
+			if node is None:
+				break
+			if END in node:
+				biggest = node[END]
+		return biggest
@@ -0,0 +1,100 @@
+from suffixindex import SUFFIX_INDEX
+from records import RECORD
+from codec import CODECS
+
+def addresses(record):
+	"""A zone with several name servers lists all of their addresses in "A", a single one is just a string
+
+	Args:
+		record (dict): entry of a zone file
+
+	Returns:
+		list: every address of the name
+	"""
+	if isinstance(record["A"], list):
+		return record["A"]
+	return [record["A"]]
+
+class ZONE():
+	def __init__(self, records, authoritative):
+		"""A loaded zone with the response to every possible query compiled in advance
+
+		The answer for a name only changes when the zone changes, so every answer, every referral and
+		the error are built and serialized once per codec, a query only patches in its question
+
+		Args:
+			records (dict): zone file as dictionary/JSON
+			authoritative (boolean): Can give authoritative answers or not
+		"""
+		if not isinstance(records, SUFFIX_INDEX):
+			records = SUFFIX_INDEX(records)
+		# Same names and trie, but compact records instead of the JSON dicts
+		self.records = SUFFIX_INDEX.restore({name: RECORD.fromJSON(record) for name, record in records.items()}, records.trie)
+		self.authoritative = authoritative
+		self.answers = {}
+		self.referrals = {}
+		for name, record in self.records.items():
+			self.answers[name] = self.compile(self.answerBody(name, record.addressList(), record.ttl))
+			self.referrals[name] = self.compile(self.referralBody(name, record.addressList(), record.ttl))
+		# Authoritative servers know the name doesn't exist, the others just can't process the query
+		self.error = self.compile({"dns.count.answers": 0}, 3 if self.authoritative else 2)
+		# Sent over UDP instead of a response that doesn't fit, the client asks again over TCP
+		self.truncated = self.compile({"dns.flags.truncated": 1, "dns.count.answers": 0})
+
+	@staticmethod
+	def answerBody(name, addresses, ttl):
+		# A query for the name itself gets the first address
+		return {"dns.count.answers": 1, "dns.ns": name, "dns.a": addresses[0], "dns.resp.ttl": ttl}
+
+	@staticmethod
+	def referralBody(name, addresses, ttl):
+		"""Referral to the name servers of a zone below us, the resolver picks one of dns.auth.a if there are several
+
+		Returns:
+			dict: the referral part of the response
+		"""
+		body = {"dns.count.answers": 0, "dns.count_auth_rr": 1, "dns.ns": name, "dns.a": addresses[0], "dns.resp.ttl": ttl}
+		if len(addresses) > 1:
+			body["dns.auth.a"] = list(addresses)
+		return body
+
+	def compile(self, records, rcode=0):
+		"""Builds a response body and serializes it for every codec
+
+		Args:
+			records (dict): the answer or referral part of the response
+			rcode (int): response code, default = 0
+
+		Returns:
+			tuple: response body without question, and codec name -> template
+		"""
+		# Static things that every response has
+		body = {
+			"dns.flags.response": 1,
+			"dns.flags.recavail": 0,
+			"dns.flags.rcode": rcode,
+			"dns.flags.authoritative": 1 if self.authoritative else 0}
+		body.update(records)
+		return (body, {name: codec.compile(body) for name, codec in CODECS.items()})
+
+	def close(self):
+		"""Frees what the zone holds besides memory, nothing for a loaded zone, see ZONE_DB.close()
+		"""
+		pass
+
+	def lookup(self, domain):
+		"""Finds the response for a domain: its answer, else a referral to the longest suffix we know, else the error
+
+		Args:
+			domain (str): the queried name
+
+		Returns:
+			tuple: response body without question, and codec name -> template
+		"""
+		compiled = self.answers.get(domain)
+		if compiled is not None:
+			return compiled
+		suffix = self.records.longestSuffix(domain)
+		if suffix:
+			return self.referrals[suffix]
+		return self.error
@@ -0,0 +1,182 @@
+import sqlite3, json, os, tempfile, collections, argparse, urllib.request
+from suffixindex import SUFFIX_INDEX
+from zone import ZONE, addresses
+
+# Bump when the table layout changes, old files have to be converted again
+VERSION = 1
+
+def reversedName(name):
+	"""Key of a name in the database, labels from the top down so a zone and everything below it sort next to each other
+
+	Args:
+		name (str): e.g. www.switch.telematik.
+
+	Returns:
+		str: e.g. telematik.switch.www
+	"""
+	return ".".join(SUFFIX_INDEX.labels(name))
+
+def convertZone(zonePath, dbPath=None):
+	"""Converts a JSON zone file into an SQLite zone, the file is replaced in one step so running servers can reload it
+
+	Args:
+		zonePath (str): e.g. zones/switch.telematik.zone
+		dbPath (str): where the database goes, default = zonePath + "db"
+
+	Returns:
+		str: path of the database
+	"""
+	dbPath = dbPath or zonePath + "db"
+	with open(zonePath) as zonefile:
+		records = json.load(zonefile)
+	handle, tmpPath = tempfile.mkstemp(dir=os.path.dirname(dbPath) or ".", suffix=".tmp")
+	os.close(handle)
+	try:
+		db = sqlite3.connect(tmpPath)
+		db.execute("PRAGMA journal_mode = OFF")
+		db.execute("PRAGMA synchronous = OFF")
+		db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID")
+		db.execute("CREATE TABLE records (rname TEXT PRIMARY KEY, name TEXT NOT NULL, a TEXT NOT NULL, ttl INTEGER NOT NULL) WITHOUT ROWID")
+		db.executemany("INSERT INTO records VALUES (?, ?, ?, ?)", ((reversedName(name), name, ",".join(addresses(record)), record["TTL"]) for name, record in records.items()))
+		db.executemany("INSERT INTO meta VALUES (?, ?)", [("version", VERSION), ("count", len(records))])
+		db.commit()
+		db.close()
+		os.replace(tmpPath, dbPath)
+	except BaseException:
+		os.remove(tmpPath)
+		raise
+	return dbPath
+
+class ZONE_INDEX():
+	def __init__(self, path):
+		"""Read only view on an SQLite zone that answers the same questions as the SUFFIX_INDEX of a JSON zone
+
+		Nothing is loaded up front, every lookup is one query on the primary key
+
+		Args:
+			path (str): the database, see convertZone()
+		"""
+		self.path = path
+		# Built by the reload thread, used by the serving thread afterwards
+		self.db = sqlite3.connect("file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(path)), uri=True, check_same_thread=False)
+		try:
+			meta = dict(self.db.execute("SELECT key, value FROM meta"))
+			if meta.get("version") != VERSION:
+				raise ValueError("%s has zone database version %s, we need %d" % (path, meta.get("version"), VERSION))
+		except BaseException:
+			self.db.close()
+			raise
+		self.count = meta["count"]
+
+	def close(self):
+		self.db.close()
+
+	def __len__(self):
+		return self.count
+
+	def __contains__(self, name):
+		return self.get(name) is not None
+
+	def get(self, name, default=None):
+		"""Record of a name
+
+		Args:
+			name (str): the name
+			default: returned if the zone doesn't know the name, default = None
+
+		Returns:
+			dict: {"A": ..., "TTL": ...} like in the zone file
+		"""
+		row = self.db.execute("SELECT a, ttl FROM records WHERE rname = ?", (reversedName(name),)).fetchone()
+		if row is None:
+			return default
+		found = row[0].split(",")
+		return {"A": found if len(found) > 1 else found[0], "TTL": row[1]}
+
+	def match(self, domain):
+		"""Finds the longest known name that is a whole-label suffix of the domain (or the domain itself)
+
+		Args:
+			domain (str): The Domain we want to answer
+
+		Returns:
+			tuple: (name, addresses joined by commas, TTL) or None if there is none
+		"""
+		labels = SUFFIX_INDEX.labels(domain)
+		if not labels:
+			return None
+		suffixes = [".".join(labels[:i]) for i in range(1, len(labels) + 1)]
+		return self.db.execute(
+			"SELECT name, a, ttl FROM records WHERE rname IN (%s) ORDER BY length(rname) DESC LIMIT 1" % ",".join("?" * len(suffixes)),
+			suffixes).fetchone()
+
+	def longestSuffix(self, domain):
+		"""Same as SUFFIX_INDEX.longestSuffix
+
+		Returns:
+			str: the longest known suffix or "" if there is none
+		"""
+		found = self.match(domain)
+		return found[0] if found else ""
+
+class ZONE_DB(ZONE):
+	def __init__(self, path, authoritative, compiledEntries=10000):
+		"""A zone that stays in its SQLite file, for zones too big to load and compile completely
+
+		Responses are compiled on first use and the most recently used ones are kept
+
+		Args:
+			path (str): the database, see convertZone()
+			authoritative (boolean): Can give authoritative answers or not
+			compiledEntries (int): Compiled responses we keep, default = 10000
+		"""
+		self.records = ZONE_INDEX(path)
+		self.authoritative = authoritative
+		self.compiledEntries = compiledEntries
+		# (name, is answer) -> compiled response, oldest first
+		self.compiled = collections.OrderedDict()
+		self.error = self.compile({"dns.count.answers": 0}, 3 if self.authoritative else 2)
+		self.truncated = self.compile({"dns.flags.truncated": 1, "dns.count.answers": 0})
+
+	def close(self):
+		"""Closes the database, the compiled responses stay usable
+		"""
+		self.records.close()
+
+	def lookup(self, domain):
+		"""Finds the response for a domain: its answer, else a referral to the longest suffix we know, else the error
+
+		Args:
+			domain (str): the queried name
+
+		Returns:
+			tuple: response body without question, and codec name -> template
+		"""
+		compiled = self.compiled.get((domain, True))
+		if compiled is not None:
+			self.compiled.move_to_end((domain, True))
+			return compiled
+		found = self.records.match(domain)
+		if found is None:
+			return self.error
+		name, joined, ttl = found
+		key = (name, name == domain)
+		compiled = self.compiled.get(key)
+		if compiled is not None:
+			self.compiled.move_to_end(key)
+			return compiled
+		if key[1]:
+			compiled = self.compile(self.answerBody(name, joined.split(","), ttl))
+		else:
+			compiled = self.compile(self.referralBody(name, joined.split(","), ttl))
+		self.compiled[key] = compiled
+		if len(self.compiled) > self.compiledEntries:
+			self.compiled.popitem(last=False)
+		return compiled
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Converts JSON zone files into SQLite zones, a server prefers zones/NAME.zonedb over zones/NAME.zone")
+	parser.add_argument("zones", nargs="+", help="JSON zone files, e.g. zones/switch.telematik.zone")
+	args = parser.parse_args()
+	for zonePath in args.zones:
+		print(convertZone(zonePath))